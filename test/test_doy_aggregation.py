@@ -467,6 +467,41 @@ def test_2y_depth_on_1y():
     assert funcs.doy_aggregation(series, depth=2).empty
 
 
+@pytest.mark.parametrize('method', ['mean', 'median', 'sum', 'max', 'std'])
+@pytest.mark.parametrize('leap_day_rule', ['ignore', 'linear', 'as_is'])
+def test_grid_like_yearly(method, leap_day_rule):
+    # daily values with holes and nans over 8 years
+    index = pd.date_range('2014-3-1', '2022-2-28', freq='D')
+    values = np.arange(len(index), dtype='float64') % 97
+    values[::7] = np.nan
+    series = pd.Series(values, index=index, name='indicator')
+    series = series.drop(index[100:400:3])
+
+    start, end = funcs.get_boundaries(series, 3)
+    for ratio in (.5, 1.):
+        pd.testing.assert_series_equal(
+            funcs._doy_grid_aggregation(
+                series, 3, method, leap_day_rule, ratio, start, end
+            ),
+            funcs._doy_yearly_aggregation(
+                series, 3, method, leap_day_rule, ratio, start, end
+            ),
+        )
+
+
+def test_hourly_last_day():
+    index = pd.date_range('2020-12-30', '2022-1-1', freq='H', inclusive='left')
+    series = pd.Series(
+        np.where(index.hour < 12, 1., 3.),
+        index=index,
+        name='indicator'
+    )
+    ts = funcs.doy_aggregation(series, depth=1, valid_aggr_ratio=0.)
+    # all the hours of december 31st count
+    assert ts[pd.Timestamp('2021-12-31')] == 2.
+    assert ts.loc['2022-12-30':'2022-12-31'].tolist() == [2., 2.]
+
+
 # test helpers for operator
 
 @pytest.fixture
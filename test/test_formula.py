@@ -1,9 +1,13 @@
 from datetime import datetime as dt, timedelta
+import threading
+import time
 
 from dateutil.relativedelta import relativedelta
 import pandas as pd
 import numpy as np
 import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 
 from psyl import lisp
 from tshistory.testutil import (
@@ -14,6 +18,11 @@ from tshistory.testutil import (
 )
 
 from tshistory_formula.decorator import decorate
+from tshistory_formula.evaluator import (
+    compile_plan,
+    count_query,
+    pevaluate
+)
 from tshistory_formula.registry import (
     func,
     FUNCS,
@@ -21,6 +30,7 @@ from tshistory_formula.registry import (
     HISTORY,
     history,
     metadata,
+    POINTWISE,
     gfunc,
     gfinder,
     ginsertion_dates,
@@ -35,9 +45,16 @@ from tshistory_formula.helper import (
     name_of_expr,
     rename_operator,
     find_autos,
+    inject_toplevel_bindings,
     scan_descendant_nodes,
+    LRUCache,
+    ReadPool,
+    Scheduler,
 )
+from tshistory_formula import interpreter
 from tshistory_formula.interpreter import (
+    HistoryIndex,
+    HistoryInterpreter,
     Interpreter,
     NullIntepreter,
     OperatorHistory,
@@ -67,6 +84,473 @@ def test_evaluator():
     assert tree == ['+', 20.0, ['series', 'foo']]
 
 
+def test_compiled_plan():
+    env = lisp.Env({
+        '+': lambda a, b: a + b,
+        '*': lambda a, b=1: a * b
+    })
+    tree = lisp.parse(
+        '(let x 2 (let y (+ x 1) (let x 5 (+ (* x #:b y) (* x)))))'
+    )
+    plan = compile_plan(tree)
+    # one node per function call, let-bindings are gone
+    assert len(plan.nodes) == 4
+    assert pevaluate(plan, env, concurrency=1) == 20
+    # a plan can be evaluated many times
+    assert pevaluate(plan, env, concurrency=1) == 20
+    # the intermediate values are released after their last use
+    assert [node.release for node in plan.nodes] == [(), (0,), (), (1, 2)]
+
+
+def test_plan_cse():
+    calls = []
+
+    def leaf(x):
+        calls.append(x)
+        return pd.Series(
+            [x, x],
+            index=pd.date_range(dt(2022, 1, 1), periods=2, freq='D')
+        )
+
+    def shifted(ts):
+        # in place mutation of the input
+        ts.index = ts.index + timedelta(days=1)
+        return ts
+
+    env = lisp.Env({
+        'leaf': leaf,
+        'shifted': shifted,
+        'list': lambda *a: a
+    })
+    tree = lisp.parse(
+        '(list (shifted (leaf 1)) (leaf 1) (leaf 1.0) (shifted (leaf 1)))'
+    )
+    plan = compile_plan(tree)
+    # leaf 1, shifted, leaf 1.0, list
+    assert len(plan.nodes) == 4
+    assert plan.uses == {0: 2, 1: 2}
+
+    shift1, base, base_float, shift2 = pevaluate(plan, env, concurrency=1)
+    assert calls == [1, 1.0]
+    assert base.index[0] == pd.Timestamp('2022-01-01')
+    assert shift1.index[0] == pd.Timestamp('2022-01-02')
+    assert shift2.index[0] == pd.Timestamp('2022-01-02')
+    assert shift1 is not shift2
+    assert base_float.dtype == 'float64'
+
+
+def test_plan_fusion(engine, tsh):
+    ts = pd.Series(
+        [0, 60, 90, np.nan],
+        index=pd.date_range(dt(2022, 1, 1), periods=4, freq='D')
+    )
+    tsh.update(engine, ts, 'fuse-me', 'Babar')
+
+    text = (
+        '(* 1.1 (+ 3 (** (trig.cos (series "fuse-me" #:fill 0)) 2)))'
+    )
+    plan = compile_plan(lisp.parse(text))
+    # series, fused chain
+    assert len(plan.nodes) == 2
+    assert plan.nodes[1].opnames() == ('trig.cos', '**', '+', '*')
+
+    tsh.register_formula(engine, 'fused', text)
+    fused = tsh.get(engine, 'fused')
+    base = tsh.get(engine, 'fuse-me')
+    assert fused.equals(1.1 * (3 + np.cos(base * np.pi / 180) ** 2))
+
+    i = Interpreter(engine, tsh, {})
+    res = pevaluate(
+        inject_toplevel_bindings(lisp.parse(text), {}),
+        i.env,
+        concurrency=1
+    )
+    assert res.options == {'fill': 0, 'limit': None}
+
+    # comparators drop the name and options
+    res = pevaluate(
+        inject_toplevel_bindings(
+            lisp.parse(
+                '(> (* 2 (series "fuse-me" #:fill 0)) 100 #:true_value 7)'
+            ),
+            {}
+        ),
+        i.env,
+        concurrency=1
+    )
+    assert res.options == {}
+    assert res.tolist() == [0., 7., 7.]
+
+    # the fused comparators are the operators, equal values included
+    shifted = pevaluate(
+        inject_toplevel_bindings(
+            lisp.parse('(+ 1 (series "fuse-me" #:fill 0))'), {}
+        ),
+        i.env,
+        concurrency=1
+    )
+    for op in ('<', '<=', '>', '>=', '==', '<>'):
+        text = f'({op} (+ 1 (series "fuse-me" #:fill 0)) 61)'
+        plan = compile_plan(lisp.parse(text))
+        assert plan.nodes[-1].opnames() == ('+', op)
+        res = pevaluate(
+            inject_toplevel_bindings(lisp.parse(text), {}),
+            i.env,
+            concurrency=1
+        )
+        assert res.equals(FUNCS[op](shifted, 61)), op
+
+    # the step by step fallback
+    res = pevaluate(
+        lisp.parse('(+ 1 (* 2 3))'), i.env, concurrency=1
+    )
+    assert res == 7
+
+
+def test_plan_rewrite(engine, tsh):
+    for name, offset in (('rw-a', 0), ('rw-b', 1), ('rw-c', 2)):
+        ts = pd.Series(
+            [1., 2., 3., 4.],
+            index=pd.date_range(
+                dt(2022, 1, 1 + offset), periods=4, freq='D'
+            )
+        )
+        tsh.update(engine, ts, name, 'Babar')
+
+    def nodes(text):
+        return [
+            node.opnames()
+            for node in compile_plan(lisp.parse(text)).nodes
+        ]
+
+    # identities
+    assert nodes(
+        '(priority (slice (* 1 (series "rw-a")) #:fromdate (date "2022-1-2")))'
+    ) == [('series',), ('date',)]
+    # merged shifts and options
+    assert nodes(
+        '(time-shifted (time-shifted (series "rw-a") #:days 1) #:days 2 #:hours 1)'
+    ) == [('series',), ('time-shifted',)]
+    assert nodes(
+        '(options (options (series "rw-a") #:fill 0) #:fill "ffill")'
+    ) == [('series',), ('options',)]
+    # exact coefficients only
+    assert nodes('(* 2 (* 3 (series "rw-a")))') == [('series',), ('*',)]
+    assert nodes('(* 1.1 (* 3 (series "rw-a")))') == [('series',), ('*', '*')]
+    # flattened sums, unless the inner series are filled
+    assert nodes(
+        '(add (add (series "rw-a") (series "rw-b")) (series "rw-c" #:fill 0))'
+    ) == [('series',), ('series',), ('series',), ('add',)]
+    assert nodes(
+        '(add (add (series "rw-a") (series "rw-b" #:fill 0)) (series "rw-c"))'
+    ) == [('series',), ('series',), ('add',), ('series',), ('add',)]
+    # shared nodes are kept
+    plan = compile_plan(
+        lisp.parse(
+            '(add (time-shifted (series "rw-a") #:days 1) '
+            '     (time-shifted (time-shifted (series "rw-a") #:days 1) #:days 1))'
+        )
+    )
+    assert len(plan.nodes) == 4
+
+    for text, expected in (
+            ('(time-shifted (time-shifted (series "rw-a") #:days 1) #:days 2)',
+             [1., 2., 3., 4.]),
+            ('(options (options (series "rw-a") #:fill 0) #:fill "ffill")',
+             [1., 2., 3., 4.]),
+            ('(* 2 (* 3 (series "rw-a")))',
+             [6., 12., 18., 24.]),
+            ('(add (add (series "rw-a") (series "rw-b")) (series "rw-c" #:fill 0))',
+             [3., 6., 9.]),
+            ('(priority (slice (series "rw-a") #:fromdate (date "2022-1-2")))',
+             [2., 3., 4.])
+    ):
+        tsh.register_formula(engine, 'rewritten', text)
+        assert tsh.get(engine, 'rewritten').tolist() == expected
+        tsh.delete(engine, 'rewritten')
+
+    ts = tsh.get(
+        engine, 'rw-a'
+    )
+    shifted = pevaluate(
+        inject_toplevel_bindings(
+            lisp.parse(
+                '(time-shifted (time-shifted (series "rw-a") #:days 1) #:days 2)'
+            ),
+            {}
+        ),
+        Interpreter(engine, tsh, {}).env,
+        concurrency=1
+    )
+    assert shifted.index[0] == ts.index[0] + timedelta(days=3)
+
+
+def test_history_index():
+    hist = {
+        utcdt(2022, 1, 2): 'b',
+        utcdt(2022, 1, 1): 'a',
+        pd.Timestamp('2022-1-3 1:00', tz='Europe/Paris'): 'c'
+    }
+    index = HistoryIndex(hist)
+    assert index.find(utcdt(2021, 12, 31)) is None
+    assert index.find(utcdt(2022, 1, 1)) == 'a'
+    assert index.find(utcdt(2022, 1, 1, 23)) == 'a'
+    assert index.find(utcdt(2022, 1, 2)) == 'b'
+    # naive dates are utc
+    assert index.find(dt(2022, 1, 2, 23, 59)) == 'b'
+    assert index.find(dt(2022, 1, 3)) == 'c'
+    assert index.find(pd.Timestamp('2022-1-3', tz='Europe/Paris')) == 'b'
+    assert HistoryIndex({}).find(utcdt(2022, 1, 1)) is None
+
+
+def test_plan_prefetch():
+    barrier = threading.Barrier(4, timeout=5)
+
+    def leaf(x):
+        # all the leaves must be in flight at the same time
+        barrier.wait()
+        return x
+
+    env = lisp.Env({
+        '+': lambda a, b: a + b,
+        '*': lambda a, b: a * b,
+        'leaf': leaf
+    })
+    tree = lisp.parse(
+        '(+ (* (leaf 1) (leaf 2)) (* (leaf 3) (leaf 4)))'
+    )
+    with Scheduler(4) as pool:
+        assert pevaluate(tree, env, (leaf,), pool=pool) == 14
+
+
+def test_scheduler_nesting(tsh):
+    # a task waiting on its own sub-tasks does not starve
+    # the (single worker) pool
+    with Scheduler(1) as pool:
+        def fib(n):
+            if n < 2:
+                return n
+            a = pool.submit(fib, n - 1)
+            b = pool.submit(fib, n - 2)
+            return a.result() + b.result()
+
+        assert pool.submit(fib, 10).result() == 55
+        assert len(pool._threads) == 1
+
+    # a waiter only helps with the work of its own evaluation
+    with Scheduler(1) as pool:
+        release = threading.Event()
+        blocker = pool.submit(release.wait)
+        try:
+            own = pool.submit(threading.current_thread)
+            foreign = []
+            other = threading.Thread(
+                target=lambda: foreign.append(
+                    pool.submit(threading.current_thread)
+                )
+            )
+            other.start()
+            other.join()
+
+            # the newest item is not ours
+            assert own.result() is threading.current_thread()
+            assert not foreign[0].done()
+        finally:
+            release.set()
+
+        assert blocker.result()
+        assert foreign[0].result() not in (
+            threading.current_thread(), other
+        )
+
+    # the scheduler is shared across evaluations
+    if tsh.concurrency > 1:
+        assert tsh.scheduler is tsh.scheduler
+        assert tsh.scheduler.max_workers == tsh.concurrency
+    else:
+        assert tsh.scheduler is None
+
+
+def test_read_pool(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(dt(2023, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'pooled-a', 'Babar')
+
+    with engine.begin() as cn:
+        pool = ReadPool(cn, 2)
+        with pool.borrow() as first:
+            # the transaction connection goes first
+            assert first is cn
+            with pool.borrow() as second:
+                assert second is not cn
+                # written after the snapshot export
+                tsh.update(engine, ts, 'pooled-b', 'Babar')
+                assert tsh.exists(cn, 'pooled-b')
+                assert tsh.get(second, 'pooled-a').equals(
+                    tsh.get(cn, 'pooled-a')
+                )
+                assert not tsh.exists(second, 'pooled-b')
+        assert len(pool._opened) == 1
+        pool.close()
+
+    # a transaction which has written keeps its connection
+    with engine.begin() as cn:
+        tsh.update(cn, ts + 1, 'pooled-a', 'Babar')
+        pool = ReadPool(cn, 2)
+        with pool.borrow() as first:
+            with pool.borrow() as second:
+                assert first is second is cn
+                assert tsh.get(second, 'pooled-a').equals(ts + 1)
+        assert not pool._opened
+
+    # no waiting for the connections of a busy engine
+    small = create_engine(engine.url, pool_size=2, max_overflow=0)
+    with small.begin() as cn:
+        pool = ReadPool(cn, 2)
+        with pool.borrow() as first:
+            with small.connect():
+                start = time.time()
+                with pool.borrow() as second:
+                    assert first is second is cn
+                assert time.time() - start < 1
+        assert not pool._opened
+    small.dispose()
+
+    # the leaves read concurrently (the rolling windows bounds being
+    # computed, these are not bulk prefetched)
+    for idx in range(4):
+        tsh.update(engine, ts * idx, f'pooled-leaf-{idx}', 'Babar')
+    tsh.register_formula(
+        engine,
+        'pooled-sum',
+        '(add ' + ' '.join(
+            f'(rolling (series "pooled-leaf-{idx}") 1)' for idx in range(4)
+        ) + ')'
+    )
+
+    inflight = set()
+    maxinflight = []
+    lock = threading.Lock()
+    get = tsh.get
+    def spy(cn, name, **kw):
+        if not name.startswith('pooled-leaf'):
+            return get(cn, name, **kw)
+        with lock:
+            # no connection is shared by two concurrent reads
+            assert id(cn) not in inflight
+            inflight.add(id(cn))
+            maxinflight.append(len(inflight))
+        try:
+            time.sleep(.1)
+            return get(cn, name, **kw)
+        finally:
+            with lock:
+                inflight.remove(id(cn))
+    # the pool is opt-in
+    assert tsh.readers == 1
+    monkeypatch.setattr(tsh, 'readers', 4)
+    tsh.get = spy
+    try:
+        assert tsh.get(engine, 'pooled-sum').tolist() == [6., 12., 18.]
+    finally:
+        del tsh.get
+    assert not tsh._readpools
+    assert len(maxinflight) == 4
+    if tsh.concurrency > 1:
+        assert max(maxinflight) > 1
+
+
+def test_profile(engine, tsh):
+    ts = pd.Series(
+        [1., 2., 3.],
+        index=pd.date_range(dt(2023, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'profiled-a', 'Babar')
+    tsh.update(engine, ts * 2, 'profiled-b', 'Babar')
+    tsh.register_formula(
+        engine,
+        'profiled-inner',
+        '(add (series "profiled-a") (series "profiled-b"))'
+    )
+    tsh.register_formula(
+        engine,
+        'profiled-outer',
+        '(* 3 (series "profiled-inner"))'
+    )
+
+    ts, report = tsh.get(engine, 'profiled-outer', __profile__=True)
+    assert ts.tolist() == [9., 18., 27.]
+    assert ts.equals(tsh.get(engine, 'profiled-outer'))
+
+    assert report['get'] == 'profiled-outer'
+    assert report['queries'] > 0
+    outer, = report['nested']
+    assert outer['formula'] == 'profiled-outer'
+    root, = outer['plans']
+    # the inner formula has been expanded in the plan
+    assert root['operator'] == '*'
+    assert root['expression'] == (
+        '(* 3 (add (series "profiled-a") (series "profiled-b")))'
+    )
+    assert root['rows_in'] == 3
+    assert root['rows_out'] == 3
+    assert root['bytes'] > 0
+    assert root['time'] > 0
+    assert root['wait'] >= 0
+    add, = root['inputs']
+    assert add['operator'] == 'add'
+    assert add['rows_in'] == 6
+    assert [
+        (node['operator'], node['expression'], node['rows_out'])
+        for node in add['inputs']
+    ] == [
+        ('series', '(series "profiled-a")', 3),
+        ('series', '(series "profiled-b")', 3)
+    ]
+    # the primary series are read upfront by the formula
+    # evaluation, with one batch of queries
+    assert outer['queries'] > 0
+    assert [node['queries'] for node in add['inputs']] == [0, 0]
+
+    # the formulas read at evaluation time hang below the node
+    # which has read them
+    tsh.update(engine, tsh.get(engine, 'profiled-b'), 'listed.b', 'Babar')
+    tsh.register_formula(
+        engine,
+        'listed.inner',
+        '(add (series "profiled-a") (series "profiled-b"))'
+    )
+    tsh.register_formula(
+        engine,
+        'profiled-list',
+        '(row-max (serieslist (findnames (by.name "listed."))))'
+    )
+    ts, report = tsh.get(engine, 'profiled-list', __profile__=True)
+    assert ts.tolist() == [3., 6., 9.]
+    root, = report['nested'][0]['plans']
+    assert root['operator'] == 'serieslist|row-max'
+    assert root['rows_out'] == 3
+    inner, = root['nested']
+    assert inner['formula'] == 'listed.inner'
+    assert inner['plans'][0]['operator'] == 'add'
+    assert inner['plans'][0]['rows_out'] == 3
+
+    # a primary series
+    ts, report = tsh.get(engine, 'profiled-a', __profile__=True)
+    assert ts.tolist() == [1., 2., 3.]
+    assert report['get'] == 'profiled-a'
+    assert report['queries'] > 0
+    assert 'nested' not in report
+
+    # the queries are only watched during the profile
+    for target in (engine, Engine):
+        assert not event.contains(
+            target, 'before_cursor_execute', count_query
+        )
+
+
 def test_bad_toplevel_type(engine, tsh):
     msg = 'formula `test_bad_toplevel_type` must return a `Series`, not `int`'
     with pytest.raises(TypeError, match=msg):
@@ -386,6 +870,204 @@ def test_content_hash(engine, tsh):
     assert ch == tsh.live_content_hash(engine, 'hash-me')
 
 
+def test_formula_plan_cache(engine, tsh):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'plan-base', 'Babar')
+    tsh.register_formula(engine, 'plan-sub', '(+ 1 (series "plan-base"))')
+    tsh.register_formula(engine, 'plan-top', '(* 2 (series "plan-sub"))')
+
+    ts = tsh.get(engine, 'plan-top')
+    assert_df("""
+2022-01-01 00:00:00+00:00    4.0
+2022-01-02 00:00:00+00:00    6.0
+2022-01-03 00:00:00+00:00    8.0
+""", ts)
+    ch, plan = tsh.plans['plan-top']
+    assert ch == tsh.content_hash(engine, 'plan-top')
+
+    ts = tsh.get(engine, 'plan-top', from_value_date=utcdt(2022, 1, 2))
+    assert_df("""
+2022-01-02 00:00:00+00:00    6.0
+2022-01-03 00:00:00+00:00    8.0
+""", ts)
+    assert tsh.plans['plan-top'][1] is plan
+
+    # the dependents content hash follows the sub-formula
+    tsh.register_formula(engine, 'plan-sub', '(+ 2 (series "plan-base"))')
+    assert tsh.content_hash(engine, 'plan-top') != ch
+    assert tsh.content_hash(engine, 'plan-top') == tsh.live_content_hash(
+        engine, 'plan-top'
+    )
+
+    ts = tsh.get(engine, 'plan-top')
+    assert_df("""
+2022-01-01 00:00:00+00:00     6.0
+2022-01-02 00:00:00+00:00     8.0
+2022-01-03 00:00:00+00:00    10.0
+""", ts)
+    assert tsh.plans['plan-top'][1] is not plan
+
+    # the cache keeps the most recently used entries
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache['a'] == 1
+    assert cache['c'] == 3
+    assert len(cache) == 2
+
+
+def test_expansion_cache(engine, tsh):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'exp-base', 'Babar')
+    tsh.register_formula(engine, 'exp-1', '(+ 1 (series "exp-base"))')
+    tsh.register_formula(engine, 'exp-2', '(* 2 (series "exp-1"))')
+    tsh.register_formula(engine, 'exp-3', '(+ 3 (series "exp-2"))')
+    tsh.register_formula(engine, 'exp-4', '(series "exp-3")')
+
+    assert tsh.expanded_formula(engine, 'exp-4') == (
+        '(let revision_date nil from_value_date nil to_value_date nil '
+        '(+ 3 (* 2 (+ 1 (series "exp-base")))))'
+    )
+    ch, tree = tsh.expansions[('exp-3', True)]
+    assert ch == tsh.content_hash(engine, 'exp-3')
+    # the cached trees are not shared
+    assert tsh.expanded_tree(engine, 'exp-3') == tree
+    assert tsh.expanded_tree(engine, 'exp-3') is not tree
+
+    # a change at the bottom of the stack invalidates the dependents
+    tsh.register_formula(engine, 'exp-1', '(+ 10 (series "exp-base"))')
+    assert ('exp-2', True) not in tsh.expansions
+    assert ('exp-3', True) not in tsh.expansions
+    for name in ('exp-2', 'exp-3', 'exp-4'):
+        assert tsh.content_hash(engine, name) == tsh.live_content_hash(
+            engine, name
+        )
+
+    assert_df("""
+2022-01-01 00:00:00+00:00    25.0
+2022-01-02 00:00:00+00:00    27.0
+2022-01-03 00:00:00+00:00    29.0
+""", tsh.get(engine, 'exp-4'))
+
+    tsh.delete(engine, 'exp-4')
+    assert ('exp-4', True) not in tsh.expansions
+    tsh.rename(engine, 'exp-2', 'exp-2-renamed')
+    assert ('exp-2', True) not in tsh.expansions
+    assert tsh.expanded_formula(engine, 'exp-3') == (
+        '(let revision_date nil from_value_date nil to_value_date nil '
+        '(+ 3 (* 2 (+ 10 (series "exp-base")))))'
+    )
+
+
+def test_registry_cache(engine, tsh):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'regcache-base', 'Babar')
+
+    with engine.begin() as cn:
+        assert not tsh.exists(cn, 'regcache-formula')
+        tsh.register_formula(
+            cn, 'regcache-formula', '(series "regcache-base")'
+        )
+        assert tsh.exists(cn, 'regcache-formula')
+        assert tsh.type(cn, 'regcache-formula') == 'formula'
+        assert tsh.type(cn, 'regcache-base') == 'primary'
+
+        # served from the cache of the api calls
+        cache = cn.cache['internal_metadata']
+        assert cache[(tsh.namespace, 'regcache-base')]['tzaware']
+        meta = tsh.internal_metadata(cn, 'regcache-base')
+        meta['tzaware'] = False
+        assert tsh.internal_metadata(cn, 'regcache-base')['tzaware']
+
+        tsh.rename(cn, 'regcache-formula', 'regcache-renamed')
+        assert not tsh.exists(cn, 'regcache-formula')
+        assert tsh.formula(cn, 'regcache-renamed') == '(series "regcache-base")'
+
+        tsh.delete(cn, 'regcache-renamed')
+        assert not tsh.exists(cn, 'regcache-renamed')
+
+        ts = pd.Series(
+            [1, 2, 3],
+            index=pd.date_range(dt(2022, 1, 1), periods=3, freq='D')
+        )
+        assert tsh.internal_metadata(cn, 'regcache-new') is None
+        tsh.update(cn, ts, 'regcache-new', 'Babar')
+        assert not tsh.internal_metadata(cn, 'regcache-new')['tzaware']
+
+        # the patch store shares the connection
+        assert tsh.patch.internal_metadata(cn, 'regcache-new') is None
+        assert tsh.exists(cn, 'regcache-new')
+
+    # outside of the api calls, straight to the database
+    with engine.begin() as cn:
+        assert tsh.exists(cn, 'regcache-new')
+        assert not hasattr(cn, 'cache')
+
+    tsh.delete(engine, 'regcache-new')
+
+
+def test_get_many(engine, tsh):
+    for idate in range(3):
+        ts = pd.Series(
+            range(600),
+            index=pd.date_range(
+                utcdt(2022, 1, 1), periods=600, freq='H'
+            )
+        ) + idate
+        tsh.update(
+            engine, ts, 'bulk-aware', 'Babar',
+            insertion_date=utcdt(2023, 1, idate + 1)
+        )
+    ts = pd.Series(
+        ['a', 'b', 'c'],
+        index=pd.date_range(dt(2022, 1, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'bulk-naive-str', 'Babar')
+    tsh.register_formula(engine, 'bulk-formula', '(series "bulk-aware")')
+
+    queries = [
+        ('bulk-aware', None, None, None),
+        ('bulk-aware', utcdt(2023, 1, 2), utcdt(2022, 1, 10), None),
+        ('bulk-aware', utcdt(2022, 1, 1), None, None),
+        ('bulk-aware', None, dt(2022, 1, 3), dt(2022, 1, 5)),
+        ('bulk-naive-str', None, utcdt(2022, 1, 2), None),
+        ('bulk-formula', None, None, None),
+        ('bulk-nope', None, None, None)
+    ]
+    bulk = tsh.get_many(engine, queries)
+    assert set(bulk) == set(queries[:5])
+    for (name, revdate, fromdate, todate), ts in bulk.items():
+        expected = tsh.get(
+            engine, name,
+            revision_date=revdate,
+            from_value_date=fromdate,
+            to_value_date=todate
+        )
+        assert ts.equals(expected)
+        assert ts.name == name
+    assert len(bulk[queries[2]]) == 0
+
+    # the interpreter prefetches for the `series` operator
+    i = Interpreter(engine, tsh, {})
+    i.prefetch(queries)
+    assert len(i.leaves) == 5
+    assert i.leaves.pop(queries[0]).equals(
+        tsh.get(engine, 'bulk-aware')
+    )
+
+
 def test_base_api(engine, tsh):
     tsh.register_formula(engine, 'test_plus_two', '(+ 2 (series "test"))', False)
     tsh.register_formula(engine, 'test_three_plus', '(+ 3 (series "test"))', False)
@@ -696,6 +1378,94 @@ insertion_date             value_date
 """, h)
 
 
+def test_history_interpreter_fork(engine, tsh):
+    for day in (1, 2, 3):
+        ts = pd.Series(
+            [day] * 3,
+            index=pd.date_range(dt(2018, 1, 1), periods=3, freq='D')
+        )
+        tsh.update(engine, ts, 'fork-base', 'Babar',
+                   insertion_date=utcdt(2019, 1, day))
+    tsh.register_formula(engine, 'fork-formula', '(+ 1 (series "fork-base"))')
+
+    hi = HistoryInterpreter(
+        'fork-formula', engine, tsh, {},
+        histories={'fork-base': tsh.history(engine, 'fork-base')}
+    )
+    fork = hi.fork()
+    assert fork.histories is hi.histories
+    assert fork.getargs is not hi.getargs
+    assert fork.env['series'].args == (fork,)
+    assert hi.env['series'].args == (hi,)
+
+    plan = compile_plan(
+        tsh._expanded_formula(engine, '(+ 1 (series "fork-base"))', qargs={})
+    )
+    idates = [utcdt(2019, 1, 3), utcdt(2019, 1, 1), utcdt(2019, 1, 2)]
+    hist = hi.evaluate_many(plan, idates, 'fork-formula')
+    assert list(hist) == idates
+    assert [ts.iloc[0] for ts in hist.values()] == [4, 2, 3]
+    assert all(ts.name == 'fork-formula' for ts in hist.values())
+
+
+def test_history_incremental(engine, tsh):
+    base = pd.Series(
+        np.arange(20, dtype='float64'),
+        index=pd.date_range(utcdt(2020, 1, 1), periods=20, freq='D')
+    )
+    tsh.update(engine, base, 'incr-a', 'Babar',
+               insertion_date=utcdt(2021, 1, 1))
+    tsh.update(engine, base * 2, 'incr-b', 'Babar',
+               insertion_date=utcdt(2021, 1, 1))
+    tsh.update(engine, base[5:10] * 3, 'incr-c', 'Babar',
+               insertion_date=utcdt(2021, 1, 1))
+
+    # point changes, appends and erasures
+    tsh.update(engine, base[3:5] + 100, 'incr-a', 'Babar',
+               insertion_date=utcdt(2021, 1, 2))
+    tsh.update(engine, pd.Series(
+        [np.nan, 42.],
+        index=pd.date_range(utcdt(2020, 1, 8), periods=2, freq='D')
+    ), 'incr-b', 'Babar', insertion_date=utcdt(2021, 1, 3))
+    tsh.update(engine, pd.Series(
+        [7., 8.],
+        index=pd.date_range(utcdt(2020, 1, 21), periods=2, freq='D')
+    ), 'incr-c', 'Babar', insertion_date=utcdt(2021, 1, 4))
+    tsh.update(engine, base[15:18] - 1, 'incr-b', 'Babar',
+               insertion_date=utcdt(2021, 1, 5))
+
+    tsh.register_formula(
+        engine,
+        'incr-formula',
+        '(priority '
+        '  (series "incr-c")'
+        '  (+ 1 (* 2 (add (series "incr-a") (series "incr-b" #:fill 0)))))'
+    )
+    plan = compile_plan(
+        tsh._expanded_formula(
+            engine, tsh.formula(engine, 'incr-formula'), qargs={}
+        )
+    )
+    assert tsh._incremental_history(plan)
+
+    hist = tsh.history(engine, 'incr-formula')
+    assert len(hist) == 5
+    for idate, ts in hist.items():
+        assert ts.equals(
+            tsh.get(engine, 'incr-formula', revision_date=idate)
+        )
+        assert ts.name == 'incr-formula'
+
+    for formula in (
+            '(add (series "incr-a") (series "incr-b" #:fill "ffill"))',
+            '(resample (series "incr-a") "D")'
+    ):
+        plan = compile_plan(
+            tsh._expanded_formula(engine, formula, qargs={})
+        )
+        assert not tsh._incremental_history(plan)
+
+
 def test_history_bounds(engine, tsh):
     # two series, one with a gap
 
@@ -856,6 +1626,50 @@ def test_staircase(engine, tsh):
     FUNCS.pop('identity')
 
 
+def test_staircase_pointwise(engine, tsh):
+    for day in (1, 2, 3, 4, 5):
+        idate = utcdt(2018, 1, day)
+        for name, coef in (('a', 1), ('b', 3)):
+            ts = pd.Series(
+                [coef * day / 2.] * 5,
+                index=pd.date_range(dt(2018, 1, day), periods=5, freq='D')
+            )
+            tsh.update(engine, ts, 'spw-' + name, 'Babar',
+                       insertion_date=idate)
+
+    tsh.register_formula(
+        engine,
+        'spw-formula',
+        '(div (mul (series "spw-a") (+ 1 (series "spw-b"))) '
+        '     (clip (series "spw-b") #:min 2))'
+    )
+    assert interpreter.has_compatible_operators(
+        engine, tsh,
+        lisp.parse('(add (series "spw-formula") (series "spw-a"))'),
+        tsh.fast_staircase_operators | POINTWISE
+    )
+    # nested non pointwise operators are spotted
+    assert not interpreter.has_compatible_operators(
+        engine, tsh,
+        lisp.parse('(add (mul (resample (series "spw-a") "D")))'),
+        tsh.fast_staircase_operators | POINTWISE
+    )
+
+    delta = pd.Timedelta(hours=12)
+    fast = tsh.staircase(engine, 'spw-formula', delta=delta)
+    slow = super(type(tsh), tsh).staircase(engine, 'spw-formula', delta=delta)
+    assert_df("""
+2018-01-03    1.333333
+2018-01-04    1.833333
+2018-01-05    2.333333
+2018-01-06    2.833333
+2018-01-07    2.833333
+2018-01-08    2.833333
+2018-01-09    2.833333
+""", fast)
+    assert fast.equals(slow)
+
+
 def test_new_func(engine, tsh):
 
     @func('identity')
@@ -3298,3 +4112,323 @@ def test_bound_formula_group_crash(engine, tsh):
 
     # we do not go into a recursion error any longer
     tsh.group_get(engine, 'crash-group')
+
+
+def test_bound_formula_broadcast(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3, 4],
+        index=pd.date_range(utcdt(2023, 1, 1), periods=4, freq='D')
+    )
+    for name in ('bcast-a', 'bcast-b', 'bcast-c'):
+        tsh.update(engine, ts, name, 'test')
+
+    tsh.group_replace(
+        engine,
+        gengroup(
+            n_scenarios=3,
+            from_date=utcdt(2023, 1, 1),
+            length=4,
+            freq='D',
+            seed=1
+        ),
+        'bcast-temp',
+        'test'
+    )
+    tsh.group_replace(
+        engine,
+        gengroup(
+            n_scenarios=2,
+            from_date=utcdt(2023, 1, 2),
+            length=2,
+            freq='D',
+            seed=10
+        ) * 1.5,
+        'bcast-wind',
+        'test'
+    )
+
+    tsh.register_formula(
+        engine,
+        'bcast-formula',
+        '(add (* 2 (series "bcast-a")) '
+        '     (series "bcast-b" #:fill 0) '
+        '     (div (series "bcast-c") '
+        '          (slice (series "bcast-a") #:fromdate (date "2023-1-2"))))'
+    )
+
+    binding = pd.DataFrame(
+        [
+            ['bcast-a', 'bcast-temp', 'temp'],
+            ['bcast-b', 'bcast-wind', 'wind'],
+        ],
+        columns=('series', 'group', 'family')
+    )
+    tsh.register_formula_bindings(
+        engine,
+        'bcast-group',
+        'bcast-formula',
+        binding
+    )
+
+    df = tsh.group_get(engine, 'bcast-group')
+    assert_df("""
+                            0.0   0.1        1.0        1.1        2.0        2.1
+2023-01-02 00:00:00+00:00  20.0  21.5  21.666667  23.166667  23.500000  25.000000
+2023-01-03 00:00:00+00:00  23.5  25.0  25.250000  26.750000  27.100000  28.600000
+2023-01-04 00:00:00+00:00   9.0   9.0  10.800000  10.800000  12.666667  12.666667
+""", df)
+
+    # per combination evaluation yields the same
+    monkeypatch.setattr(interpreter, 'BROADCAST', {})
+    assert tsh.group_get(engine, 'bcast-group').equals(df)
+
+
+def test_group_members(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        [1, 2, 3],
+        index=pd.date_range(utcdt(2023, 2, 1), periods=3, freq='D')
+    )
+    tsh.update(engine, ts, 'members-a', 'test')
+    tsh.update(engine, ts, 'members-b', 'test')
+    for idx in range(2):
+        tsh.group_replace(
+            engine,
+            gengroup(
+                n_scenarios=4,
+                from_date=utcdt(2023, 2, 1),
+                length=3,
+                freq='D',
+                seed=idx
+            ) * (idx + 1),
+            'members-group',
+            'test',
+            insertion_date=utcdt(2023, 2, 1 + idx)
+        )
+    tsh.group_replace(
+        engine,
+        gengroup(
+            n_scenarios=3,
+            from_date=utcdt(2023, 2, 1),
+            length=3,
+            freq='D',
+            seed=10
+        ),
+        'members-other',
+        'test',
+        insertion_date=utcdt(2023, 2, 1)
+    )
+
+    fetched = []
+    get = tsh.tsh_group.get
+    def spyget(cn, name, **kw):
+        fetched.append(name)
+        return get(cn, name, **kw)
+    monkeypatch.setattr(tsh.tsh_group, 'get', spyget)
+
+    # primary
+    full = tsh.group_get(engine, 'members-group')
+    assert len(fetched) == 4
+    fetched.clear()
+    df = tsh.group_get(engine, 'members-group', members=['3', '1'])
+    assert len(fetched) == 2
+    assert df.equals(full[['1', '3']])
+
+    # formula
+    tsh.register_group_formula(
+        engine,
+        'members-formula',
+        '(group-add (group "members-group") (series "members-a"))'
+    )
+    full = tsh.group_get(engine, 'members-formula')
+    fetched.clear()
+    df = tsh.group_get(engine, 'members-formula', members=['2'])
+    # the formula groups are computed as a whole
+    assert len(fetched) == 4
+    assert df.equals(full[['2']])
+
+    # bound
+    tsh.register_formula(
+        engine,
+        'members-bound-formula',
+        '(add (series "members-a") (series "members-b"))'
+    )
+    binding = pd.DataFrame(
+        [
+            ['members-a', 'members-group', 'one'],
+            ['members-b', 'members-other', 'two'],
+        ],
+        columns=('series', 'group', 'family')
+    )
+    tsh.register_formula_bindings(
+        engine,
+        'members-bound',
+        'members-bound-formula',
+        binding
+    )
+    full = tsh.group_get(engine, 'members-bound')
+    assert full.shape == (3, 12)
+    fetched.clear()
+    df = tsh.group_get(engine, 'members-bound', members=['0.2', '3.2'])
+    # and so are the bound groups
+    assert len(fetched) == 7
+    assert_df("""
+                            0.2   3.2
+2023-02-01 00:00:00+00:00  14.0  20.0
+2023-02-02 00:00:00+00:00  17.0  23.0
+2023-02-03 00:00:00+00:00  20.0  26.0
+""", df)
+    assert df.equals(full[['0.2', '3.2']])
+
+    hist = tsh.group_history(engine, 'members-bound', members=['1.0'])
+    assert list(hist) == [
+        pd.Timestamp('2023-02-01 00:00:00+0000', tz='UTC'),
+        pd.Timestamp('2023-02-02 00:00:00+0000', tz='UTC')
+    ]
+    for idate, df in hist.items():
+        assert df.equals(
+            tsh.group_get(
+                engine, 'members-bound', revision_date=idate
+            )[['1.0']]
+        )
+
+    # sparse members: the values of a member of the formula and bound
+    # groups depend on the others
+    index = pd.date_range(utcdt(2021, 1, 1), periods=6, freq='D')
+    tsh.update(engine, pd.Series(1., index=index), 'members-sparse-a', 'test')
+    tsh.update(engine, pd.Series(2., index=index), 'members-sparse-b', 'test')
+    for idx in range(2):
+        tsh.group_replace(
+            engine,
+            pd.DataFrame(
+                {
+                    's0': [1., 2., 3., np.nan, np.nan, np.nan],
+                    's1': [4., np.nan, 5., 6., 7. + idx, np.nan],
+                },
+                index=index
+            ),
+            'members-sparse-ga',
+            'test',
+            insertion_date=utcdt(2021, 2, 1 + idx)
+        )
+    tsh.group_replace(
+        engine,
+        pd.DataFrame(
+            {
+                's0': [np.nan, 8., np.nan, 9., np.nan, 10.],
+                's1': [np.nan, np.nan, np.nan, np.nan, 11., 12.],
+            },
+            index=index
+        ),
+        'members-sparse-gb',
+        'test',
+        insertion_date=utcdt(2021, 2, 1)
+    )
+    tsh.register_formula(
+        engine,
+        'members-sparse-formula',
+        '(priority (series "members-sparse-a") (series "members-sparse-b"))'
+    )
+    tsh.register_formula_bindings(
+        engine,
+        'members-sparse-bound',
+        'members-sparse-formula',
+        pd.DataFrame(
+            [
+                ['members-sparse-a', 'members-sparse-ga', 'one'],
+                ['members-sparse-b', 'members-sparse-gb', 'two'],
+            ],
+            columns=('series', 'group', 'family')
+        )
+    )
+    tsh.register_group_formula(
+        engine,
+        'members-sparse-add',
+        '(group-add (group "members-sparse-ga") (group "members-sparse-gb"))'
+    )
+    for name in (
+            'members-sparse-ga',
+            'members-sparse-bound',
+            'members-sparse-add'
+    ):
+        full = tsh.group_get(engine, name)
+        hist = tsh.group_history(engine, name)
+        for members in [[col] for col in full.columns] + [full.columns[:2]]:
+            members = list(members)
+            df = tsh.group_get(engine, name, members=members)
+            assert df.dropna(how='all').equals(
+                full[members].dropna(how='all')
+            ), (name, members)
+            mhist = tsh.group_history(engine, name, members=members)
+            assert list(mhist) == list(hist)
+            for idate, df in mhist.items():
+                assert df.dropna(how='all').equals(
+                    hist[idate][members].dropna(how='all')
+                ), (name, members, idate)
+
+
+def test_group_bound_history_engine(engine, tsh, monkeypatch):
+    for idx in range(4):
+        idate = utcdt(2023, 3, idx + 1)
+        ts = pd.Series(
+            [idx] * 5,
+            index=pd.date_range(utcdt(2023, 3, 1), periods=5, freq='D')
+        )
+        tsh.update(engine, ts, 'hengine-a', 'test', insertion_date=idate)
+        tsh.update(engine, ts * 2, 'hengine-b', 'test', insertion_date=idate)
+        tsh.group_replace(
+            engine,
+            gengroup(3, from_date=utcdt(2023, 3, 1), length=5, freq='D', seed=idx),
+            'hengine-group',
+            'test',
+            insertion_date=idate + timedelta(hours=1)
+        )
+
+    tsh.register_formula(
+        engine,
+        'hengine-formula',
+        '(add (series "hengine-a") (* 2 (series "hengine-b")))'
+    )
+    tsh.register_formula_bindings(
+        engine,
+        'hengine-bound',
+        'hengine-formula',
+        pd.DataFrame(
+            [['hengine-a', 'hengine-group', 'ens']],
+            columns=('series', 'group', 'family')
+        )
+    )
+
+    histories = []
+    history = tsh.tsh_group.history
+    def spyhistory(cn, name, **kw):
+        histories.append(name)
+        return history(cn, name, **kw)
+    monkeypatch.setattr(tsh.tsh_group, 'history', spyhistory)
+
+    bounds = {
+        'from_value_date': utcdt(2023, 3, 2),
+        'to_value_date': utcdt(2023, 3, 4)
+    }
+    hist = tsh.group_history(engine, 'hengine-bound', **bounds)
+    # one read per member
+    assert len(histories) == 3
+    assert len(hist) == 4
+    for idate, df in hist.items():
+        assert df.equals(
+            tsh.group_get(
+                engine, 'hengine-bound', revision_date=idate, **bounds
+            )
+        )
+
+    assert_df("""
+                              0     1     2
+2023-03-02 00:00:00+00:00  16.0  17.0  18.0
+2023-03-03 00:00:00+00:00  17.0  18.0  19.0
+2023-03-04 00:00:00+00:00  18.0  19.0  20.0
+""", hist[utcdt(2023, 3, 4, 1)])
+
+    histories.clear()
+    hist = tsh.group_history(engine, 'hengine-bound', members=['2'], **bounds)
+    # the bound groups are computed as a whole
+    assert len(histories) == 3
+    assert all(df.columns.to_list() == ['2'] for df in hist.values())
@@ -8,6 +8,7 @@ import pandas as pd
 from psyl import lisp
 from dateutil.relativedelta import relativedelta
 
+from tshistory.util import patchmany
 from tshistory.testutil import (
     assert_df,
     assert_hist,
@@ -19,6 +20,8 @@ from tshistory_formula.registry import (
     metadata
 )
 from tshistory_formula.interpreter import Interpreter
+from tshistory_formula.evaluator import compile_plan
+from tshistory_formula import funcs
 from tshistory_formula.funcs import compute_bounds
 
 
@@ -424,6 +427,40 @@ def test_add(engine, tsh):
 """, ts)
 
 
+def test_align_kernel():
+    def series(values, start, fill=None, limit=None):
+        ts = pd.Series(
+            values,
+            dtype='float64' if not len(values) else None,
+            index=pd.date_range(utcdt(2020, 1, start), periods=len(values), freq='D')
+        )
+        ts.options = {'fill': fill, 'limit': limit}
+        return ts
+
+    for options in (
+            (None, None, None),
+            ('ffill', None, 0),
+            ('ffill', 1, 'bfill'),
+            ('bfill,ffill', 2, 'ffill'),
+            (42, 1, None),
+    ):
+        fill, limit, fill2 = options
+        serieslist = [
+            series([1., np.nan, 3.], 1, fill, limit),
+            series([1., 2.], 6, fill2),
+            series([1, 2, 3, 4, 5, 6, 7, 8], 1),
+        ]
+        index, arrays = funcs._align(serieslist)
+        df = funcs._group_series(*serieslist)
+        assert index.equals(df.index)
+        for values, col in zip(arrays, df.columns):
+            assert np.array_equal(values, df[col].values, equal_nan=True)
+
+    # unfilled empty series
+    assert funcs._align([series([], 1), series([1.], 1)]) is None
+    assert funcs.series_add(series([], 1), series([1.], 1)).empty
+
+
 def test_serieslist(engine, tsh):
     a = pd.Series(
         [1, 2, 3],
@@ -697,6 +734,45 @@ def test_filter_vs_tzaware(engine, tsh):
     )
 
 
+def test_streamed_reductions(engine, tsh):
+    for idx, name in enumerate(('stream.a', 'stream.b', 'stream.c')):
+        ts = pd.Series(
+            [1. + idx, 2., 4. * idx, 3., -1.],
+            index=pd.date_range(dt(2023, 1, 1 + idx), periods=5, freq='D')
+        )
+        if idx == 1:
+            ts = ts.drop(ts.index[2])
+        tsh.update(engine, ts, name, 'Babar')
+
+    for op, kw in (
+            ('add', ''),
+            ('row-min', ''),
+            ('row-max', ' #:skipna #f'),
+            ('row-mean', ''),
+            ('row-mean', ' #:skipna #f'),
+            ('std', ''),
+            ('std', ' #:skipna #f')):
+        streamed = f'({op} (findseries (by.name "stream.")){kw})'
+        plan = compile_plan(lisp.parse(streamed))
+        assert plan.nodes[-1].opnames() == ('findseries', op)
+
+        tsh.register_formula(engine, 'reduce.streamed', streamed)
+        tsh.register_formula(
+            engine,
+            'reduce.unstreamed',
+            f'({op} (series "stream.a") (series "stream.b") '
+            f'(series "stream.c"){kw})'
+        )
+        expected = tsh.get(engine, 'reduce.unstreamed')
+        assert len(expected)
+        ts = tsh.get(engine, 'reduce.streamed')
+        assert ts.index.equals(expected.index)
+        assert np.allclose(ts.values, expected.values)
+
+    ts = tsh.get(engine, 'reduce.streamed', from_value_date=dt(2023, 1, 5))
+    assert len(ts) == 1
+
+
 def test_scalar_div(engine, tsh):
     a = pd.Series(
         [1, 2, 3],
@@ -795,6 +871,29 @@ insertion_date             value_date
 """, h)
 
 
+def test_priority_kernel():
+    layers = [
+        pd.Series(
+            [float(idx)] * 3,
+            index=pd.date_range(utcdt(2020, 1, 1 + idx), periods=3, freq='D')
+        )
+        for idx in range(6)
+    ]
+    layers.insert(2, pd.Series(dtype='float64'))
+    ts = funcs.series_priority(*layers)
+    assert ts.equals(patchmany(list(reversed(layers))))
+    assert_df("""
+2020-01-01 00:00:00+00:00    0.0
+2020-01-02 00:00:00+00:00    0.0
+2020-01-03 00:00:00+00:00    0.0
+2020-01-04 00:00:00+00:00    1.0
+2020-01-05 00:00:00+00:00    2.0
+2020-01-06 00:00:00+00:00    3.0
+2020-01-07 00:00:00+00:00    4.0
+2020-01-08 00:00:00+00:00    5.0
+""", ts)
+
+
 def test_priority2(engine, tsh):
     tsh.register_formula(
         engine,
@@ -2170,6 +2269,157 @@ def test_rolling(engine, tsh):
 """, s1)
 
 
+def test_rolling_lookback(engine, tsh, monkeypatch):
+    series = pd.Series(
+        np.arange(400, dtype='float64'),
+        index=pd.date_range(utcdt(2020, 1, 1), periods=400, freq='D')
+    )
+    tsh.update(
+        engine,
+        series,
+        'rolling-lookback',
+        'Babar'
+    )
+
+    reads = []
+    get = Interpreter.get
+    def spy(self, name, getargs):
+        reads.append(getargs['from_value_date'])
+        return get(self, name, getargs)
+    monkeypatch.setattr(Interpreter, 'get', spy)
+
+    for formula in (
+            '(rolling (series "rolling-lookback") 3)',
+            '(rolling (rolling (series "rolling-lookback") 3) 2)',
+            '(rolling (time-shifted (series "rolling-lookback") #:days 1) 3)',
+            '(cumsum (series "rolling-lookback"))',
+            '(+ 1 (cumsum (rolling (series "rolling-lookback") 3)))',
+    ):
+        tsh.register_formula(
+            engine,
+            'test-rolling-lookback',
+            formula
+        )
+        full = tsh.get(engine, 'test-rolling-lookback')
+        part = tsh.get(
+            engine,
+            'test-rolling-lookback',
+            from_value_date=utcdt(2020, 11, 1),
+            to_value_date=utcdt(2020, 11, 10)
+        )
+        assert part.index[0] == utcdt(2020, 11, 1)
+        assert part.equals(
+            full.loc[utcdt(2020, 11, 1): utcdt(2020, 11, 10)]
+        )
+
+    reads.clear()
+    tsh.register_formula(
+        engine,
+        'test-rolling-lookback',
+        '(rolling (series "rolling-lookback") 30)'
+    )
+    ts = tsh.get(
+        engine,
+        'test-rolling-lookback',
+        from_value_date=utcdt(2020, 11, 1)
+    )
+    assert ts.index[0] == utcdt(2020, 11, 1)
+    # the series is read once, from 29 points before
+    assert reads == [utcdt(2020, 10, 3)]
+
+    # over the snapshot chunks (of 250 points)
+    stamp = series.index[251]
+    assert tsh.lookback_stamp(
+        engine, 'rolling-lookback', stamp, 5
+    ) == series.index[246]
+    assert tsh.lookback_stamp(engine, 'rolling-lookback', stamp, 251) == (
+        series.index[0]
+    )
+    assert tsh.lookback_stamp(engine, 'rolling-lookback', stamp, 252) is None
+    assert tsh.lookback_stamp(
+        engine, 'rolling-lookback', stamp, 5,
+        revision_date=utcdt(2000, 1, 1)
+    ) is None
+    assert tsh.lookback_stamp(engine, 'test-rolling-lookback', stamp, 5) is None
+
+    # the points of a resampled series are not those of its input:
+    # the input is read from the start
+    hourly = pd.Series(
+        np.arange(24 * 20, dtype='float64'),
+        index=pd.date_range(utcdt(2022, 1, 1), periods=24 * 20, freq='H')
+    )
+    tsh.update(engine, hourly, 'rolling-lookback-hourly', 'Babar')
+    tsh.register_formula(
+        engine,
+        'test-rolling-lookback',
+        '(rolling (resample (series "rolling-lookback-hourly") "D") 3)'
+    )
+    full = tsh.get(engine, 'test-rolling-lookback')
+    reads.clear()
+    part = tsh.get(
+        engine,
+        'test-rolling-lookback',
+        from_value_date=utcdt(2022, 1, 10)
+    )
+    assert reads == [None]
+    assert part.index[0] == utcdt(2022, 1, 10)
+    assert part.equals(full.loc[utcdt(2022, 1, 10):])
+
+    # the history reads the revisions before from_value_date
+    # likewise
+    for idx, idate in enumerate((utcdt(2021, 2, 1), utcdt(2021, 2, 2))):
+        tsh.update(
+            engine,
+            pd.Series(
+                np.arange(10, dtype='float64') * (idx + 1),
+                index=pd.date_range(
+                    utcdt(2021, 1, 1 + 2 * idx), periods=10, freq='D'
+                )
+            ),
+            'rolling-lookback-hist',
+            'Babar',
+            insertion_date=idate
+        )
+    for formula in (
+            '(rolling (series "rolling-lookback-hist") 3)',
+            '(cumsum (series "rolling-lookback-hist"))',
+            '(add (series "rolling-lookback-hist") '
+            '     (rolling (series "rolling-lookback-hist") 3))',
+            '(+ 1 (cumsum (rolling (series "rolling-lookback-hist") 3)))',
+    ):
+        tsh.register_formula(
+            engine,
+            'test-rolling-lookback',
+            formula
+        )
+        for fromidate in (None, utcdt(2021, 2, 2)):
+            hist = tsh.history(
+                engine,
+                'test-rolling-lookback',
+                from_insertion_date=fromidate,
+                from_value_date=utcdt(2021, 1, 6)
+            )
+            assert len(hist) == (2 if fromidate is None else 1)
+            for idate, ts in hist.items():
+                assert ts.equals(
+                    tsh.get(
+                        engine,
+                        'test-rolling-lookback',
+                        revision_date=idate,
+                        from_value_date=utcdt(2021, 1, 6)
+                    )
+                ), (formula, idate)
+
+    # not an operator
+    with pytest.raises(ValueError):
+        tsh.register_formula(
+            engine,
+            'test-lookback-stamp',
+            '(series "rolling-lookback" #:fill '
+            '(lookback-stamp (date "2020-1-1") 3 "rolling-lookback"))'
+        )
+
+
 def test_na_behaviour(engine, tsh):
     series = pd.Series(
         [1, 2, np.nan],
@@ -2458,6 +2708,73 @@ def test_constant_today_timetravel(engine, tsh):
 """, ts)
 
 
+def test_constant_lazy(engine, tsh):
+    base = pd.Series(
+        np.arange(72.),
+        index=pd.date_range(utcdt(2020, 1, 1), periods=72, freq='H')
+    )
+    tsh.update(engine, base, 'lazy-base', 'Babar')
+
+    text = (
+        '(add (series "lazy-base") '
+        '     (constant 1. (date "1900-1-1") (date "2039-12-31") "D" '
+        '               (date "2019-1-1")))'
+    )
+    plan = compile_plan(lisp.parse(text))
+    assert [node.lazy for node in plan.nodes] == [
+        False, False, False, False, True, False
+    ]
+
+    tsh.register_formula(engine, 'lazy-add', text)
+    ts = tsh.get(engine, 'lazy-add')
+    assert_df("""
+2020-01-01 00:00:00+00:00     1.0
+2020-01-02 00:00:00+00:00    25.0
+2020-01-03 00:00:00+00:00    49.0
+""", ts)
+
+    ts = tsh.get(
+        engine, 'lazy-add',
+        from_value_date=utcdt(2020, 1, 1, 1),
+        to_value_date=utcdt(2020, 1, 2)
+    )
+    assert_df("""
+2020-01-02 00:00:00+00:00    25.0
+""", ts)
+
+    ts = tsh.get(engine, 'lazy-add', revision_date=utcdt(2018, 1, 1))
+    assert len(ts) == 0
+
+    # the filled series: the whole constant range counts
+    tsh.register_formula(
+        engine,
+        'lazy-mul-filled',
+        '(mul (series "lazy-base" #:fill 1) '
+        '     (constant 2. (date "2020-1-2") (date "2020-1-5") "D" '
+        '               (date "2019-1-1")))'
+    )
+    ts = tsh.get(engine, 'lazy-mul-filled')
+    assert_df("""
+2020-01-02 00:00:00+00:00    48.0
+2020-01-03 00:00:00+00:00    96.0
+2020-01-04 00:00:00+00:00     2.0
+2020-01-05 00:00:00+00:00     2.0
+""", ts)
+
+    # off the grid
+    tsh.register_formula(
+        engine,
+        'lazy-off-grid',
+        '(add (series "lazy-base") '
+        '     (constant 1. (date "2020-1-1 00:30") (date "2039-12-31") "H" '
+        '               (date "2019-1-1")))'
+    )
+    assert len(tsh.get(engine, 'lazy-off-grid')) == 0
+
+    hist = tsh.history(engine, 'lazy-add')
+    assert list(hist.values())[-1].equals(tsh.get(engine, 'lazy-add'))
+
+
 def test_trigo(engine, tsh):
     base = pd.Series(
         [-400, -1, 0, 90, 180, 300000],
@@ -3376,6 +3693,178 @@ def test_integration_which_big_gap(engine, tsh):
     assert tsp.equals(tsf)
 
 
+def test_last_point(engine, tsh, monkeypatch):
+    ts = pd.Series(
+        np.arange(600, dtype='float64'),
+        index=pd.date_range(dt(2020, 1, 1), periods=600, freq='D')
+    )
+    tsh.update(
+        engine, ts, 'last-point', 'test',
+        insertion_date=utcdt(2023, 1, 1)
+    )
+    # erase a whole period and override the end
+    ts = pd.Series(
+        [np.nan] * 100 + [-1.] * 10,
+        index=pd.date_range(dt(2020, 6, 1), periods=110, freq='D')
+    )
+    tsh.update(
+        engine, ts, 'last-point', 'test',
+        insertion_date=utcdt(2023, 1, 2)
+    )
+
+    for revision_date in (utcdt(2023, 1, 1), utcdt(2023, 1, 2), None):
+        for stamp in (
+                dt(2019, 1, 1),
+                dt(2020, 1, 1),
+                dt(2020, 6, 1, 12),
+                dt(2020, 9, 9),
+                dt(2021, 12, 30),
+                dt(2030, 1, 1)
+        ):
+            expected = tsh.get(
+                engine, 'last-point',
+                revision_date=revision_date,
+                to_value_date=stamp
+            ).iloc[-1:]
+            point = tsh.last_point(
+                engine, 'last-point', stamp, revision_date=revision_date
+            )
+            assert point.equals(expected)
+
+    revs = tsh.last_points(engine, 'last-point', dt(2020, 9, 8))
+    assert [
+        (idate, ts.to_dict()) for idate, ts in revs
+    ] == [
+        (utcdt(2023, 1, 1), {pd.Timestamp('2020-09-08'): 251.}),
+        (utcdt(2023, 1, 2), {pd.Timestamp('2020-05-31'): 151.})
+    ]
+
+    tsh.register_formula(
+        engine,
+        'last-point-formula',
+        '(series "last-point")'
+    )
+    assert tsh.last_point(
+        engine, 'last-point-formula', dt(2020, 9, 8)
+    ) is None
+    assert tsh.last_point(engine, 'no-such-series', dt(2020, 9, 8)) is None
+
+    # the integration does not probe the stock anymore
+    ts = pd.Series(
+        1.,
+        index=pd.date_range(dt(2021, 8, 1), dt(2022, 1, 1), freq='D')
+    )
+    tsh.update(
+        engine, ts, 'last-point-flow', 'test',
+        insertion_date=utcdt(2022, 12, 31)
+    )
+    tsh.register_formula(
+        engine,
+        'integration-last-point',
+        '(integration "last-point" "last-point-flow")'
+    )
+    reads = []
+    get = Interpreter.get
+    def spy(self, name, getargs):
+        reads.append(name)
+        return get(self, name, getargs)
+    monkeypatch.setattr(Interpreter, 'get', spy)
+
+    ts = tsh.get(
+        engine,
+        'integration-last-point',
+        from_value_date=dt(2021, 12, 30),
+        to_value_date=dt(2022, 1, 10)
+    )
+    assert reads.count('last-point') == 1
+    assert_df("""
+2021-12-30    729.0
+2021-12-31    730.0
+2022-01-01    731.0
+""", ts)
+
+    # and neither does its history
+    calls = []
+    last_points = tsh.last_points
+    def spy(cn, name, stamp, **kw):
+        calls.append(name)
+        return last_points(cn, name, stamp, **kw)
+    monkeypatch.setattr(tsh, 'last_points', spy)
+
+    hist = tsh.history(
+        engine,
+        'integration-last-point',
+        from_value_date=dt(2021, 12, 30),
+        to_value_date=dt(2022, 1, 10)
+    )
+    # the stock revisions count, though their points are before
+    # from_value_date
+    assert list(hist) == [
+        utcdt(2022, 12, 31), utcdt(2023, 1, 1), utcdt(2023, 1, 2)
+    ]
+    assert calls == ['last-point']
+    for idate, ts in hist.items():
+        assert ts.equals(
+            tsh.get(
+                engine,
+                'integration-last-point',
+                revision_date=idate,
+                from_value_date=dt(2021, 12, 30),
+                to_value_date=dt(2022, 1, 10)
+            )
+        )
+
+
+def test_integration_history_window(engine, tsh):
+    tsh.update(
+        engine,
+        pd.Series([100.], index=[dt(2022, 1, 1)]),
+        'window-stock', 'test',
+        insertion_date=utcdt(2022, 2, 1)
+    )
+    tsh.update(
+        engine,
+        pd.Series(
+            5.,
+            index=pd.date_range(dt(2022, 1, 2), dt(2022, 1, 10), freq='D')
+        ),
+        'window-flow', 'test',
+        insertion_date=utcdt(2022, 2, 2)
+    )
+    tsh.update(
+        engine,
+        pd.Series([111.], index=[dt(2022, 1, 3)]),
+        'window-stock', 'test',
+        insertion_date=utcdt(2022, 2, 3)
+    )
+
+    for fill in ('', ' #:fill #t'):
+        tsh.register_formula(
+            engine,
+            'integration-window',
+            f'(integration "window-stock" "window-flow"{fill})'
+        )
+        hist = tsh.history(
+            engine,
+            'integration-window',
+            from_value_date=dt(2022, 1, 5),
+            to_value_date=dt(2022, 1, 8)
+        )
+        assert len(hist) == 3
+        assert hist[utcdt(2022, 2, 2)].iloc[0] == 120.
+        assert hist[utcdt(2022, 2, 3)].iloc[0] == 121.
+        for idate, ts in hist.items():
+            assert ts.equals(
+                tsh.get(
+                    engine,
+                    'integration-window',
+                    revision_date=idate,
+                    from_value_date=dt(2022, 1, 5),
+                    to_value_date=dt(2022, 1, 8)
+                )
+            ), (fill, idate)
+
+
 def test_conditional_operators(engine, tsh):
     # base series
     ts = pd.Series(
@@ -1,31 +1,47 @@
 import inspect
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial
 from concurrent.futures import (
     Future
 )
-from functools import partial
 
 try:
     from functools import cache
 except ImportError:
     # before python 3.9
-    _CACHE = {}
     def cache(func):
+        _cache = {}
         def wrapper(*a, **k):
-            val = _CACHE.get(a)
+            val = _cache.get(a)
             if val:
                 return val
-            _CACHE[a] = val = func(*a, **k)
+            _cache[a] = val = func(*a, **k)
             return val
         return wrapper
 
 
+import pandas as pd
 from psyl.lisp import (
     buildargs,
-    let,
+    Keyword,
+    pairwise,
+    serialize,
+    SPLICE,
     Symbol
 )
 
-from tshistory_formula.helper import ThreadPoolExecutor
+from tshistory_formula.helper import Scheduler
+from tshistory_formula.registry import (
+    FUNCS,
+    KERNELS,
+    LAZY,
+    REDUCERS,
+    STREAMS
+)
 
 
 NONETYPE = type(None)
@@ -43,100 +59,1012 @@ QARGS = {
 }
 
 
-# parallel evaluator
+@cache
+def funcinfo(func):
+    """Compute once the call protocol of an operator: its async key,
+    whether it takes varargs and the names of the query arguments to
+    inject from the lisp environment.
+    """
+    signature = inspect.getfullargspec(func)
+    return (
+        funcid(func),
+        signature.varargs is not None,
+        tuple(
+            QARGS[arg] for arg in signature.args
+            if arg in QARGS
+        )
+    )
+
+
+
+
+# compiled plans
+
+# operand kinds
+CONST, NODE, SYM = range(3)
+
+# a node value not computed yet
+PENDING = object()
+
+
+def _result(val):
+    if isinstance(val, Future):
+        return val.result()
+    return val
+
+
+def _share(val):
+    """Return a copy of a value which has other consumers: the
+    operators are free to mutate their inputs (e.g. `time-shifted`
+    assigns the series index, `options` its options).
+    """
+    val = _result(val)
+    if isinstance(val, list):
+        return [_share(item) for item in val]
+    if isinstance(val, (pd.Series, pd.DataFrame)):
+        copy = val.copy()
+        options = getattr(val, 'options', None)
+        if options is not None:
+            copy.options = options.copy()
+        return copy
+    return val
+
+
+class Node:
+    """A function call of a plan.
+
+    The operands are `(kind, value)` pairs: a constant, the index of
+    another node, or a free symbol to be looked up in the environment
+    at evaluation time (operators and the toplevel query arguments).
+
+    """
+    __slots__ = ('op', 'args', 'kwargs', 'splice', 'scope', 'tree', 'release',
+                 'lazy')
 
-def resolve(atom, env):
-    if isinstance(atom, Symbol):
-        return env.find(atom)
-    assert isinstance(atom, (int, float, str, NONETYPE))
-    return atom
+    def __init__(self, op, args, kwargs, splice, scope, tree):
+        self.op = op
+        self.args = args
+        self.kwargs = kwargs
+        self.splice = splice
+        # the let-bindings visible from this node
+        self.scope = scope
+        # needed by the autotrophic operators in history mode
+        self.tree = tree
+        # the nodes whose value is no longer needed after this one
+        self.release = ()
+        # compute the lazy form of the operator (see defer)
+        self.lazy = False
 
+    def opnames(self):
+        """The names of the operators computed by the node."""
+        kind, op = self.op
+        if kind == SYM:
+            return (op,)
+        if op is fused:
+            return tuple(step[0] for step in self.args[0][1])
+        if op is streamed:
+            return (self.args[3][1], self.args[0][1])
+        return ()
+
+    def operands(self):
+        yield self.op
+        yield from self.args
+        yield from self.kwargs.values()
+        for qarg in QARGS.values():
+            if qarg in self.scope:
+                yield self.scope[qarg]
+
+    def call(self, value, funcids, pool, hist, record=None):
+        proc = value(self.op)
+        if record is not None:
+            start = time.perf_counter()
+        posargs = [
+            _result(value(arg))
+            for arg in self.args
+        ]
+        kwargs = {
+            kw: _result(value(arg))
+            for kw, arg in self.kwargs.items()
+        }
+        if self.splice:
+            posargs, kwargs = buildargs(posargs)
+
+        # open partials to find the true operator on which we can decide
+        # to go async
+        if hasattr(proc, 'func'):
+            func = proc.func
+        else:
+            func = proc
+        funkey, varargs, qargs = funcinfo(func)
+
+        # for autotrophic operators: prepare to pass the tree if present
+        if hist and funkey in funcids:
+            kwargs['__tree__'] = self.tree
+        elif self.lazy and func is FUNCS.get(self.op[1]):
+            # the consumer will materialize the value
+            proc = partial(LAZY[self.op[1]][1], *proc.args)
+
+        if varargs:
+            if len(posargs) == 1 and isinstance(posargs[0], list):
+                posargs = posargs[0]
+
+        # prepare args injection from the lisp environment
+        if qargs:
+            posargs = [
+                value(self.scope.get(qarg) or (SYM, qarg))
+                for qarg in qargs
+            ] + posargs
+
+        if record is not None:
+            # the time spent there is the time waited for the inputs
+            record.wait = time.perf_counter() - start
+            record.rowsin = _rows(posargs) + _rows(list(kwargs.values()))
+            proc = record.wrap(proc)
+
+        # an async function, e.g. series, being I/O oriented
+        # can be deferred to a thread
+        if funkey in funcids and pool:
+            return pool.submit(proc, *posargs, **kwargs)
+
+        return proc(*posargs, **kwargs)
+
+
+class Plan:
+    """A flat, pre-resolved form of an (expanded) formula tree.
+
+    The nodes are stored in evaluation order (arguments first) and
+    refer to each other by index. The let-bindings are resolved at
+    compilation time, hence a plan does not depend on the query
+    arguments (revision/from/to dates), which are provided by the
+    environment at evaluation time.
+
+    """
+    __slots__ = ('nodes', 'root', 'uses')
+
+    def __init__(self, nodes, root, uses):
+        self.nodes = nodes
+        self.root = root
+        # node index -> number of consumers (when more than one)
+        self.uses = uses
+
+    def calls(self, opname, env):
+        """Yield the `(args, kwargs, qargs)` of the calls to the
+        `opname` operator which do not depend on any computation
+        (their operands being constants or environment lookups).
+        """
+        def value(operand):
+            kind, val = operand
+            if kind == SYM:
+                return env.find(val)
+            return val
+
+        for node in self.nodes:
+            if node.op != (SYM, opname) or node.splice:
+                continue
+            if any(kind == NODE for kind, _ in node.operands()):
+                continue
+            yield (
+                [value(arg) for arg in node.args],
+                {kw: value(arg) for kw, arg in node.kwargs.items()},
+                {
+                    qarg: value(node.scope.get(qarg) or (SYM, qarg))
+                    for qarg in QARGS.values()
+                }
+            )
+
+    def evaluate(self, env, funcids=(), pool=None, hist=False):
+        values = [PENDING] * len(self.nodes)
+        uses = dict(self.uses)
+        records = [None] * len(self.nodes)
+        section = _profiled()
+        if section is not None:
+            profile = Profile(self)
+            section.attach(profile)
+            records = profile.records
+
+        def value(operand):
+            kind, val = operand
+            if kind == NODE:
+                if val in uses:
+                    # a common subexpression: all the consumers but
+                    # the last get their own copy
+                    uses[val] -= 1
+                    if uses[val]:
+                        return _share(values[val])
+                return values[val]
+            if kind == SYM:
+                return env.find(val)
+            return val
 
-def _evaluate(tree, env, funcids=(), pool=None, hist=False):
+        def ready(operand):
+            kind, val = operand
+            if kind != NODE:
+                return True
+            val = values[val]
+            if val is PENDING:
+                return False
+            return not isinstance(val, Future) or val.done()
+
+        if pool is not None:
+            # prefetch: issue at once all the calls whose inputs are at
+            # hand, that is the (async) leaves of the whole tree and
+            # the computations their scopes depend upon, rather than
+            # waiting for each branch to complete before starting the
+            # next one
+            for idx, node in enumerate(self.nodes):
+                if all(ready(operand) for operand in node.operands()):
+                    values[idx] = node.call(
+                        value, funcids, pool, hist, records[idx]
+                    )
+
+        # the releases only happen there, when all the consumers
+        # of a value have been computed
+        for idx, node in enumerate(self.nodes):
+            if values[idx] is PENDING:
+                values[idx] = node.call(
+                    value, funcids, pool, hist, records[idx]
+                )
+            for used in node.release:
+                values[used] = None
+
+        return value(self.root)
+
+
+def _key(operand):
+    kind, val = operand
+    if kind == CONST:
+        # do not mix up 1, 1.0 and #t
+        return kind, type(val), val
+    return operand
+
+
+def _compile(tree, scope, nodes, memo):
     if not isinstance(tree, list):
         # we've got an atom
-        # we do this very late rather than upfront
-        # because the interpreter will need the original
-        # symbolic expression to build names
-        return resolve(tree, env)
+        if isinstance(tree, Symbol):
+            return scope.get(tree) or (SYM, tree)
+        assert isinstance(tree, (int, float, str, NONETYPE))
+        return (CONST, tree)
 
     if tree[0] == 'let':
-        newtree, newenv = let(
-            env, tree[1:],
-            partial(_evaluate, funcids=funcids, pool=pool, hist=hist)
+        # the bindings are evaluated in the outer scope
+        newscope = dict(scope)
+        for sym, val in pairwise(tree[1:-1]):
+            newscope[sym] = _compile(val, scope, nodes, memo)
+        return _compile(tree[-1], newscope, nodes, memo)
+
+    op = _compile(tree[0], scope, nodes, memo)
+    splice = any(
+        isinstance(item, Symbol) and item == SPLICE
+        for item in tree[1:]
+    )
+    args = []
+    kwargs = {}
+    if splice:
+        # the arguments shape is only known at evaluation time
+        args = [
+            _compile(item, scope, nodes, memo)
+            for item in tree[1:]
+        ]
+    else:
+        kw = None
+        for item in tree[1:]:
+            if kw is not None:
+                kwargs[kw] = _compile(item, scope, nodes, memo)
+                kw = None
+                continue
+            if isinstance(item, Keyword):
+                kw = item
+                continue
+            args.append(_compile(item, scope, nodes, memo))
+
+    # common subexpressions elimination: the same call with the same
+    # operands under the same query arguments is computed only once
+    key = (
+        _key(op),
+        tuple(_key(arg) for arg in args),
+        tuple((kw, _key(arg)) for kw, arg in kwargs.items()),
+        splice,
+        tuple(scope.get(qarg) for qarg in QARGS.values())
+    )
+    idx = memo.get(key)
+    if idx is None:
+        nodes.append(
+            Node(op, args, kwargs, splice, scope, tree)
         )
-        # the env grows new bindigs
-        # the tree has lost its let-definition
-        return _evaluate(newtree, newenv, funcids, pool, hist)
-
-    # a functional expression
-    # the recursive evaluation will
-    # * dereference the symbols -> functions
-    # * evaluate the sub-expressions -> values
-    exps = [
-        _evaluate(exp, env, funcids, pool, hist)
-        for exp in tree
-    ]
-    # since some calls are evaluated asynchronously (e.g. series) we
-    # need to resolve all the future objects
-    newargs = [
-        arg.result() if isinstance(arg, Future) else arg
-        for arg in exps[1:]
+        idx = memo[key] = len(nodes) - 1
+    return (NODE, idx)
+
+
+# elementwise operators fusion
+
+def fused(steps, series, *procs):
+    """Compute a chain of elementwise operators (see `fuse`) in one
+    pass over the values of a series, using the operators kernels.
+    """
+    if (isinstance(series, pd.Series) and
+        series.dtype.kind in 'iuf' and
+        all(proc is FUNCS.get(step[0]) for step, proc in zip(steps, procs))):
+        values = series.values
+        keep = True
+        for name, args, kwargs in steps:
+            position, stepkeep, kernel = KERNELS[name]
+            args = list(args)
+            args[position] = values
+            values = kernel(*args, **dict(kwargs))
+            if values is NotImplemented:
+                break
+            keep = keep and stepkeep
+        else:
+            res = pd.Series(
+                values,
+                index=series.index,
+                name=series.name if keep else None
+            )
+            res.options = series.options if keep else {}
+            return res
+
+    # the operators one by one
+    val = series
+    for (name, args, kwargs), proc in zip(steps, procs):
+        args = list(args)
+        args[KERNELS[name][0]] = val
+        val = proc(*args, **dict(kwargs))
+    return val
+
+
+def _step(node):
+    """Return the `(name, args, kwargs)` fused step of a node and its
+    series operand, or None when it cannot be fused.
+    """
+    kind, op = node.op
+    if kind != SYM or op not in KERNELS or node.splice:
+        return None
+    position = KERNELS[op][0]
+    if len(node.args) <= position:
+        return None
+    operands = [
+        arg for idx, arg in enumerate(node.args)
+        if idx != position
+    ] + list(node.kwargs.values())
+    if any(kind != CONST for kind, _ in operands):
+        return None
+    args = tuple(
+        None if idx == position else val
+        for idx, (_, val) in enumerate(node.args)
+    )
+    kwargs = tuple(
+        (str(kw), val)
+        for kw, (_, val) in node.kwargs.items()
+    )
+    return (op, args, kwargs), node.args[position]
+
+
+def _uses(nodes):
+    uses = defaultdict(int)
+    for node in nodes:
+        for kind, val in node.operands():
+            if kind == NODE:
+                uses[val] += 1
+    return uses
+
+
+def _prune(nodes, root, dead, alias=None):
+    """Drop the dead nodes and renumber the others (the references to
+    the aliased nodes being redirected to their alias).
+    """
+    if not dead:
+        return nodes, root
+
+    alias = alias or {}
+    renum = {}
+    for idx in range(len(nodes)):
+        if idx not in dead:
+            renum[idx] = len(renum)
+
+    def resolve(operand):
+        while operand[0] == NODE and operand[1] in alias:
+            operand = alias[operand[1]]
+        return operand
+
+    def remap(operand):
+        kind, val = resolve(operand)
+        if kind == NODE:
+            return kind, renum[val]
+        return kind, val
+
+    scopes = {}
+    def rescope(scope):
+        if id(scope) not in scopes:
+            scopes[id(scope)] = {
+                sym: remap(operand)
+                for sym, operand in scope.items()
+                if resolve(operand)[0] != NODE or
+                resolve(operand)[1] not in dead
+            }
+        return scopes[id(scope)]
+
+    newnodes = [
+        Node(
+            remap(node.op),
+            [remap(arg) for arg in node.args],
+            {kw: remap(arg) for kw, arg in node.kwargs.items()},
+            node.splice,
+            rescope(node.scope),
+            node.tree
+        )
+        for idx, node in enumerate(nodes)
+        if idx not in dead
     ]
-    proc = exps[0]
-    posargs, kwargs = buildargs(newargs)
+    return newnodes, remap(root)
 
-    # open partials to find the true operator on which we can decide
-    # to go async
-    if hasattr(proc, 'func'):
-        func = proc.func
-    else:
-        func = proc
 
-    # for autotrophic operators: prepare to pass the tree if present
-    funkey = funcid(func)
-    if hist and funkey in funcids:
-        kwargs['__tree__'] = tree
+# algebraic rewrites
 
-    signature = inspect.getfullargspec(func)
-    if signature.varargs:
-        if len(posargs) == 1 and isinstance(posargs[0], list):
-            posargs = posargs[0]
-    # prepare args injection from the lisp environment
-    posargs = [
-        env.find(QARGS[arg]) for arg in signature.args
-        if arg in QARGS
-    ] + posargs
-
-
-    # an async function, e.g. series, being I/O oriented
-    # can be deferred to a thread
-    if funkey in funcids and pool:
-        return pool.submit(proc, *posargs, **kwargs)
-
-    # at this point, we have a function, and all the arguments
-    # have been evaluated, so we do the final call
-    return proc(*posargs, **kwargs)
-
-
-def pevaluate(tree, env, asyncfuncs=(), concurrency=16, hist=False):
-    if concurrency > 1:
-        with ThreadPoolExecutor(concurrency) as pool:
-            val = _evaluate(
-                tree,
-                env,
-                {funcid(func) for func in asyncfuncs},
-                pool,
-                hist
+def _opname(node):
+    kind, op = node.op
+    if kind != SYM or node.splice:
+        return None
+    return op
+
+
+def _static_options(operand, nodes):
+    """Return the `(fill, limit)` options of a series operand when they
+    can be known before evaluation (or None).
+    """
+    kind, val = operand
+    if kind != NODE:
+        return None
+    node = nodes[val]
+    op = _opname(node)
+    if op in ('series', 'options'):
+        options = []
+        for name in ('fill', 'limit'):
+            kind, val = node.kwargs.get(Keyword(name), (CONST, None))
+            if kind != CONST:
+                return None
+            options.append(val)
+        return tuple(options)
+    if op in ('add', 'mul', 'div'):
+        return None, None
+    if op in ('+', '*') and len(node.args) == 2:
+        return _static_options(node.args[1], nodes)
+    if op in ('/', '**') and len(node.args) == 2:
+        return _static_options(node.args[0], nodes)
+    return None
+
+
+def _exact_factor(num):
+    # multiplying by a power of two is exact
+    return (
+        isinstance(num, (int, float)) and
+        not isinstance(num, bool) and
+        num != 0 and
+        math.isfinite(num) and
+        abs(math.frexp(num)[0]) == .5
+    )
+
+
+def _simplify(node, nodes, uses, root):
+    """Return `(alias, None, None)` when the node can be replaced by one
+    of its operands, `(None, newnode, inneridx)` when it absorbs its
+    inner node, or None.
+    """
+    op = _opname(node)
+    if op is None:
+        return None
+
+    if op in ('slice', 'priority') and len(node.args) == 1:
+        # slice does its job through the query arguments scopes
+        # and priority of one series is this series
+        if op == 'slice' or not node.kwargs:
+            return node.args[0], None, None
+
+    if op == '*' and node.args[0] == (CONST, 1) and type(node.args[0][1]) is int:
+        return node.args[1], None, None
+
+    # now, the rules absorbing an inner node
+    inner = None
+    position = 1 if op == '*' else 0
+    if len(node.args) > position:
+        kind, val = node.args[position]
+        if (kind == NODE and
+            uses[val] == 1 and
+            (NODE, val) != root and
+            _opname(nodes[val]) == op):
+            inner = val
+    if inner is None:
+        return None
+    innernode = nodes[inner]
+
+    def newnode(args, kwargs):
+        return None, Node(
+            node.op, args, kwargs, False, node.scope, node.tree
+        ), inner
+
+    if op == 'time-shifted':
+        # shifts add up
+        allkw = list(node.kwargs.items()) + list(innernode.kwargs.items())
+        if (len(node.args) != 1 or len(innernode.args) != 1 or
+            any(kind != CONST or not isinstance(val, int)
+                for _, (kind, val) in allkw)):
+            return None
+        kwargs = {}
+        for kw, (_, val) in allkw:
+            kwargs[kw] = (CONST, kwargs.get(kw, (CONST, 0))[1] + val)
+        return newnode(innernode.args, kwargs)
+
+    if op == 'options':
+        # the outer options replace the inner ones
+        if len(node.args) != 1 or len(innernode.args) != 1:
+            return None
+        return newnode(innernode.args, node.kwargs)
+
+    if op == '*':
+        # scalar coefficients, when it is exact
+        if len(node.args) != 2 or len(innernode.args) != 2 or node.kwargs:
+            return None
+        (kind, a), (innerkind, b) = node.args[0], innernode.args[0]
+        if kind != CONST or innerkind != CONST:
+            return None
+        if not (_exact_factor(a) or _exact_factor(b)):
+            return None
+        if not isinstance(b, (int, float)) or isinstance(b, bool):
+            return None
+        coef = a * b
+        if not math.isfinite(coef):
+            return None
+        return newnode([(CONST, coef), innernode.args[1]], {})
+
+    if op in ('add', 'mul'):
+        # (add (add a b) c) -> (add a b c), keeping the computation
+        # order; this is exact when the inner series are not filled
+        # (the outer fill policies then only apply where the inner
+        # series have points) and nothing has a limit
+        if node.kwargs or innernode.kwargs:
+            return None
+        inneropts = [_static_options(arg, nodes) for arg in innernode.args]
+        outeropts = [_static_options(arg, nodes) for arg in node.args[1:]]
+        if any(opts is None or opts != (None, None) for opts in inneropts):
+            return None
+        if any(opts is None or opts[1] is not None for opts in outeropts):
+            return None
+        return newnode(innernode.args + node.args[1:], {})
+
+    return None
+
+
+def rewrite(nodes, root):
+    """Simplify the plan nodes with exact algebraic rules: the
+    identities (slice, priority of one series, product by 1) vanish,
+    the nested time shifts, options and scalar products are merged,
+    the nested add/mul calls flattened.
+
+    Returns the new nodes and root.
+    """
+    nodes = list(nodes)
+    uses = _uses(nodes)
+    alias = {}
+    dead = set()
+
+    def resolve(operand):
+        while operand[0] == NODE and operand[1] in alias:
+            operand = alias[operand[1]]
+        return operand
+
+    for idx, node in enumerate(nodes):
+        node = nodes[idx] = Node(
+            resolve(node.op),
+            [resolve(arg) for arg in node.args],
+            {kw: resolve(arg) for kw, arg in node.kwargs.items()},
+            node.splice,
+            node.scope,
+            node.tree
+        )
+        while True:
+            simpler = _simplify(node, nodes, uses, resolve(root))
+            if simpler is None:
+                break
+            target, newnode, inner = simpler
+            if target is not None:
+                alias[idx] = target
+                if target[0] == NODE:
+                    # the users of the node now use its alias
+                    uses[target[1]] += uses[idx] - 1
+                dead.add(idx)
+                break
+            dead.add(inner)
+            node = nodes[idx] = newnode
+
+    return _prune(nodes, resolve(root), dead, alias)
+
+
+# elementwise operators fusion
+
+def fuse(nodes, root):
+    """Merge the chains of elementwise operators (having a kernel) over
+    a single series into one node computing them in one pass.
+
+    Returns the new nodes and root.
+    """
+    uses = _uses(nodes)
+
+    chains = {}
+    dead = set()
+    for idx, node in enumerate(nodes):
+        step = _step(node)
+        if step is None:
+            continue
+        step, (kind, val) = step
+        if (kind == NODE and val in chains and
+            uses[val] == 1 and (NODE, val) != root):
+            steps, source = chains.pop(val)
+            dead.add(val)
+            chains[idx] = steps + [step], source
+        else:
+            chains[idx] = [step], (kind, val)
+
+    if not dead:
+        return nodes, root
+
+    nodes = list(nodes)
+    for idx, (steps, source) in chains.items():
+        if len(steps) > 1:
+            node = nodes[idx]
+            nodes[idx] = Node(
+                (CONST, fused),
+                [(CONST, tuple(steps)), source] + [
+                    (SYM, Symbol(name)) for name, _, _ in steps
+                ],
+                {},
+                False,
+                node.scope,
+                node.tree
             )
-            if isinstance(val, Future):
-                val = val.result()
-        return val
+    return _prune(nodes, root, dead)
+
+
+# streaming reductions
+
+def streamed(__from_value_date__,
+             __to_value_date__,
+             __revision_date__,
+             name, kwargs, proc, srcname, source, *args, **srckwargs):
+    """Compute a variadic operator over the series list of a source
+    operator (see `stream`), folding the series as they are fetched
+    rather than holding them all.
+    """
+    qargs = (__from_value_date__, __to_value_date__, __revision_date__)
+    kwargs = dict(kwargs)
+    if (proc is not FUNCS.get(name) or
+        getattr(source, 'func', None) is not FUNCS.get(srcname)):
+        return proc(*source(*qargs, *args, **srckwargs), **kwargs)
+
+    acc = REDUCERS[name](**kwargs)
+    # the source is bound to the interpreter
+    STREAMS[srcname](
+        *source.args, *qargs, *args, consume=acc.push, **srckwargs
+    )
+    return acc.result()
+
+
+def stream(nodes, root):
+    """Turn the reductions (having a reducer) of a series list
+    (e.g. `(add (findseries ...))`) into one node streaming the series
+    from the source to the reducer.
+
+    Returns the new nodes and root.
+    """
+    uses = _uses(nodes)
+    dead = set()
+    nodes = list(nodes)
+    for idx, node in enumerate(nodes):
+        op = _opname(node)
+        if op not in REDUCERS or len(node.args) != 1:
+            continue
+        if any(kind != CONST for kind, _ in node.kwargs.values()):
+            continue
+        kind, val = node.args[0]
+        if kind != NODE or uses[val] > 1 or (NODE, val) == root:
+            continue
+        source = nodes[val]
+        srcop = _opname(source)
+        if srcop not in STREAMS:
+            continue
+        dead.add(val)
+        nodes[idx] = Node(
+            (CONST, streamed),
+            [
+                (CONST, op),
+                (CONST, tuple(
+                    (str(kw), const) for kw, (_, const) in node.kwargs.items()
+                )),
+                (SYM, Symbol(op)),
+                (CONST, srcop),
+                (SYM, Symbol(srcop))
+            ] + source.args,
+            source.kwargs,
+            False,
+            # the query arguments are the source ones
+            source.scope,
+            node.tree
+        )
+    return _prune(nodes, root, dead)
+
+
+# lazy values
+
+def defer(nodes, root):
+    """Mark the calls to the operators having a lazy form (e.g.
+    `constant`) whose value is only consumed by operators able to
+    materialize it (e.g. `add`): these can skip building values
+    they would mostly drop.
+    """
+    consumers = {}
+    uses = _uses(nodes)
+    for node in nodes:
+        for kind, val in node.operands():
+            if kind == NODE:
+                consumers[val] = (node, (kind, val) in node.args)
+
+    for idx, node in enumerate(nodes):
+        op = _opname(node)
+        if op not in LAZY or uses[idx] != 1 or (NODE, idx) == root:
+            continue
+        consumer, positional = consumers[idx]
+        if positional and _opname(consumer) in LAZY[op][0]:
+            node.lazy = True
+
+
+def compile_plan(tree):
+    nodes = []
+    root = _compile(tree, {}, nodes, {})
+    nodes, root = rewrite(nodes, root)
+    nodes, root = fuse(nodes, root)
+    nodes, root = stream(nodes, root)
+    defer(nodes, root)
+
+    # drop the intermediate values as soon as their last consumer
+    # has been computed
+    lastuse = {}
+    uses = defaultdict(int)
+    for idx, node in enumerate(nodes):
+        for kind, val in node.operands():
+            if kind == NODE:
+                lastuse[val] = idx
+                uses[val] += 1
+    if root[0] == NODE:
+        lastuse.pop(root[1], None)
+    release = defaultdict(list)
+    for used, idx in lastuse.items():
+        release[idx].append(used)
+    for idx, node in enumerate(nodes):
+        node.release = tuple(release[idx])
+
+    return Plan(
+        nodes,
+        root,
+        {idx: count for idx, count in uses.items() if count > 1}
+    )
+
+
+# parallel evaluator
 
-    return _evaluate(
-        tree,
+def pevaluate(tree, env, asyncfuncs=(), concurrency=16, hist=False, pool=None):
+    plan = tree if isinstance(tree, Plan) else compile_plan(tree)
+    if pool is None and concurrency > 1:
+        # no shared scheduler: use a private one
+        with Scheduler(concurrency) as pool:
+            return pevaluate(plan, env, asyncfuncs, hist=hist, pool=pool)
+
+    val = plan.evaluate(
         env,
         {funcid(func) for func in asyncfuncs},
-        None,
+        pool,
         hist
     )
+    if isinstance(val, Future):
+        val = val.result()
+    return val
+
+
+# profiling
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _profiled():
+    return getattr(_local, 'record', None)
+
+
+def _rows(val):
+    if isinstance(val, (pd.Series, pd.DataFrame)):
+        return len(val)
+    if isinstance(val, (list, tuple)):
+        return sum(_rows(item) for item in val)
+    return 0
+
+
+def _nbytes(val):
+    if isinstance(val, pd.Series):
+        return int(val.memory_usage(index=True))
+    if isinstance(val, pd.DataFrame):
+        return int(val.memory_usage(index=True).sum())
+    if isinstance(val, (list, tuple)):
+        return sum(_nbytes(item) for item in val)
+    return 0
+
+
+class Record:
+    """The statistics of a profiled computation: a plan node call or
+    a section opened by `profiling` (e.g. the evaluation of a nested
+    formula).
+
+    The time is the wall time (in seconds) of the computation,
+    inclusive of the nested records; for a node it leaves out the
+    wait, which is the time spent blocked on its inputs. The queries
+    are the sql statements issued by the computation itself
+    (exclusive of the nested records) and the rows and bytes measure
+    the series going in and out.
+    """
+    __slots__ = (
+        'kind', 'label', 'expr', 'time', 'wait', 'queries',
+        'rowsin', 'rowsout', 'bytes', 'children'
+    )
+
+    def __init__(self, kind, label, expr=None):
+        self.kind = kind
+        self.label = label
+        self.expr = expr
+        self.time = self.wait = 0.
+        self.queries = self.rowsin = self.rowsout = self.bytes = 0
+        # the nested sections and plan profiles
+        self.children = []
+
+    def attach(self, child):
+        with _lock:
+            self.children.append(child)
+
+    @contextmanager
+    def active(self):
+        previous = _profiled()
+        _local.record = self
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.time += time.perf_counter() - start
+            _local.record = previous
+
+    def wrap(self, proc):
+        def profiled(*args, **kwargs):
+            with self.active():
+                val = proc(*args, **kwargs)
+            self.rowsout = _rows(val)
+            self.bytes = _nbytes(val)
+            return val
+        return profiled
+
+    def report(self):
+        out = {
+            self.kind: self.label,
+            'time': self.time,
+            'queries': self.queries
+        }
+        if self.kind == 'operator':
+            out.update({
+                'expression': self.expr,
+                'wait': self.wait,
+                'rows_in': self.rowsin,
+                'rows_out': self.rowsout,
+                'bytes': self.bytes
+            })
+        for child in self.children:
+            if isinstance(child, Profile):
+                out.setdefault('plans', []).append(child.report())
+            else:
+                out.setdefault('nested', []).append(child.report())
+        return out
+
+
+def _label(node):
+    names = node.opnames()
+    if names:
+        return '|'.join(names)
+    return getattr(node.op[1], '__name__', repr(node.op[1]))
+
+
+class Profile:
+    """The records of the nodes of a plan evaluation."""
+    __slots__ = ('plan', 'records')
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.records = [
+            Record(
+                'operator',
+                _label(node),
+                serialize(node.tree) if node.tree is not None else None
+            )
+            for node in plan.nodes
+        ]
+
+    def report(self):
+        """Return the tree of the node records, following the
+        operands from the root (a node shared by several consumers is
+        reported in full once, then as a reference to its index).
+        """
+        seen = set()
+        nodes = self.plan.nodes
+
+        def node(idx):
+            if idx in seen:
+                return {'node': idx}
+            seen.add(idx)
+            out = self.records[idx].report()
+            out['node'] = idx
+            out['inputs'] = [
+                node(val)
+                for kind, val in nodes[idx].operands()
+                if kind == NODE
+            ]
+            return out
+
+        kind, val = self.plan.root
+        if kind != NODE:
+            return {}
+        return node(val)
+
+
+@contextmanager
+def profiling(label=None, kind='formula'):
+    """Profile the plan evaluations happening within, in the calling
+    thread (and the ones started by the profiled nodes).
+
+    A new record is attached to the current one, if any. Its
+    `.report()` gives the structured profile, e.g.:
+
+    .. code-block:: python
+
+       with profiling() as record:
+           pevaluate(tree, env)
+       record.report()
+
+    """
+    record = Record(kind, label)
+    parent = _profiled()
+    if parent is not None:
+        parent.attach(record)
+    with record.active():
+        yield record
+
+
+def profiled():
+    """Tell whether the current thread runs under a profile."""
+    return _profiled() is not None
+
+
+def carry_profile(func):
+    """Bind `func` to the current record, for the operators which
+    run their own threads."""
+    record = _profiled()
+    if record is None:
+        return func
+
+    def carried(*args, **kwargs):
+        previous = _profiled()
+        _local.record = record
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.record = previous
+    return carried
+
+
+def count_query(*_):
+    """Account for an sql statement in the current record."""
+    record = _profiled()
+    if record is not None:
+        with _lock:
+            record.queries += 1
@@ -2,8 +2,10 @@ from datetime import date, timedelta, datetime
 from typing import List, Union, Optional, Tuple
 from numbers import Number
 import calendar
-from functools import reduce
+from functools import partial, reduce
 import operator
+import threading
+import warnings
 
 import numpy as np
 import pandas as pd
@@ -30,10 +32,16 @@ from tshistory_formula.registry import (
     func,
     history,
     insertion_dates,
+    kernel,
+    lazy,
+    lookback,
     metadata,
+    reducer,
+    streams,
     argscope
 )
 from tshistory_formula.types import NONETYPE
+from tshistory_formula.evaluator import carry_profile
 from tshistory_formula.helper import seriesname
 from tshistory_formula.interpreter import Interpreter
 
@@ -145,6 +153,14 @@ def series(__interpreter__,
 
     """
     i = __interpreter__
+    ts = i.leaves.pop(
+        (name, __revision_date__, __from_value_date__, __to_value_date__),
+        None
+    )
+    if ts is not None:
+        # bulk fetched, already cut
+        return _series_options(ts, fill, limit, weight)
+
     exists = i.tsh.exists(i.cn, name)
     if not exists:
         if i.tsh.othersources and i.tsh.othersources.exists(name):
@@ -172,6 +188,10 @@ def series(__interpreter__,
         compatible_date(tzaware, __from_value_date__):
         compatible_date(tzaware, __to_value_date__)
     ]
+    return _series_options(ts, fill, limit, weight)
+
+
+def _series_options(ts, fill, limit, weight):
     ts.options = {
         'fill': fill,
         'limit': limit
@@ -209,29 +229,57 @@ def serieslist(__interpreter__,
     Example: `(add (serieslist (findnames (by.value "weight" "<" 43)))`
 
     """
+    result = []
+    _fetch_series(
+        __interpreter__,
+        __from_value_date__,
+        __to_value_date__,
+        __revision_date__,
+        names,
+        result.append
+    )
+    return result
+
+
+def _fetch_series(i, fvd, tvd, rd, names, consume):
+    i.prefetch([
+        (name, rd, fvd, tvd)
+        for name in names
+    ])
     poolrun = threadpool(16)
+    lock = threading.Lock()
 
-    result = []
-    def collect(name, interpreter, fvd, tvd, rd):
-        result.append(
-            series(interpreter, fvd, tvd, rd, name)
-        )
+    def collect(name):
+        ts = series(i, fvd, tvd, rd, name)
+        with lock:
+            consume(ts)
 
     poolrun(
-        collect,
-        [
-            (
-                name,
-                __interpreter__,
-                __from_value_date__,
-                __to_value_date__,
-                __revision_date__
-            )
-            for name in names
-        ]
+        carry_profile(collect),
+        [(name,) for name in names]
     )
 
-    return result
+
+# bulk fetch by batches to keep a bounded number of series in memory
+STREAMBATCH = 64
+
+
+@streams('serieslist')
+def serieslist_stream(__interpreter__,
+                      __from_value_date__,
+                      __to_value_date__,
+                      __revision_date__,
+                      names,
+                      consume):
+    for idx in range(0, len(names), STREAMBATCH):
+        _fetch_series(
+            __interpreter__,
+            __from_value_date__,
+            __to_value_date__,
+            __revision_date__,
+            names[idx:idx + STREAMBATCH],
+            consume
+        )
 
 
 @func('findnames')
@@ -269,6 +317,24 @@ def findseries(__interpreter__,
     )
 
 
+@streams('findseries')
+def findseries_stream(__interpreter__,
+                      __from_value_date__,
+                      __to_value_date__,
+                      __revision_date__,
+                      q,
+                      consume):
+    i = __interpreter__
+    serieslist_stream(
+        __interpreter__,
+        __from_value_date__,
+        __to_value_date__,
+        __revision_date__,
+        i.tsh.find(i.cn, q),
+        consume
+    )
+
+
 @func('by.name')
 def byname(namequery: str) -> search.query:
     """Yields a query filter operating on series names.
@@ -553,6 +619,16 @@ def constant(__interpreter__,
 
 
 def _constant(__interpreter__, args, value, fromdate, todate, freq, revdate):
+    ts = _constant_range(
+        __interpreter__, args, value, fromdate, todate, freq, revdate
+    )
+    if isinstance(ts, Broadcast):
+        return ts.series()
+    return ts
+
+
+def _constant_range(__interpreter__, args, value, fromdate, todate, freq,
+                    revdate):
     getargs = __interpreter__.getargs
     qrevdate = args.get('revision_date')
     if qrevdate and ensuretz(qrevdate) < revdate:
@@ -574,6 +650,27 @@ def _constant(__interpreter__, args, value, fromdate, todate, freq, revdate):
     if maxdate:
         maxdate = ensuretz(maxdate)
 
+    offset = pd.tseries.frequencies.to_offset(freq)
+    if isinstance(offset, pd.offsets.Tick) and str(fromdate.tzinfo) == 'UTC':
+        # a regular grid: compute its part in the requested window
+        step = offset.nanos
+        start = fromdate.value
+        first = 0
+        last = (todate.value - start) // step
+        if mindate is not None:
+            first = max(first, -((start - pd.Timestamp(mindate).value) // step))
+        if maxdate is not None:
+            last = min(last, (pd.Timestamp(maxdate).value - start) // step)
+        if last < first:
+            return pd.Series(
+                dtype='float64',
+                name='constant',
+                index=pd.DatetimeIndex([], tz='UTC')
+            )
+        return Broadcast(
+            value, offset, start + first * step, last - first + 1
+        )
+
     dates = pd.date_range(
         start=fromdate,
         end=todate,
@@ -581,13 +678,103 @@ def _constant(__interpreter__, args, value, fromdate, todate, freq, revdate):
     )
 
     return pd.Series(
-        [value] * len(dates),
+        np.full(len(dates), value, dtype='float64'),
         name='constant',
-        index=dates,
-        dtype='float64'
+        index=dates
     ).loc[mindate:maxdate]
 
 
+class Broadcast:
+    """A constant value over a regular grid of utc value dates.
+
+    This stands for a series in the aligned operators (see
+    evaluator.defer), which only materialize it on the value dates
+    they need.
+    """
+    __slots__ = ('value', 'offset', 'start', 'step', 'count')
+
+    def __init__(self, value, offset, start, count):
+        self.value = value
+        self.offset = offset
+        # the grid in utc nanoseconds
+        self.start = start
+        self.step = offset.nanos
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def series(self, index=None):
+        """Materialize the constant over its whole grid or over the
+        value dates of `index` belonging to the grid.
+        """
+        if index is None:
+            index = pd.date_range(
+                start=pd.Timestamp(self.start, tz='UTC'),
+                periods=self.count,
+                freq=self.offset
+            )
+        else:
+            offsets = index.asi8 - self.start
+            index = index[
+                (offsets >= 0) &
+                (offsets // self.step < self.count) &
+                (offsets % self.step == 0)
+            ]
+        ts = pd.Series(
+            np.full(len(index), self.value, dtype='float64'),
+            name='constant',
+            index=index
+        )
+        ts.options = {}
+        return ts
+
+
+def _materialize(serieslist):
+    """Return the series list of an aligned operator with its lazy
+    constants (see `Broadcast`) materialized.
+
+    Without fill policies the result only holds the value dates common
+    to all the series: there is no need to materialize the constants
+    beyond the value dates of another series.
+    """
+    if not any(isinstance(ts, Broadcast) for ts in serieslist):
+        return serieslist
+
+    index = None
+    others = [
+        ts for ts in serieslist
+        if not isinstance(ts, Broadcast)
+    ]
+    if others and all(ts.options.get('fill') is None for ts in others):
+        index = others[0].index
+        if not isinstance(index, pd.DatetimeIndex) or index.tz is None:
+            index = None
+
+    return [
+        ts.series(index) if isinstance(ts, Broadcast) else ts
+        for ts in serieslist
+    ]
+
+
+@lazy('constant', consumers=('add', 'mul'))
+def constant_lazy(__interpreter__,
+                  __from_value_date__,
+                  __to_value_date__,
+                  __revision_date__,
+                  value, fromdate, todate, freq, revdate):
+    ts = _constant_range(
+        __interpreter__,
+        {'revision_date': __revision_date__,
+         'from_value_date': __from_value_date__,
+         'to_value_date': __to_value_date__},
+        value, fromdate, todate, freq, revdate
+    )
+    if isinstance(ts, pd.Series):
+        ts.options = {}
+    return ts
+
+
 @metadata('constant')
 def constant_metadata(cn, tsh, tree):
     return {
@@ -627,7 +814,7 @@ def constant_idates(cn, tsh, tree,
     return [revdate]
 
 
-@func('+')
+@func('+', pointwise=True)
 def scalar_add(
         num: Number,
         num_or_series: Union[Number, pd.Series]) -> Union[Number, pd.Series]:
@@ -649,7 +836,7 @@ def scalar_add(
     return res
 
 
-@func('*')
+@func('*', pointwise=True)
 def scalar_prod(
         num: Number,
         num_or_series: Union[Number, pd.Series]) -> Union[Number, pd.Series]:
@@ -671,7 +858,7 @@ def scalar_prod(
     return res
 
 
-@func('/')
+@func('/', pointwise=True)
 def scalar_div(
         num_or_series: Union[Number, pd.Series],
         num: Number) -> Union[Number, pd.Series]:
@@ -691,7 +878,7 @@ def scalar_div(
     return res
 
 
-@func('**')
+@func('**', pointwise=True)
 def scalar_pow(
         series: pd.Series,
         num: Number) -> pd.Series:
@@ -707,6 +894,34 @@ def scalar_pow(
     return res
 
 
+@kernel('+', position=1)
+def _scalar_add_kernel(num, values):
+    if not isinstance(num, (int, float)):
+        return NotImplemented
+    return num + values
+
+
+@kernel('*', position=1)
+def _scalar_prod_kernel(num, values):
+    if not isinstance(num, (int, float)):
+        return NotImplemented
+    return num * values
+
+
+@kernel('/')
+def _scalar_div_kernel(values, num):
+    if not isinstance(num, (int, float)):
+        return NotImplemented
+    return values / num
+
+
+@kernel('**')
+def _scalar_pow_kernel(values, num):
+    if not isinstance(num, (int, float)):
+        return NotImplemented
+    return values ** num
+
+
 
 def _fill(df, colname, fillopt):
     """ in-place application of the series fill policies
@@ -753,9 +968,130 @@ def _group_series(*serieslist):
     return df
 
 
+# k-way alignment kernel
+
+FILLMETHODS = {
+    'ffill': 'ffill',
+    'pad': 'ffill',
+    'bfill': 'bfill',
+    'backfill': 'bfill'
+}
+
+
+def _ffill(values, limit=None):
+    # forward fill the nans of a 1d array, at most `limit`
+    # consecutive ones
+    positions = np.arange(len(values))
+    last = np.where(~np.isnan(values), positions, -1)
+    np.maximum.accumulate(last, out=last)
+    mask = last >= 0
+    if limit is not None:
+        mask &= (positions - last) <= limit
+    out = values.copy()
+    out[mask] = values[last[mask]]
+    return out
+
+
+def _fill_array(values, fillopt):
+    """ the array version of `_fill` """
+    filler = fillopt['fill']
+    limit = fillopt.get('limit')
+    if isinstance(filler, str):
+        for method in filler.split(','):
+            if FILLMETHODS[method.strip()] == 'ffill':
+                values = _ffill(values, limit)
+            else:
+                values = _ffill(values[::-1], limit)[::-1]
+    elif isinstance(filler, (int, float)):
+        nans = np.flatnonzero(np.isnan(values))
+        if limit is not None:
+            nans = nans[:limit]
+        values = values.copy()
+        values[nans] = filler
+    return values
+
+
+def _alignable(serieslist):
+    first = serieslist[0].index
+    if not isinstance(first, pd.DatetimeIndex):
+        return False
+    for ts in serieslist:
+        if not isinstance(ts.index, pd.DatetimeIndex):
+            return False
+        if ts.index.tz != first.tz:
+            return False
+        if ts.dtype.kind not in 'iuf':
+            return False
+        if not ts.index.is_monotonic_increasing or not ts.index.is_unique:
+            return False
+        filler = ts.options.get('fill')
+        if isinstance(filler, str) and any(
+                method.strip() not in FILLMETHODS
+                for method in filler.split(',')):
+            return False
+    return True
+
+
+def _align(serieslist):
+    """Align the series on the union of their (sorted) indexes and
+    apply their fill policies.
+
+    This is the array version of `_group_series`: it returns the union
+    index and one aligned array per series, or None when an unfilled
+    empty series entails an empty result.
+    """
+    for ts in serieslist:
+        if ts.options.get('fill') is None and not len(ts):
+            # at least one series without fill policy and no data
+            # entails an empty result
+            return None
+
+    first = serieslist[0].index
+    if all(ts.index.equals(first) for ts in serieslist[1:]):
+        # the common case: nothing to align
+        index = first
+        arrays = [ts.values for ts in serieslist]
+    else:
+        stamps = np.unique(
+            np.concatenate([ts.index.asi8 for ts in serieslist])
+        )
+        index = pd.DatetimeIndex(stamps.view('datetime64[ns]'))
+        if first.tz is not None:
+            index = index.tz_localize('UTC').tz_convert(first.tz)
+        arrays = []
+        for ts in serieslist:
+            if len(ts) == len(stamps):
+                arrays.append(ts.values)
+                continue
+            values = np.full(len(stamps), np.nan)
+            values[np.searchsorted(stamps, ts.index.asi8)] = ts.values
+            arrays.append(values)
+
+    names = {ts.index.name for ts in serieslist}
+    index = index.rename(names.pop() if len(names) == 1 else None)
+
+    # apply the filling rules
+    for idx, ts in enumerate(serieslist):
+        fillopt = ts.options
+        if fillopt and fillopt.get('fill') is not None:
+            if arrays[idx].dtype.kind == 'f':
+                arrays[idx] = _fill_array(arrays[idx], fillopt)
+
+    return index, arrays
+
+
+def _complete(index, result, name=None):
+    # the aligned operators drop the rows with missing values
+    if result.dtype.kind == 'f':
+        mask = ~np.isnan(result)
+        if not mask.all():
+            index, result = index[mask], result[mask]
+    return pd.Series(result, index=index, name=name)
+
+
 # trigonometric functions
 
-@func('trig.cos')
+@func('trig.cos', pointwise=True)
 def trig_cosinus(series: pd.Series,
                  decimals: Optional[Number]=None) -> pd.Series:
     """
@@ -771,7 +1107,7 @@ def trig_cosinus(series: pd.Series,
     return res
 
 
-@func('trig.arccos')
+@func('trig.arccos', pointwise=True)
 def trig_arccosinus(series: pd.Series) -> pd.Series:
     """
     Trigonometric inverse cosine on a series of values [-1, 1] with a degree output.
@@ -785,7 +1121,7 @@ def trig_arccosinus(series: pd.Series) -> pd.Series:
     return res
 
 
-@func('trig.sin')
+@func('trig.sin', pointwise=True)
 def trig_sinus(series: pd.Series,
           decimals: Optional[Number]=None) -> pd.Series:
     """
@@ -802,7 +1138,7 @@ def trig_sinus(series: pd.Series,
     return res
 
 
-@func('trig.arcsin')
+@func('trig.arcsin', pointwise=True)
 def trig_arcsinus(series: pd.Series) -> pd.Series:
     """
     Trigonometric inverse sine on a series of values [-1, 1] with a degree output.
@@ -816,7 +1152,7 @@ def trig_arcsinus(series: pd.Series) -> pd.Series:
     return res
 
 
-@func('trig.tan')
+@func('trig.tan', pointwise=True)
 def trig_tangent(series: pd.Series,
                  decimals: Optional[Number]=None) -> pd.Series:
     """
@@ -833,7 +1169,7 @@ def trig_tangent(series: pd.Series,
     return res
 
 
-@func('trig.arctan')
+@func('trig.arctan', pointwise=True)
 def trig_arctangent(series: pd.Series) -> pd.Series:
     """
     Trigonometric inverse tangent on a series of values [-1, 1] with a degree output.
@@ -846,7 +1182,24 @@ def trig_arctangent(series: pd.Series) -> pd.Series:
     return res
 
 
-@func('trig.row-arctan2')
+def _trig_kernel(func, values, decimals=None):
+    res = func(values * (np.pi / 180))
+    if decimals:
+        res = res.round(decimals)
+    return res
+
+
+kernel('trig.cos')(partial(_trig_kernel, np.cos))
+kernel('trig.sin')(partial(_trig_kernel, np.sin))
+kernel('trig.tan')(partial(_trig_kernel, np.tan))
+
+
+@kernel('trig.arctan')
+def _trig_arctangent_kernel(values):
+    return np.arctan(values) * (180 / np.pi)
+
+
+@func('trig.row-arctan2', pointwise=True)
 def trig_arctangent2(series1: pd.Series,
                      series2: pd.Series) -> pd.Series:
     """
@@ -902,7 +1255,34 @@ def _comparator(
     return ts
 
 
-@func('>')
+# the kernels copy the operators (and `<` has always been `<=`)
+COMPARATORS = {
+    '<': operator.le,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '<>': operator.ne
+}
+
+
+def _comparator_kernel(operation, values, num_or_series,
+                       false_value=0, true_value=1):
+    if not isinstance(num_or_series, (int, float)):
+        return NotImplemented
+    mask = COMPARATORS[operation](values, num_or_series)
+    return np.where(
+        mask,
+        np.nan if true_value is None else true_value,
+        np.nan if false_value is None else false_value
+    ).astype('float64')
+
+
+for operation in COMPARATORS:
+    kernel(operation, keep=False)(partial(_comparator_kernel, operation))
+
+
+@func('>', pointwise=True)
 def superior_to(series: pd.Series,
                 num_or_series: Union[Number, pd.Series],
                 false_value: Optional[Number] = 0,
@@ -919,7 +1299,7 @@ def superior_to(series: pd.Series,
     return _comparator('>', series, num_or_series, false_value, true_value)
 
 
-@func('>=')
+@func('>=', pointwise=True)
 def superior_or_equal_to(series: pd.Series,
                          num_or_series: Union[Number, pd.Series],
                          false_value: Optional[Number] = 0,
@@ -936,7 +1316,7 @@ def superior_or_equal_to(series: pd.Series,
     return _comparator('>=', series, num_or_series, false_value, true_value)
 
 
-@func('<')
+@func('<', pointwise=True)
 def inferior_to(series: pd.Series,
                 num_or_series: Union[Number, pd.Series],
                 false_value: Optional[Number] = 0,
@@ -953,7 +1333,7 @@ def inferior_to(series: pd.Series,
     return _comparator('<=', series, num_or_series, false_value, true_value)
 
 
-@func('<=')
+@func('<=', pointwise=True)
 def inferior_or_equal_to(series: pd.Series,
                          num_or_series: Union[Number, pd.Series],
                          false_value: Optional[Number] = 0,
@@ -970,7 +1350,7 @@ def inferior_or_equal_to(series: pd.Series,
     return _comparator('<=', series, num_or_series, false_value, true_value)
 
 
-@func('==')
+@func('==', pointwise=True)
 def equal_to(series: pd.Series,
              num_or_series: Union[Number, pd.Series],
              false_value: Optional[Number] = 0,
@@ -987,7 +1367,7 @@ def equal_to(series: pd.Series,
     return _comparator('==', series, num_or_series, false_value, true_value)
 
 
-@func('<>')
+@func('<>', pointwise=True)
 def different_to(series: pd.Series,
                  num_or_series: Union[Number, pd.Series],
                  false_value: Optional[Number] = 0,
@@ -1006,7 +1386,7 @@ def different_to(series: pd.Series,
 # /conditionals
 
 
-@func('add')
+@func('add', pointwise=True)
 def series_add(*serieslist: pd.Series) -> pd.Series:
     """
     Linear combination of two or more series. Takes a variable number
@@ -1028,15 +1408,36 @@ def series_add(*serieslist: pd.Series) -> pd.Series:
         # but we don't yet have that
         return empty_series(True)
 
+    serieslist = _materialize(serieslist)
     assert [
         isinstance(s, pd.Series)
         for s in serieslist
     ]
 
-    return _group_series(*serieslist).dropna().sum(axis=1)
+    if not _alignable(serieslist):
+        return _group_series(*serieslist).dropna().sum(axis=1)
+
+    aligned = _align(serieslist)
+    if aligned is None:
+        return pd.Series(dtype='float64')
+
+    index, arrays = aligned
+    missing = None
+    for values in arrays:
+        if values.dtype.kind == 'f':
+            nans = np.isnan(values)
+            missing = nans if missing is None else missing | nans
+    if missing is not None and missing.any():
+        index = index[~missing]
+        arrays = [values[~missing] for values in arrays]
 
+    result = arrays[0]
+    for values in arrays[1:]:
+        result = result + values
+    return pd.Series(result, index=index)
 
-@func('mul')
+
+@func('mul', pointwise=True)
 def series_multiply(*serieslist: pd.Series) -> pd.Series:
     """
     Element wise multiplication of series. Takes a variable number of
@@ -1048,6 +1449,19 @@ def series_multiply(*serieslist: pd.Series) -> pd.Series:
     in euros, using a currency exchange rate series with a
     forward-fill option.
     """
+    serieslist = _materialize(serieslist)
+    if _alignable(serieslist):
+        aligned = _align(serieslist)
+        if aligned is None or not len(aligned[0]):
+            return empty_series(
+                tzaware_serie(serieslist[0])
+            )
+        index, arrays = aligned
+        result = arrays[0]
+        for values in arrays[1:]:
+            result = result * values
+        return _complete(index, result, name='0')
+
     df = _group_series(*serieslist)
     if not len(df):
         return empty_series(
@@ -1064,13 +1478,23 @@ def series_multiply(*serieslist: pd.Series) -> pd.Series:
     return res[res.columns[0]].dropna()
 
 
-@func('div')
+@func('div', pointwise=True)
 def series_div(s1: pd.Series, s2: pd.Series) -> pd.Series:
     """
     Element wise division of two series.
 
     Example: `(div (series "$-to-€") (series "€-to-£"))`
     """
+    if _alignable((s1, s2)):
+        aligned = _align((s1, s2))
+        if aligned is None or not len(aligned[0]):
+            return empty_series(
+                tzaware_serie(s1)
+            )
+        index, (v1, v2) = aligned
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return _complete(index, v1 / v2)
+
     df = _group_series(*(s1, s2))
     if not len(df) or len(df.columns) < 2:
         return empty_series(
@@ -1081,7 +1505,7 @@ def series_div(s1: pd.Series, s2: pd.Series) -> pd.Series:
     return (df[c1] / df[c2]).dropna()
 
 
-@func('priority')
+@func('priority', pointwise=True)
 def series_priority(*serieslist: pd.Series) -> pd.Series:
     """
     The priority operator combines its input series as layers. For
@@ -1096,12 +1520,42 @@ def series_priority(*serieslist: pd.Series) -> pd.Series:
     if len(serieslist) == 1:
         return serieslist[0]
 
-    series = list(serieslist)
-    series.reverse()
-    return patchmany(series)
+    if any(ts.dtype == 'object' for ts in serieslist):
+        series = list(serieslist)
+        series.reverse()
+        return patchmany(series)
+
+    return _priority(serieslist)
+
+
+def _priority(serieslist):
+    """k-way merge of the layers: one stable sort of all the stamps
+    (in priority order), keeping the first occurrence of each stamp.
+    """
+    last = serieslist[-1]
+    layers = [ts for ts in serieslist if len(ts)]
+    if not layers:
+        return last
+
+    stamps = np.concatenate([ts.index.values for ts in layers])
+    order = np.argsort(stamps, kind='stable')
+    stamps = stamps[order]
+    keep = np.empty(len(stamps), dtype=bool)
+    keep[0] = True
+    np.not_equal(stamps[1:], stamps[:-1], out=keep[1:])
+
+    values = np.concatenate([
+        ts.values.astype('float64', copy=False)
+        for ts in layers
+    ])[order[keep]]
+    index = pd.Index(stamps[keep])
+    tz = getattr(last.index, 'tz', None)
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    return pd.Series(values, index=index, name=last.name)
 
 
-@func('clip')
+@func('clip', pointwise=True)
 def series_clip(series: pd.Series,
                 min: Optional[Number]=None,
                 max: Optional[Number]=None,
@@ -1163,7 +1617,7 @@ def slice_transform(tree):
     return top
 
 
-@func('slice')
+@func('slice', pointwise=True)
 @argscope('slice', slice_transform)
 def slice(series: pd.Series,
           fromdate: Optional[pd.Timestamp]=None,
@@ -1188,7 +1642,7 @@ def slice(series: pd.Series,
     return series
 
 
-@func('row-mean')
+@func('row-mean', pointwise=True)
 def row_mean(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     This operator computes the row-wise mean of its input series using
@@ -1227,7 +1681,7 @@ def row_mean(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     ).dropna()
 
 
-@func('row-min')
+@func('row-min', pointwise=True)
 def row_min(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the row-wise minimum of its input series.
@@ -1243,7 +1697,7 @@ def row_min(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     return allseries.min(axis=1, skipna=skipna).dropna()
 
 
-@func('row-max')
+@func('row-max', pointwise=True)
 def row_max(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the row-wise maximum of its input series.
@@ -1259,7 +1713,7 @@ def row_max(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     return allseries.max(axis=1, skipna=skipna).dropna()
 
 
-@func('std')
+@func('std', pointwise=True)
 def row_std(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     """
     Computes the standard deviation over its input series.
@@ -1275,6 +1729,138 @@ def row_std(*serieslist: pd.Series, skipna: Optional[bool]=True) -> pd.Series:
     return allseries.std(axis=1, skipna=skipna).dropna()
 
 
+# streaming reductions (see evaluator.stream)
+
+class _Fold:
+    """Fold the series one at a time with a variadic operator for
+    which `op(a, b, c) == op(op(a, b), c)` (the series of a list having
+    no fill option).
+    """
+    __slots__ = ('op', 'kwargs', 'acc')
+
+    def __init__(self, op, kwargs):
+        self.op = op
+        self.kwargs = kwargs
+        self.acc = None
+
+    def push(self, ts):
+        if self.acc is None:
+            self.acc = ts
+            return
+        self.acc = self.op(self.acc, ts, **self.kwargs)
+
+    def result(self):
+        if self.acc is None:
+            return self.op(**self.kwargs)
+        return self.op(self.acc, **self.kwargs)
+
+
+@reducer('add')
+def add_reducer():
+    return _Fold(series_add, {})
+
+
+@reducer('row-min')
+def row_min_reducer(skipna=True):
+    return _Fold(row_min, {'skipna': skipna})
+
+
+@reducer('row-max')
+def row_max_reducer(skipna=True):
+    return _Fold(row_max, {'skipna': skipna})
+
+
+class _RowMoments:
+    """Running row-wise moments of the series, aligned on the union of
+    their indexes.
+
+    The subclasses maintain their own arrays (named in `.state`) from
+    the aligned values and presence mask of each new series.
+    """
+    state = ()
+
+    def __init__(self, op, skipna):
+        self.op = op
+        self.skipna = skipna
+        self.pushes = 0
+        self.index = None
+        self.count = None
+
+    def _arrays(self):
+        return ['count'] + list(self.state)
+
+    def push(self, ts):
+        values = ts.values.astype('float64')
+        if self.index is None:
+            self.index = ts.index
+            for name in self._arrays():
+                setattr(self, name, np.zeros(len(values)))
+        elif not ts.index.equals(self.index):
+            index = self.index.union(ts.index)
+            positions = index.get_indexer(self.index)
+            for name in self._arrays():
+                array = np.zeros(len(index))
+                array[positions] = getattr(self, name)
+                setattr(self, name, array)
+            aligned = np.full(len(index), np.nan)
+            aligned[index.get_indexer(ts.index)] = values
+            self.index, values = index, aligned
+
+        present = ~np.isnan(values)
+        self.count += present
+        self.pushes += 1
+        self.update(ts, np.where(present, values, 0.), present)
+
+    def result(self):
+        if self.index is None:
+            return self.op(skipna=self.skipna)
+        values = self.compute()
+        if not self.skipna:
+            # a missing point makes a missing row
+            values[self.count < self.pushes] = np.nan
+        return _complete(self.index, values)
+
+
+class _RowMean(_RowMoments):
+    state = ('total', 'weights')
+
+    def update(self, ts, values, present):
+        weight = ts.options.get('weight', 1)
+        self.total += values * weight
+        self.weights += present * weight
+
+    def compute(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.total / self.weights
+
+
+class _RowStd(_RowMoments):
+    # welford
+    state = ('mean', 'm2')
+
+    def update(self, ts, values, present):
+        delta = np.where(present, values - self.mean, 0.)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(present, values - self.mean, 0.)
+
+    def compute(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = self.m2 / (self.count - 1)
+        variance[self.count < 2] = np.nan
+        # the rounding errors must not make negative variances
+        return np.sqrt(np.maximum(variance, 0.))
+
+
+@reducer('row-mean')
+def row_mean_reducer(skipna=True):
+    return _RowMean(row_mean, skipna)
+
+
+@reducer('std')
+def row_std_reducer(skipna=True):
+    return _RowStd(row_std, skipna)
+
+
 def resample_adjust(tstamp, freq):
     """Return adjusted time stamp when resampling with freq.
 
@@ -1385,7 +1971,8 @@ def resample(series: pd.Series,
 
 
 @func('cumsum')
-def cumsum(series: pd.Series) -> pd.Series:
+def cumsum(__from_value_date__,
+           series: pd.Series) -> pd.Series:
     """
     Return cumulative sum over a series.
 
@@ -1393,7 +1980,16 @@ def cumsum(series: pd.Series) -> pd.Series:
 
     """
 
-    return series.cumsum()
+    return _cut_before(
+        series.cumsum(),
+        __from_value_date__
+    )
+
+
+@lookback('cumsum')
+def cumsum_lookback():
+    # the whole past is summed
+    return None
 
 
 def time_shifted_transform(tree):
@@ -1453,7 +2049,8 @@ def time_shifted(series: pd.Series,
 
 
 @func('rolling')
-def rolling(series: pd.Series,
+def rolling(__from_value_date__,
+            series: pd.Series,
             window: int,
             method: str='mean') -> pd.Series:
     """
@@ -1468,7 +2065,26 @@ def rolling(series: pd.Series,
 
     rolled = series.rolling(window)
     df = rolled.agg((method,)).dropna()
-    return df[df.columns[0]]
+    return _cut_before(
+        df[df.columns[0]],
+        __from_value_date__
+    )
+
+
+@lookback('rolling')
+def rolling_lookback(window, method='mean'):
+    # the first point of the requested range needs the
+    # `window - 1` points before it
+    return window - 1
+
+
+def _cut_before(series, fromdate):
+    # the input was read before `fromdate` (see lookback)
+    if fromdate is None or not len(series):
+        return series
+    return series.loc[
+        compatible_date(tzaware_serie(series), fromdate):
+    ]
 
 
 # integration -- a somewhat hairy operator :)
@@ -1546,13 +2162,9 @@ def find_last_values(
         tzaware):
     """
     Returns a series contained between from_value_date and
-    to_value_date If no data is found in this interval, this function
-    will look at the left of the lower bound until it finds something
-    (with a hard-coded limit to avoid infinite loops)
+    to_value_date If no data is found in this interval (or with
+    `fill`), the latest point before the lower bound is added.
     """
-    period = timedelta(days=10)
-    multiplier = 2
-
     args = {}
     if revision_date:
         args['revision_date'] = revision_date
@@ -1563,35 +2175,45 @@ def find_last_values(
     if not from_value_date:
         return __interpreter__.get(name, args)
 
-    current_bound = from_value_date
-    ts = empty_series(tzaware)
-    if not fill:
-        while not len(ts):
-            args.update({'from_value_date': current_bound})
-            ts = __interpreter__.get(name, args)
-            current_bound = from_value_date - period
-            period = period * multiplier
-            if period > timedelta(days=3000):
-                break
-    else:
-        args.update({'from_value_date': from_value_date})
-        ts = __interpreter__.get(name, args)
-        previous_ts = empty_series(tzaware)
-        current_bound = from_value_date
-        args.update({'to_value_date': from_value_date})
-        while not len(previous_ts):
-            args.update({'from_value_date': current_bound})
-            previous_ts = __interpreter__.get(name, args)
-            current_bound = from_value_date - period
-            period = period * multiplier
-            if period > timedelta(days=3000):
-                break
+    args.update({'from_value_date': from_value_date})
+    ts = __interpreter__.get(name, args)
+    if fill or not len(ts):
+        previous_ts = last_value(
+            __interpreter__, name, args, from_value_date, tzaware
+        )
         if len(previous_ts):
             ts = patch(previous_ts, ts)
 
     return ts
 
 
+def last_value(__interpreter__, name, args, tstamp, tzaware):
+    """
+    Returns the latest point of a series at or before `tstamp`
+    (as a series).
+    """
+    ts = __interpreter__.last_point(name, tstamp, args)
+    if ts is not None:
+        return ts
+
+    # look at the left of the bound until we find something
+    # (with a hard-coded limit to avoid infinite loops)
+    period = timedelta(days=10)
+    multiplier = 2
+
+    args = dict(args, to_value_date=tstamp)
+    current_bound = tstamp
+    ts = empty_series(tzaware)
+    while not len(ts):
+        args.update({'from_value_date': current_bound})
+        ts = __interpreter__.get(name, args)
+        current_bound = tstamp - period
+        period = period * multiplier
+        if period > timedelta(days=3000):
+            break
+    return ts.iloc[-1:]
+
+
 def _integration(__interpreter__, iargs, stock_name, flow_name, fill):
     i = __interpreter__
     args = iargs.copy()
@@ -1799,6 +2421,20 @@ def doy_aggregation(
     except ValueError:
         return empty_series(False)
     assert leap_day_rule in ["ignore", "linear", "as_is"]
+
+    if method in DOY_REDUCERS and series.dtype != 'object':
+        return _doy_grid_aggregation(
+            series, depth, method, leap_day_rule, valid_aggr_ratio, start, end
+        )
+
+    return _doy_yearly_aggregation(
+        series, depth, method, leap_day_rule, valid_aggr_ratio, start, end
+    )
+
+
+def _doy_yearly_aggregation(
+        series, depth, method, leap_day_rule, valid_aggr_ratio, start, end):
+    # one groupby per year, for the methods without a numpy reducer
     # L.info(
     #     f"doy-agg from {start} to {end} ["
     #     f" aggregator={method!r}"
@@ -1848,6 +2484,121 @@ def doy_aggregation(
     return pd.concat(habits_segments).dropna()
 
 
+# position of the days (month, day) in a leap year
+DOY_POSITIONS = np.cumsum(
+    [0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30]
+)
+LEAP_DAY = 59
+
+# the nan-aware reductions of a (years, days, values) array over its
+# last axis, matching the pandas groupby aggregations
+# (mean, sum and count are computed from cumulative sums)
+DOY_REDUCERS = {
+    'mean': None,
+    'sum': None,
+    'count': None,
+    'min': np.nanmin,
+    'max': np.nanmax,
+    'median': np.nanmedian,
+    'std': partial(np.nanstd, ddof=1),
+    'var': partial(np.nanvar, ddof=1),
+}
+
+
+def _doy_grid_aggregation(
+        series, depth, method, leap_day_rule, valid_aggr_ratio, start, end):
+    """Aggregate the values by day of year over the `depth` previous
+    years for all the years at once, on a years x days grid.
+    """
+    index = series.index
+    values = series.values.astype('float64')
+    firstyear = index.year.min()
+    years = index.year.values - firstyear
+    days = DOY_POSITIONS[index.month.values - 1] + index.day.values - 1
+    nyears = years.max() + 1
+    cells = years * 366 + days
+    notna = ~np.isnan(values)
+
+    # the aggregation windows [year - depth, year - 1] of the
+    # output years, as slices of the grid years
+    outyears = np.arange(start.year, end.year + 1)
+    hi = np.clip(outyears - firstyear, 0, nyears)
+    lo = np.clip(outyears - firstyear - depth, 0, nyears)
+
+    def windowed(counts):
+        # incremental sums over the years windows
+        grid = np.zeros((nyears + 1, 366))
+        grid[1:] = counts.reshape(nyears, 366)
+        grid = grid.cumsum(axis=0)
+        return grid[hi] - grid[lo]
+
+    def cellsum(weights=None):
+        return np.bincount(cells, weights, minlength=nyears * 366)
+
+    present = windowed(cellsum()) > 0
+    count = windowed(cellsum(notna.astype('float64')))
+
+    if method == 'count':
+        result = count
+    elif method in ('mean', 'sum'):
+        result = windowed(cellsum(np.where(notna, values, 0.)))
+        if method == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = result / count
+    else:
+        # the values of each cell, padded with nans
+        order = np.argsort(cells, kind='stable')
+        sortedcells = cells[order]
+        rank = np.arange(len(cells)) - np.searchsorted(sortedcells, sortedcells)
+        grid = np.full((nyears + depth, 366, rank.max() + 1), np.nan)
+        grid[depth + years[order], days[order], rank] = values[order]
+        windows = np.lib.stride_tricks.sliding_window_view(
+            grid, depth, axis=0
+        )[outyears - firstyear]
+        windows = windows.reshape(windows.shape[:2] + (-1,))
+        with warnings.catch_warnings():
+            # all-nan cells
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = DOY_REDUCERS[method](windows, axis=-1)
+
+    result[count / depth < valid_aggr_ratio] = np.nan
+
+    # back to dates
+    leap = np.array([calendar.isleap(year) for year in outyears])
+    keep = present.copy()
+    if leap_day_rule == 'as_is':
+        keep[~leap, LEAP_DAY] = False
+    else:
+        keep[:, LEAP_DAY] = False
+    yearidx, dayidx = np.nonzero(keep)
+    offsets = dayidx - ((dayidx > LEAP_DAY) & ~leap[yearidx])
+    stamps = (
+        (outyears[yearidx] - 1970).astype('datetime64[Y]').astype('datetime64[D]') +
+        offsets.astype('timedelta64[D]')
+    )
+    aggregated = pd.Series(
+        result[yearidx, dayidx],
+        index=pd.DatetimeIndex(stamps, name='datetime'),
+        name=series.name
+    )
+    aggregated = aggregated[
+        (start <= aggregated.index) & (aggregated.index <= end)
+    ]
+
+    if leap_day_rule == 'linear':
+        segments = [aggregated]
+        for year in outyears[leap]:
+            leapday = pd.Timestamp(f'{year}-2-29')
+            segment = linear_insert_date(
+                aggregated.loc[str(year)].copy(), leapday
+            )
+            if leapday in segment.index:
+                segments.append(segment.loc[[leapday]])
+        aggregated = pd.concat(segments).sort_index()
+
+    return aggregated.dropna()
+
+
 def aggregate_by_doy(
         series: pd.Series,
         from_year: int,
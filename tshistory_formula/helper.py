@@ -1,8 +1,13 @@
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 import inspect
-import queue
+import os
 import threading
 from concurrent.futures import _base
 
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
 from psyl.lisp import (
     Keyword,
     parse,
@@ -70,6 +75,30 @@ def inject_toplevel_bindings(tree, qargs):
     return top
 
 
+def toplevel_bindings(qargs):
+    """Compute the values that `inject_toplevel_bindings` would bind,
+    for the evaluation of plans (which do not embed them).
+    """
+    bindings = {}
+    for attr in ('revision_date', 'from_value_date', 'to_value_date'):
+        val = qargs.get(attr)
+        if val:
+            # naive must remain naive
+            tzone = val.tzinfo.zone if val.tzinfo else None
+            val = pd.Timestamp(val.isoformat(), tz=tzone)
+        else:
+            val = None
+        bindings[attr] = val
+    return bindings
+
+
+def copytree(tree):
+    return [
+        copytree(item) if isinstance(item, list) else item
+        for item in tree
+    ]
+
+
 def has_names(tsh, cn, tree, names, stopnames):
     if tree[0] == 'series':
         name = tree[1]
@@ -143,27 +172,23 @@ def expanded(
         if name in stopnames:
             return tree
         if tsh.type(cn, name) == 'formula':
-            formula = tsh.formula(cn, name)
-            options = extract_auto_options(tree)
-            if not options:
-                return expanded(
+            if stopnames or shownames:
+                subtree = expanded(
                     tsh,
                     cn,
-                    parse(formula),
+                    parse(tsh.formula(cn, name)),
                     stopnames,
                     shownames,
                     scopes=scopes,
                 )
+            else:
+                subtree = tsh.expanded_tree(cn, name, scopes)
+            options = extract_auto_options(tree)
+            if not options:
+                return subtree
             return [
                 Symbol('options'),
-                expanded(
-                    tsh,
-                    cn,
-                    parse(formula),
-                    stopnames,
-                    shownames,
-                    scopes=scopes,
-                ),
+                subtree,
             ] + options
 
 
@@ -395,14 +420,67 @@ def find_tzaware_query(self, cn, tree):
     return tzawares[0]
 
 
+# caches
+
+class LRUCache:
+    """A mapping bounded to its `size` most recently used entries."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def __setitem__(self, key, val):
+        with self.lock:
+            self.entries[key] = val
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+
 # thread pool
 
+_local = threading.local()
+
+
+def _owner():
+    """The evaluation on behalf of which the current thread works: the
+    one of the work item it runs, or else the thread itself."""
+    owner = getattr(_local, 'owner', None)
+    if owner is None:
+        owner = _local.owner = object()
+    return owner
+
+
 class _WorkItem(object):
     def __init__(self, future, fn, args, kwargs):
         self.future = future
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
+        self.owner = _owner()
 
     def run(self):
         try:
@@ -413,49 +491,105 @@ class _WorkItem(object):
             self.future.set_result(result)
 
 
-class Stop:
-    pass
+class _Future(_base.Future):
+    """A future that, rather than blocking, helps its scheduler
+    while waiting for its result.
+    """
 
+    def __init__(self, scheduler):
+        super().__init__()
+        self._scheduler = scheduler
 
-class ThreadPoolExecutor:
+    def result(self, timeout=None):
+        if timeout is None:
+            self._scheduler.help_until(self)
+        return super().result(timeout)
+
+
+class Scheduler:
+    """A bounded pool of long-lived worker threads.
+
+    Nested evaluations (a formula referring to another formula) submit
+    their work into the same scheduler. A thread waiting on a future
+    runs the pending work items of its own evaluation in the meantime
+    (the most recent first, likely its own sub-tasks), so a blocked
+    parent can never starve its children, nor pick up the work of
+    unrelated evaluations.
+
+    The work items belong to the evaluation of the thread which
+    submits them; the worker threads lend themselves to the owner of
+    the item they run, so that nested submissions stay with it.
+    """
 
     def __init__(self, max_workers):
-        self._max_workers = max_workers
-        self._work_queue = queue.SimpleQueue()
+        self.max_workers = max_workers
+        self.pid = os.getpid()
+        self._queue = deque()
+        self._cond = threading.Condition()
         self._threads = set()
+        self._idle = 0
         self._shutdown = False
-        self._shutdown_lock = threading.Lock()
 
     def _worker(self):
         while True:
-            work_item = self._work_queue.get(block=True)
-            if work_item is Stop:
-                # allow the other workers to get it
-                self._work_queue.put(Stop)
-                return
-            work_item.run()
+            with self._cond:
+                while not self._queue:
+                    if self._shutdown:
+                        return
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                work_item = self._queue.popleft()
+            _local.owner = work_item.owner
+            try:
+                work_item.run()
+            finally:
+                _local.owner = None
+            with self._cond:
+                # wake up the waiters of this item
+                self._cond.notify_all()
 
     def submit(self, fn, *args, **kwargs):
-        with self._shutdown_lock:
+        with self._cond:
             if self._shutdown:
                 raise RuntimeError('cannot schedule new futures after shutdown')
 
-            f = _base.Future()
-
-            self._work_queue.put(_WorkItem(f, fn, args, kwargs))
-            num_threads = len(self._threads)
-            if num_threads < self._max_workers:
-                t = threading.Thread(target=self._worker)
+            f = _Future(self)
+            self._queue.append(_WorkItem(f, fn, args, kwargs))
+            if not self._idle and len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._worker, daemon=True)
                 t.start()
                 self._threads.add(t)
+            self._cond.notify_all()
             return f
 
+    def _pop_owned(self, owner):
+        for idx in range(len(self._queue) - 1, -1, -1):
+            if self._queue[idx].owner is owner:
+                work_item = self._queue[idx]
+                del self._queue[idx]
+                return work_item
+
+    def help_until(self, future):
+        owner = _owner()
+        while True:
+            with self._cond:
+                if future.done():
+                    return
+                work_item = self._pop_owned(owner)
+                if work_item is None:
+                    self._cond.wait()
+                    continue
+            work_item.run()
+            with self._cond:
+                self._cond.notify_all()
+
     def shutdown(self):
-        with self._shutdown_lock:
+        with self._cond:
             self._shutdown = True
-            self._work_queue.put(Stop)
-            for t in self._threads:
-                t.join()
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
 
     def __enter__(self):
         return self
@@ -463,3 +597,98 @@ class ThreadPoolExecutor:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.shutdown()
         return False
+
+
+# concurrent reads
+
+class ReadPool:
+    """A bounded pool of connections for the evaluator workers to read
+    the primary series concurrently.
+
+    The transaction connection of the evaluation is lent first. The
+    other connections are opened on demand and read in the snapshot
+    exported by that transaction (at the time the first one is
+    opened), hence all the reads of an evaluation see the same data.
+    When the snapshot cannot be shared (the transaction has written
+    things the others would not see), or when no more connections can
+    be had from the engine, the transaction connection is shared by
+    the readers.
+    """
+
+    def __init__(self, cn, size):
+        self.cn = cn
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = [cn]
+        self._opened = []
+        # None: not exported yet, False: cannot be shared
+        self._snapshot = None
+
+    def _export(self):
+        if self.cn.dialect.name != 'postgresql':
+            return False
+        written = self.cn.execute(
+            'select txid_current_if_assigned()'
+        ).scalar()
+        if written is not None:
+            return False
+        return self.cn.execute(
+            'select pg_export_snapshot()'
+        ).scalar()
+
+    def _spare(self):
+        # do not wait for (nor take the last) connection of a busy
+        # engine pool: the other requests need theirs
+        pool = self.cn.engine.pool
+        if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+            return True
+        return pool.checkedout() < pool.size() + pool._max_overflow - 1
+
+    def _connect(self):
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self._export()
+            if self._snapshot is False:
+                return self.cn
+
+        if not self._spare():
+            return self.cn
+
+        try:
+            cn = self.cn.engine.connect()
+        except SQLAlchemyError:
+            # no more connections to be had
+            return self.cn
+
+        try:
+            tx = cn.begin()
+            cn.execute(
+                'set transaction isolation level repeatable read, read only'
+            )
+            cn.execute(f"set transaction snapshot '{self._snapshot}'")
+        except SQLAlchemyError:
+            cn.close()
+            return self.cn
+
+        with self._lock:
+            self._opened.append((cn, tx))
+        return cn
+
+    @contextmanager
+    def borrow(self):
+        with self._semaphore:
+            with self._lock:
+                cn = self._idle.pop() if self._idle else None
+            if cn is None:
+                cn = self._connect()
+            try:
+                yield cn
+            finally:
+                with self._lock:
+                    self._idle.append(cn)
+
+    def close(self):
+        for cn, tx in self._opened:
+            tx.rollback()
+            cn.close()
+        self._opened = []
@@ -1,17 +1,25 @@
 import json
 import inspect
+from contextlib import contextmanager
 from functools import partial
 from datetime import datetime
 
+import numpy as np
 import pytz
 import pandas as pd
 from psyl.lisp import (
     Env,
-    parse
+    Keyword,
+    parse,
+    Symbol
 )
 
-from tshistory.util import empty_series
-from tshistory_formula.evaluator import pevaluate
+from tshistory.util import (
+    compatible_date,
+    diff,
+    empty_series
+)
+from tshistory_formula.evaluator import compile_plan, pevaluate
 
 from tshistory_formula import (
     helper,
@@ -33,8 +41,11 @@ def jsontypes(all=False):
 
 
 class Interpreter:
-    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'vcache', 'auto')
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'vcache', 'auto',
+                 'leaves', 'readers')
     FUNCS = None
+    # can the primary series be fetched in bulk (see .prefetch)
+    bulk = True
 
     @property
     def operators(self):
@@ -55,19 +66,100 @@ class Interpreter:
         funcs['#t'] = True
         funcs['#f'] = False
         funcs['nil'] = None
+        # the rewritten trees helpers (not operators)
+        funcs['lookback-stamp'] = partial(type(self).lookback_stamp, self)
         self.env = Env(funcs)
         self.histories = {}
         self.vcache = {}
         self.auto = set(registry.AUTO.values())
+        # (name, revision_date, from_value_date, to_value_date) -> series
+        self.leaves = {}
+        # the connections pool of the primary series reads
+        self.readers = None
+
+    @contextmanager
+    def reading(self):
+        """Provide a connection to read primary series, concurrently
+        with the other workers of the evaluation when possible (see
+        helper.ReadPool).
+        """
+        if self.readers is None:
+            yield self.cn
+            return
+        with self.readers.borrow() as cn:
+            yield cn
 
     def get(self, name, getargs):
         # `getarg` likey comes from self.getargs
         # but we allow it being modified hence
         # it comes back as a parameter there
-        return self.tsh.get(self.cn, name, **getargs)
+        if self.readers is None or self.tsh.formula(self.cn, name):
+            # the nested evaluations borrow for their own reads
+            return self.tsh.get(self.cn, name, **getargs)
+        with self.reading() as cn:
+            return self.tsh.get(cn, name, **getargs)
+
+    def last_point(self, name, tstamp, getargs):
+        """Return the latest point of a series at or before `tstamp`
+        (as a series of at most one point), or None when it must be
+        looked for with `.get`.
+        """
+        with self.reading() as cn:
+            return self.tsh.last_point(
+                cn, name, tstamp,
+                revision_date=getargs.get('revision_date')
+            )
+
+    def lookback_stamp(self, __revision_date__, tstamp, points, name):
+        """Return the from_value_date reading `points` points of a
+        primary series before `tstamp`, or None to read it from the
+        start (see registry.lookback_transform).
+        """
+        if tstamp is None or points <= 0:
+            return tstamp
+        with self.reading() as cn:
+            stamp = self.tsh.lookback_stamp(
+                cn, name, tstamp, points, revision_date=__revision_date__
+            )
+        if stamp is None:
+            return None
+        return compatible_date(tstamp.tzinfo is not None, stamp)
 
     def evaluate(self, tree):
-        return pevaluate(tree, self.env, self.auto, self.tsh.concurrency)
+        return pevaluate(
+            tree, self.env, self.auto, self.tsh.concurrency,
+            pool=self.tsh.scheduler
+        )
+
+    def prefetch(self, queries):
+        """Fetch at once the primary series of a list of `(name,
+        revision_date, from_value_date, to_value_date)` queries, for
+        the `series` operator to pick them up.
+        """
+        if not self.bulk or len(queries) < 2:
+            return
+        with self.reading() as cn:
+            self.leaves.update(
+                self.tsh.get_many(cn, queries)
+            )
+
+    def evaluate_plan(self, plan, qargs):
+        env = Env(helper.toplevel_bindings(qargs))
+        env.add_parent(self.env)
+        self.prefetch([
+            (
+                args[0],
+                qargs['revision_date'],
+                qargs['from_value_date'],
+                qargs['to_value_date']
+            )
+            for args, _kwargs, qargs in plan.calls('series', env)
+            if args
+        ])
+        return pevaluate(
+            plan, env, self.auto, self.tsh.concurrency,
+            pool=self.tsh.scheduler
+        )
 
     def today(self, naive, tz):
         if naive:
@@ -117,46 +209,135 @@ class OperatorHistory(Interpreter):
             self.env,
             self.auto,
             self.tsh.concurrency,
-            hist=True
+            hist=True,
+            pool=self.tsh.scheduler
         )
 
 
+def _stamp(date):
+    # utc nanoseconds (naive dates being utc)
+    return pd.Timestamp(date).value
+
+
+class HistoryIndex:
+    """The revisions of a series history, sorted by insertion date for
+    a binary search lookup.
+    """
+    __slots__ = ('idates', 'series')
+
+    def __init__(self, hist):
+        idates = np.array([_stamp(idate) for idate in hist], dtype='int64')
+        order = np.argsort(idates, kind='stable')
+        self.idates = idates[order]
+        series = list(hist.values())
+        self.series = [series[idx] for idx in order]
+
+    def find(self, idate):
+        """Return the series of the nearest inferior or equal
+        insertion date (or None).
+        """
+        idx = np.searchsorted(self.idates, _stamp(idate), side='right')
+        if not idx:
+            return None
+        return self.series[idx - 1]
+
+
+def _naive_utc(stamp):
+    if stamp.tzinfo is None:
+        return stamp
+    return stamp.tz_convert('UTC').tz_localize(None)
+
+
+def _cut(ts, window):
+    tzaware = getattr(ts.index, 'tz', None) is not None
+    return ts.loc[
+        compatible_date(tzaware, window[0]):
+        compatible_date(tzaware, window[1])
+    ]
+
+
 class HistoryInterpreter(Interpreter):
-    __slots__ = 'env', 'cn', 'tsh', 'getargs', 'histories', 'tzaware', 'namecache', 'vcache'
+    __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'tzaware', 'namecache',
+                 'vcache', 'indexes', 'window', 'lastpoints')
+    bulk = False
 
     def __init__(self, name, *args, histories):
         super().__init__(*args)
         self.histories = histories
+        # name -> history index, built on demand
+        # (the histories are completed after the interpreter creation)
+        self.indexes = {}
         # a callsite -> name mapping
         self.namecache = {}
         self.tzaware = self.tsh.internal_metadata(self.cn, name)['tzaware']
+        # value dates restriction of the series (incremental mode)
+        self.window = None
+        # (name, stamp) -> history index of the last points
+        self.lastpoints = {}
+
+    def _index(self, name):
+        index = self.indexes.get(name)
+        if index is None:
+            index = self.indexes[name] = HistoryIndex(self.histories[name])
+        return index
 
     def _find_by_nearest_idate(self, name, idate):
-        hist = self.histories[name]
-        tzaware = idate.tzinfo is not None
-        for date in reversed(list(hist.keys())):
-            compdate = date
-            if not tzaware:
-                compdate = date.replace(tzinfo=None)
-            if idate >= compdate:
-                return hist[date]
-
-        ts = empty_series(
-            self.tzaware,
-            name=name
-        )
+        ts = self._index(name).find(idate)
+        if ts is None:
+            ts = empty_series(
+                self.tzaware,
+                name=name
+            )
         return ts
 
+    def lookback_stamp(self, __revision_date__, tstamp, points, name):
+        # the histories of the series under a lookback are read from
+        # the start (see tsio.history): the points are counted back
+        # in the revision at hand
+        if tstamp is None or points <= 0:
+            return tstamp
+        if name not in self.histories:
+            return None
+        ts = self._find_by_nearest_idate(
+            name,
+            __revision_date__ or self.getargs['revision_date']
+        )
+        tzaware = getattr(ts.index, 'tz', None) is not None
+        ts = ts[ts.index < compatible_date(tzaware, tstamp)]
+        if len(ts) < points:
+            return None
+        return compatible_date(tstamp.tzinfo is not None, ts.index[-points])
+
     def get(self, name, _getargs):
         # getargs is moot there because histories
         # have been precomputed
         # get the nearest inferior or equal for the given
         # insertion date
         assert self.histories
-        return self._find_by_nearest_idate(
+        ts = self._find_by_nearest_idate(
             name,
             self.getargs['revision_date']
         )
+        if self.window:
+            ts = _cut(ts, self.window)
+        return ts
+
+    def last_point(self, name, tstamp, getargs):
+        # the last points of all the revisions are read at once
+        key = (name, tstamp)
+        index = self.lastpoints.get(key)
+        if index is None:
+            revs = self.tsh.last_points(self.cn, name, tstamp)
+            if not revs:
+                return None
+            index = self.lastpoints[key] = HistoryIndex(dict(revs))
+
+        ts = index.find(
+            getargs.get('revision_date') or self.getargs['revision_date']
+        )
+        if ts is None:
+            return index.series[0].iloc[:0]
+        return ts
 
     def get_auto(self, tree):
         """ helper for autotrophic series that have pre built their
@@ -171,12 +352,167 @@ class HistoryInterpreter(Interpreter):
         assert idate
         return self._find_by_nearest_idate(name, idate)
 
+    def fork(self):
+        """Return a copy with its own evaluation state (query
+        arguments, environment, values cache) sharing the prepared
+        histories, for concurrent evaluations at distinct insertion
+        dates.
+        """
+        new = object.__new__(type(self))
+        new.cn = self.cn
+        new.tsh = self.tsh
+        new.getargs = dict(self.getargs)
+        new.histories = self.histories
+        new.indexes = self.indexes
+        new.lastpoints = self.lastpoints
+        new.namecache = self.namecache
+        new.tzaware = self.tzaware
+        new.auto = self.auto
+        new.leaves = {}
+        new.vcache = {}
+        new.readers = None
+        new.window = None
+        # rebind the operators to the fork
+        new.env = Env({
+            key: partial(val.func, new)
+            if isinstance(val, partial) and val.args == (self,)
+            else val
+            for key, val in self.env.items()
+        })
+        return new
+
+    def evaluate_many(self, tree, idates, name, windows=None):
+        """Evaluate the tree at each insertion date, concurrently
+        (in forks) when the tsh has a scheduler.
+
+        The evaluations can be restricted to value dates windows
+        (one per insertion date, None meaning no restriction).
+        """
+        if windows is None:
+            windows = [None] * len(idates)
+        pool = self.tsh.scheduler
+        if pool is None or len(idates) < 2:
+            return {
+                idate: self._evaluate_window(tree, idate, name, window)
+                for idate, window in zip(idates, windows)
+            }
+
+        futures = [
+            pool.submit(
+                self.fork()._evaluate_window, tree, idate, name, window
+            )
+            for idate, window in zip(idates, windows)
+        ]
+        return {
+            idate: future.result()
+            for idate, future in zip(idates, futures)
+        }
+
+    def _evaluate_window(self, tree, idate, name, window):
+        self.window = window
+        try:
+            return self.evaluate(tree, idate, name)
+        finally:
+            self.window = None
+
+    def _changed_window(self, previous, idate):
+        """Return the (naive utc) value dates range of the changes of
+        the series between two insertion dates, or None.
+        """
+        changes = []
+        for name in self.histories:
+            index = self._index(name)
+            old = index.find(previous)
+            new = index.find(idate)
+            if old is new:
+                continue
+            if old is None:
+                changes.append(new.index)
+            elif new is None:
+                changes.append(old.index)
+            else:
+                changes.append(diff(old, new).index)
+                changes.append(old.index.difference(new.index))
+
+        changes = [
+            changed for changed in changes
+            if len(changed)
+        ]
+        if not changes:
+            return None
+
+        return (
+            min(_naive_utc(changed.min()) for changed in changes),
+            max(_naive_utc(changed.max()) for changed in changes)
+        )
+
+    def evaluate_incremental(self, tree, idates, name):
+        """Evaluate the tree at each insertion date, only computing
+        the value dates range touched by the series changes since the
+        previous insertion date, which is patched into the previous
+        result.
+
+        This is only valid for formulas made of pointwise operators
+        (the value at a given value date only depends on the inputs
+        at the same value date).
+        """
+        if not idates:
+            return {}
+
+        windows = [
+            self._changed_window(previous, idate)
+            for previous, idate in zip(idates, idates[1:])
+        ]
+        # the first one is computed entirely
+        todo = [(idates[0], None)] + [
+            (idate, window)
+            for idate, window in zip(idates[1:], windows)
+            if window is not None
+        ]
+        parts = self.evaluate_many(
+            tree,
+            [idate for idate, _ in todo],
+            name,
+            [window for _, window in todo]
+        )
+
+        current = parts[idates[0]]
+        hist = {idates[0]: current}
+        for idate, window in zip(idates[1:], windows):
+            if window is None:
+                current = current.copy()
+            else:
+                tzaware = getattr(current.index, 'tz', None) is not None
+                lo = compatible_date(tzaware, window[0])
+                hi = compatible_date(tzaware, window[1])
+                kept = current.loc[
+                    (current.index < lo) | (current.index > hi)
+                ]
+                part = _cut(parts[idate], window)
+                if len(part) and self.tzaware and part.index.tz is None:
+                    # an empty operand (e.g. in `add`) may
+                    # yield a naive result
+                    part = part.tz_localize('UTC')
+                if not len(kept):
+                    current = part
+                elif not len(part):
+                    current = kept
+                else:
+                    current = pd.concat([kept, part]).sort_index()
+            current.name = name
+            hist[idate] = current
+
+        return hist
+
     def evaluate(self, tree, idate, name):
         # provide ammo to .today
         self.getargs['revision_date'] = idate
         self.env['__name__'] = name
         self.env['__idate__'] = idate
-        ts = pevaluate(tree, self.env, self.auto, self.tsh.concurrency, hist=True)
+        ts = pevaluate(
+            tree, self.env, self.auto, self.tsh.concurrency,
+            hist=True, pool=self.tsh.scheduler
+        )
         ts.name = name
         return ts
 
@@ -184,13 +520,16 @@ class HistoryInterpreter(Interpreter):
 # staircase fast path
 
 
-def has_compatible_operators(cn, tsh, tree, good_operators):
-    operators = [tree[0]]
+def _operators(tree):
+    yield tree[0]
     for param in tree[1:]:
         if isinstance(param, list):
-            operators.append(param[0])
+            yield from _operators(param)
+
+
+def has_compatible_operators(cn, tsh, tree, good_operators):
     if any(op not in good_operators
-           for op in operators):
+           for op in _operators(tree)):
         return False
 
     names = tsh.find_series(cn, tree)
@@ -207,12 +546,21 @@ def has_compatible_operators(cn, tsh, tree, good_operators):
 
 class FastStaircaseInterpreter(Interpreter):
     __slots__ = ('env', 'cn', 'tsh', 'getargs', 'delta')
+    bulk = False
 
     def __init__(self, cn, tsh, getargs, delta):
         assert delta is not None
         super().__init__(cn, tsh, getargs)
         self.delta = delta
 
+    def last_point(self, name, tstamp, getargs):
+        # the staircase points are not those of a revision
+        return None
+
+    def lookback_stamp(self, __revision_date__, tstamp, points, name):
+        # likewise
+        return None
+
     def get(self, name, getargs):
         if self.tsh.type(self.cn, name) == 'primary':
             # true enough, .staircase does not handle revision_date
@@ -252,6 +600,7 @@ class BridgeInterpreter(Interpreter):
     """
     __slots__ = ('env', 'cn', 'tsh', 'getargs', 'histories', 'vcache', 'auto',
                  'groups', 'binding', 'memory_cache')
+    bulk = False
 
     def __init__(self, *args, groups, binding):
         super().__init__(*args)
@@ -276,11 +625,252 @@ class BridgeInterpreter(Interpreter):
         combination = self.env['__combination__']
         return self.groups[family][seriesname][combination[family]]
 
+    def last_point(self, seriesname, tstamp, getargs):
+        if any(self.binding['series'] == seriesname):
+            return None
+        return super().last_point(seriesname, tstamp, getargs)
+
+    def lookback_stamp(self, __revision_date__, tstamp, points, seriesname):
+        if any(self.binding['series'] == seriesname):
+            return None
+        return super().lookback_stamp(
+            __revision_date__, tstamp, points, seriesname
+        )
+
     def g_evaluate(self, text, combination):
         self.env['__combination__'] = combination
-        ts = pevaluate(parse(text), self.env, (), self.tsh.concurrency)
-        ts.name = '.'.join([
-            str(sn)
-            for _, sn, in combination.items()
-        ])
+        ts = pevaluate(
+            parse(text), self.env, (), self.tsh.concurrency,
+            pool=self.tsh.scheduler
+        )
+        ts.name = combination_name(combination)
         return ts
+
+    def b_evaluate(self, tree, combinations, qargs):
+        """Evaluate the hijacked tree for all the scenario combinations
+        at once.
+
+        The bound series are seen as 2d frames (value dates x
+        combinations) and the operators of BROADCAST work on the whole
+        frames. Any other subtree depending on the groups is evaluated
+        once per scenario of the families it depends upon.
+        """
+        val, _opts = self._broadcast(tree, combinations, qargs)
+        val.columns = [
+            combination_name(combination)
+            for combination in combinations
+        ]
+        return val
+
+    def _families(self, tree):
+        if tree[0] == 'series':
+            return {
+                family
+                for family, members in self.groups.items()
+                if tree[1] in members
+            }
+        families = set()
+        for item in tree:
+            if isinstance(item, list):
+                families |= self._families(item)
+        return families
+
+    def _evaluate(self, tree, qargs):
+        return pevaluate(
+            helper.inject_toplevel_bindings(tree, qargs),
+            self.env, (), self.tsh.concurrency,
+            pool=self.tsh.scheduler
+        )
+
+    def _broadcast(self, tree, combinations, qargs):
+        if not isinstance(tree, list):
+            return tree, {}
+
+        families = self._families(tree)
+        if not families:
+            # does not depend on the scenarios: evaluate once
+            val = self._evaluate(tree, qargs)
+            return val, getattr(val, 'options', {})
+
+        if tree[0] in BROADCAST:
+            try:
+                return getattr(self, BROADCAST[tree[0]])(
+                    tree, combinations, qargs
+                )
+            except Unbroadcastable:
+                pass
+
+        return self._per_scenario(tree, families, combinations, qargs)
+
+    def _per_scenario(self, tree, families, combinations, qargs):
+        families = sorted(families)
+        plan = compile_plan(helper.inject_toplevel_bindings(tree, qargs))
+        results = {}
+        keys = []
+        for combination in combinations:
+            key = tuple(combination[family] for family in families)
+            keys.append(key)
+            if key in results:
+                continue
+            self.env['__combination__'] = combination
+            val = pevaluate(
+                plan, self.env, (), self.tsh.concurrency,
+                pool=self.tsh.scheduler
+            )
+            if not isinstance(val, pd.Series):
+                raise Unbroadcastable(tree[0])
+            results[key] = val
+
+        options = next(iter(results.values())).options
+        positions = {key: idx for idx, key in enumerate(results)}
+        df = pd.concat(list(results.values()), axis=1, join='outer')
+        if options.get('fill') is not None and df.isnull().values.any():
+            # the filling must happen on the own index of each
+            # combination
+            raise Unbroadcastable(tree[0])
+        return pd.DataFrame(
+            df.values[:, [positions[key] for key in keys]],
+            index=df.index
+        ), options
+
+    def _b_series(self, tree, combinations, qargs):
+        name = tree[1]
+        options = {'fill': None, 'limit': None}
+        options.update(_constant_kwargs(tree[2:], ('fill', 'limit', 'weight')))
+        family = self.binding.loc[
+            self.binding['series'] == name, 'family'
+        ].iloc[0]
+        df = self.groups[family][name]
+        return pd.DataFrame(
+            df[[combination[family] for combination in combinations]].values,
+            index=df.index
+        ), options
+
+    def _b_options(self, tree, combinations, qargs):
+        options = {'fill': None, 'limit': None}
+        options.update(_constant_kwargs(tree[2:], ('fill', 'limit', 'weight')))
+        val, _opts = self._broadcast(tree[1], combinations, qargs)
+        return val, options
+
+    def _b_scalar(self, tree, combinations, qargs):
+        op, left, right = tree
+        left, lopts = self._broadcast(left, combinations, qargs)
+        right, ropts = self._broadcast(right, combinations, qargs)
+        if op == '/':
+            num, opts = right, lopts
+        else:
+            num, opts = left, ropts
+        if not isinstance(num, (int, float)):
+            raise Unbroadcastable(op)
+        if op == '+':
+            return left + right, opts
+        if op == '*':
+            return left * right, opts
+        return left / right, opts
+
+    def _b_combine(self, tree, combinations, qargs):
+        op = tree[0]
+        operands = [
+            self._broadcast(item, combinations, qargs)
+            for item in tree[1:]
+        ]
+        if not operands or any(
+                not isinstance(val, (pd.Series, pd.DataFrame))
+                for val, _opts in operands):
+            raise Unbroadcastable(op)
+
+        if any(opts.get('fill') is not None for _val, opts in operands):
+            if any(val.isnull().values.any() for val, _opts in operands):
+                # rows missing in some combinations only: the fill
+                # policies must apply per combination
+                raise Unbroadcastable(op)
+
+        index = operands[0][0].index
+        for val, _opts in operands[1:]:
+            index = index.union(val.index)
+
+        arrays = []
+        for val, opts in operands:
+            if opts.get('fill') is None and not len(val):
+                arrays = None
+                break
+            val = _broadcast_fill(val.reindex(index), opts)
+            values = val.values
+            if values.ndim == 1:
+                values = values[:, None]
+            arrays.append(values)
+
+        if arrays is None:
+            return pd.DataFrame(
+                np.empty((0, len(combinations))),
+                index=index[:0]
+            ), {}
+
+        if op == 'add':
+            result = arrays[0]
+            for values in arrays[1:]:
+                result = result + values
+        elif op == 'mul':
+            result = arrays[0]
+            for values in arrays[1:]:
+                result = result * values
+        else:
+            result = arrays[0] / arrays[1]
+
+        df = pd.DataFrame(result, index=index)
+        # the series operators drop the incomplete rows
+        return df.dropna(how='all'), {}
+
+
+class Unbroadcastable(Exception):
+    pass
+
+
+# operators of the bound groups engine working on all the scenarios at
+# once, with the BridgeInterpreter method implementing them
+BROADCAST = {
+    'series': '_b_series',
+    'options': '_b_options',
+    '+': '_b_scalar',
+    '*': '_b_scalar',
+    '/': '_b_scalar',
+    'add': '_b_combine',
+    'mul': '_b_combine',
+    'div': '_b_combine',
+}
+
+
+def combination_name(combination):
+    return '.'.join(
+        str(sn)
+        for sn in combination.values()
+    )
+
+
+def _constant_kwargs(items, allowed):
+    if len(items) % 2:
+        raise Unbroadcastable('positional')
+    kwargs = {}
+    for key, val in zip(items[::2], items[1::2]):
+        if not isinstance(key, Keyword) or key not in allowed:
+            raise Unbroadcastable(key)
+        if isinstance(val, list):
+            raise Unbroadcastable(key)
+        if isinstance(val, Symbol):
+            if val != 'nil':
+                raise Unbroadcastable(key)
+            val = None
+        kwargs[str(key)] = val
+    return kwargs
+
+
+def _broadcast_fill(val, options):
+    # the frame version of funcs._fill
+    filler = options.get('fill')
+    limit = options.get('limit')
+    if isinstance(filler, str):
+        for method in filler.split(','):
+            val = val.fillna(method=method.strip(), limit=limit)
+    elif isinstance(filler, (int, float)):
+        val = val.fillna(value=filler, limit=limit)
+    return val
@@ -2,6 +2,10 @@ import inspect
 from warnings import warn
 
 import pandas as pd
+from psyl.lisp import (
+    buildargs,
+    Symbol
+)
 
 from tshistory_formula.decorator import decorate
 
@@ -13,6 +17,25 @@ METAS = {}
 FINDERS = {}
 AUTO = {}
 ARGSCOPES = {}
+# the operators whose value at a given value date only depends on
+# their inputs values at the same value date: their staircase is
+# the operator applied to the staircases of their inputs
+POINTWISE = set()
+# the elementwise operators which can be fused in chains computed in
+# one pass over the values of a series (see evaluator.fuse)
+KERNELS = {}
+# the operators needing the values of their input series before the
+# requested from_value_date (see lookback)
+LOOKBACKS = {}
+# the variadic operators which can consume the series of a list one
+# at a time (see evaluator.stream)
+REDUCERS = {}
+# the operators yielding a series list which can hand the series over
+# one at a time to a reducer
+STREAMS = {}
+# the operators having a lazy form, materialized by their consumers
+# (see evaluator.defer)
+LAZY = {}
 
 
 def _ensure_options(obj):
@@ -22,7 +45,7 @@ def _ensure_options(obj):
     return obj
 
 
-def func(name, auto=False):
+def func(name, auto=False, pointwise=False):
     # work around the circular import
     from tshistory_formula.types import assert_typed
     from tshistory_formula.interpreter import HistoryInterpreter
@@ -53,6 +76,8 @@ def func(name, auto=False):
         dec = decorate(func, operator, extrakw={'__tree__': None})
 
         FUNCS[name] = dec
+        if pointwise:
+            POINTWISE.add(name)
         if auto:
             AUTO[name] = func
 
@@ -80,6 +105,128 @@ def history(name):
     return decorator
 
 
+def kernel(name, position=0, keep=True):
+    """Register the numpy kernel of an elementwise operator.
+
+    The kernel takes the operator arguments, the series at `position`
+    being replaced by its values array, and returns an array of the
+    same length (or NotImplemented for arguments it cannot handle).
+    With `keep` the result has the name and options of the input
+    series.
+    """
+
+    def decorator(func):
+        KERNELS[name] = (position, keep, func)
+        return func
+
+    return decorator
+
+
+def reducer(name):
+    """Register the streaming form of a variadic operator.
+
+    The decorated function takes the operator keywords and returns an
+    accumulator, whose `.push` method is called with each input series
+    (in no particular order) and `.result` computes the operator
+    value.
+    """
+
+    def decorator(func):
+        REDUCERS[name] = func
+        return func
+
+    return decorator
+
+
+def streams(name):
+    """Register the streaming form of an operator yielding a series
+    list.
+
+    The decorated function takes the arguments of the operator
+    (including the `__interpreter__` and query arguments) and a
+    `consume` callable to be called with each series.
+    """
+
+    def decorator(func):
+        STREAMS[name] = func
+        return func
+
+    return decorator
+
+
+def lazy(name, consumers):
+    """Register the lazy form of an operator, used when its value is
+    only consumed by the `consumers` operators, which must know how to
+    materialize it.
+
+    The decorated function has the signature of the operator.
+    """
+
+    def decorator(func):
+        LAZY[name] = (frozenset(consumers), func)
+        return func
+
+    return decorator
+
+
+def lookback(name):
+    """Declare how far before the requested `from_value_date` an
+    operator needs to read its input series (first argument).
+
+    The decorated function takes the other arguments of the operator
+    call and returns a number of points, or None for the whole past.
+    The requirement is propagated down to the series of the input
+    (see lookback_transform).
+    """
+
+    def decorator(func):
+        LOOKBACKS[name] = func
+        ARGSCOPES[name] = lookback_transform
+        return func
+
+    return decorator
+
+
+def lookback_transform(tree):
+    """Wrap the input of an operator declared with `lookback` in a
+    scope reading enough points of its series before the requested
+    from_value_date.
+
+    The points to count are the ones of the operator input: this only
+    holds for a bare `(series ...)`, any other input (e.g. a resample)
+    being read from the start.
+    """
+    posargs, kwargs = buildargs(tree[1:])
+    if not posargs or not isinstance(tree[1], list):
+        return tree
+
+    series = tree[1]
+    args = posargs[1:] + list(kwargs.values())
+    if (len(series) == 2 and
+        series[0] == 'series' and
+        isinstance(series[1], str) and
+        not any(isinstance(arg, list) for arg in args)):
+        points = LOOKBACKS[tree[0]](*posargs[1:], **kwargs)
+    else:
+        points = None
+
+    if points is None:
+        bound = Symbol('nil')
+    else:
+        # see Interpreter.lookback_stamp
+        bound = [
+            Symbol('lookback-stamp'),
+            Symbol('from_value_date'),
+            points,
+            series[1]
+        ]
+
+    return [
+        tree[0],
+        [Symbol('let'), Symbol('from_value_date'), bound, series]
+    ] + tree[2:]
+
+
 def insertion_dates(name):
 
     def decorator(func):
@@ -1,15 +1,25 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
 import hashlib
 import itertools
 import json
 import logging
+import os
+import threading
+import zlib
 
 import pandas as pd
 from psyl.lisp import parse, serialize, Symbol
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from tshistory.tsio import timeseries as basets
 from tshistory.util import (
+    binary_unpack,
+    compatible_date,
     diff,
+    empty_series,
+    numpy_deserialize,
     patch,
     tx
 )
@@ -17,6 +27,7 @@ from tshistory.util import (
 from tshistory_formula import funcs, gfuncs  # trigger registration
 from tshistory_formula import (
     api,  # trigger extension
+    evaluator,
     interpreter,
     helper,
     types
@@ -27,6 +38,7 @@ from tshistory_formula.registry import (
     HISTORY,
     IDATES,
     METAS,
+    POINTWISE,
     GFINDERS,
     GAUTO,
     GIDATES,
@@ -37,6 +49,40 @@ from tshistory_formula.registry import (
 L = logging.getLogger('tshistory.tsio')
 
 
+# engine -> number of profiles counting its queries
+_COUNTING = {}
+_COUNTING_LOCK = threading.Lock()
+
+
+@contextmanager
+def _counting_queries(engine):
+    # the sql statements of an engine are counted (see
+    # evaluator.count_query) while a profile is running on it
+    with _COUNTING_LOCK:
+        if not _COUNTING.get(engine):
+            event.listen(
+                engine, 'before_cursor_execute', evaluator.count_query
+            )
+        _COUNTING[engine] = _COUNTING.get(engine, 0) + 1
+    try:
+        yield
+    finally:
+        with _COUNTING_LOCK:
+            _COUNTING[engine] -= 1
+            if not _COUNTING[engine]:
+                del _COUNTING[engine]
+                event.remove(
+                    engine, 'before_cursor_execute', evaluator.count_query
+                )
+
+
+def _members(df, members):
+    # the group columns of a members filter (None: all of them)
+    if members is None or df is None:
+        return df
+    return df[[col for col in df.columns if col in members]]
+
+
 class timeseries(basets):
 
     def __init__(self, *a, **kw):
@@ -44,10 +90,45 @@ class timeseries(basets):
         self.patch = basets(
             namespace='{}-formula-patch'.format(self.namespace)
         )
+        # name -> (contenthash, compiled plan)
+        self.plans = helper.LRUCache(self.cachesize)
+        # (name, scopes) -> (contenthash, expanded tree)
+        self.expansions = helper.LRUCache(self.cachesize)
+        # id(transaction) -> read connections pool
+        self._readpools = {}
 
     fast_staircase_operators = set(['+', '*', 'series', 'add', 'priority'])
+    # pointwise operators (plus the let-bindings helpers)
+    incremental_history_operators = set([
+        'add', '+', '*', '/', 'priority', 'slice', 'series',
+        'date', 'min', 'max'
+    ])
     metadata_compat_excluded = ()
     concurrency = 16
+    # the number of formulas whose plan (and expansions) are kept
+    # at hand
+    cachesize = 1024
+    # the maximum number of connections reading the primary series
+    # of an evaluation concurrently (see helper.ReadPool), the
+    # default being to read everything through the transaction
+    readers = 1
+    _scheduler = None
+
+    @property
+    def scheduler(self):
+        """The evaluation scheduler shared by all the (nested)
+        evaluations done through this instance.
+        """
+        if self.concurrency <= 1:
+            return None
+
+        scheduler = self._scheduler
+        if (scheduler is None or
+            scheduler.pid != os.getpid() or
+            scheduler.max_workers != self.concurrency):
+            # first use, forked process or new settings
+            scheduler = self._scheduler = helper.Scheduler(self.concurrency)
+        return scheduler
 
     def find_series(self, cn, tree):
         op = tree[0]
@@ -254,6 +335,8 @@ class timeseries(basets):
         meta['contenthash'] = ch
         self._register_formula(cn, name, meta, exists)
         self.register_dependents(cn, name, tree)
+        # our dependents embed our expanded content
+        self._refresh_content_hash(cn, self.dependents(cn, name))
 
     def _register_formula(self, cn, name, seriesmeta, exists):
         if exists:
@@ -273,6 +356,7 @@ class timeseries(basets):
                 name,
                 json.dumps(seriesmeta)
             )
+        self._invalidate_registry(cn, name)
 
     def live_content_hash(self, cn, name):
         return hashlib.sha1(
@@ -284,6 +368,16 @@ class timeseries(basets):
             ).encode()
         ).hexdigest()
 
+    def _refresh_content_hash(self, cn, names):
+        # these expansions are obsolete, but their
+        # content hash does not tell (yet)
+        self._invalidate_expansions(*names)
+        for name in names:
+            self.update_internal_metadata(
+                cn, name,
+                {'contenthash': self.live_content_hash(cn, name)}
+            )
+
     def default_meta(self, tzaware):
         if tzaware:
             return {
@@ -301,21 +395,47 @@ class timeseries(basets):
             'value_type': 'float64'
         }
 
-    def content_hash(self, cn, name):
-        return cn.execute(
-            f'select internal_metadata->\'contenthash\' '
+    # registry entries
+
+    def _registry_entry(self, cn, name):
+        """Return the registry entry of a name, through the cache that
+        the api points keep on the connection (see tshistory.util.tx).
+        """
+        cache = getattr(cn, 'cache', None)
+        # the patch store shares the connection
+        key = (self.namespace, name)
+        if cache is not None and key in cache['internal_metadata']:
+            return cache['internal_metadata'][key]
+
+        imeta = cn.execute(
+            'select internal_metadata '
             f'from "{self.namespace}".registry '
-            f'where name=%(name)s',
+            'where name = %(name)s',
             name=name
         ).scalar()
+        if cache is not None:
+            cache['internal_metadata'][key] = imeta
+        return imeta
+
+    def _invalidate_registry(self, cn, *names):
+        cache = getattr(cn, 'cache', None)
+        if cache is None:
+            return
+        for name in names:
+            cache['internal_metadata'].pop((self.namespace, name), None)
+
+    @tx
+    def internal_metadata(self, cn, name):
+        # the entry is updated in place by update_internal_metadata
+        return self._registry_entry(cn, name)
+
+    def content_hash(self, cn, name):
+        imeta = self._registry_entry(cn, name)
+        return imeta and imeta.get('contenthash')
 
     def formula(self, cn, name):
-        return cn.execute(
-            f'select internal_metadata->\'formula\' '
-            f'from "{self.namespace}".registry '
-            f'where name = %(name)s',
-            name=name
-        ).scalar()
+        imeta = self._registry_entry(cn, name)
+        return imeta and imeta.get('formula')
 
     def list_series(self, cn):
         series = super().list_series(cn)
@@ -336,20 +456,28 @@ class timeseries(basets):
         return super().type(cn, name)
 
     def exists(self, cn, name):
-        return super().exists(cn, name) or bool(self.formula(cn, name))
+        imeta = self._registry_entry(cn, name)
+        return bool(
+            imeta and (imeta.get('tablename') or imeta.get('formula'))
+        )
 
     @tx
     def delete(self, cn, name):
         if self.type(cn, name) != 'formula':
             return super().delete(cn, name)
 
+        dependents = self.dependents(cn, name)
         cn.execute(
             f'delete from "{self.namespace}".registry '
             'where name = %(name)s',
             name=name
         )
+        self._invalidate_registry(cn, name)
         if self.patch.exists(cn, name):
             self.patch.delete(cn, name)
+        self.plans.pop(name, None)
+        self._invalidate_expansions(name)
+        self._refresh_content_hash(cn, dependents)
 
     def update(self, cn, updatets, name, author, **k):
         if self.type(cn, name) == 'formula':
@@ -357,10 +485,21 @@ class timeseries(basets):
         return super().update(cn, updatets, name, author, **k)
 
     @tx
-    def get(self, cn, name, **kw):
+    def get(self, cn, name, __profile__=False, **kw):
+        if __profile__:
+            with _counting_queries(cn.engine):
+                with evaluator.profiling(name, kind='get') as record:
+                    ts = self.get(cn, name, **kw)
+            return ts, record.report()
+
         formula = self.formula(cn, name)
         if formula:
-            ts = self.eval_formula(cn, formula, **kw)
+            plan = self.formula_plan(cn, name, formula)
+            if evaluator.profiled():
+                with evaluator.profiling(name):
+                    ts = self._eval_plan(cn, plan, **kw)
+            else:
+                ts = self._eval_plan(cn, plan, **kw)
             if ts is not None:
                 ts.name = name
             if self.patch.exists(cn, name):
@@ -378,13 +517,397 @@ class timeseries(basets):
 
         return ts
 
-    def eval_formula(self, cn, formula, **kw):
-        i = kw.get('__interpreter__') or interpreter.Interpreter(cn, self, kw)
-        ts = i.evaluate(
-            self._expanded_formula(cn, formula, qargs=kw)
+    @tx
+    def get_many(self, cn, queries):
+        """Fetch a batch of primary series at once.
+
+        The `queries` are `(name, revision_date, from_value_date,
+        to_value_date)` tuples. The registry entries, the revision
+        heads and the snapshot chunks of all the series are each
+        obtained with one set-based query (instead of half a dozen
+        queries per series through `.get`).
+
+        Returns a mapping from the queries to the series. The
+        formulas and the unknown names are left out.
+        """
+        names = {query[0] for query in queries}
+        if not names:
+            return {}
+
+        metas = {
+            name: imeta
+            for name, imeta in cn.execute(
+                'select name, internal_metadata '
+                f'from "{self.namespace}".registry '
+                'where name in %(names)s',
+                names=tuple(names)
+            ).fetchall()
+            if imeta and imeta.get('tablename')
+        }
+        queries = [
+            query for query in dict.fromkeys(queries)
+            if query[0] in metas
+        ]
+        if not queries:
+            return {}
+
+        # revision heads
+        heads = []
+        params = {}
+        for idx, (name, revdate, fromdate, todate) in enumerate(queries):
+            self._guard_query_dates(revdate, fromdate, todate)
+            where = ''
+            if revdate:
+                where = f'where insertion_date <= %(idate{idx})s '
+                params[f'idate{idx}'] = revdate
+            heads.append(
+                f'(select {idx} as idx, snapshot '
+                f'from "{self.namespace}.revision"."{metas[name]["tablename"]}" '
+                f'{where}'
+                'order by id desc limit 1)'
+            )
+        heads = dict(
+            cn.execute(' union all '.join(heads), **params).fetchall()
         )
+
+        # snapshot chunks
+        ctes = []
+        selects = []
+        params = {}
+        for idx, head in heads.items():
+            name, _revdate, fromdate, _todate = queries[idx]
+            table = (
+                f'"{self.namespace}.snapshot"."{metas[name]["tablename"]}"'
+            )
+            where = ''
+            if fromdate:
+                where = f'where chunks.cend >= %(start{idx})s '
+                params[f'start{idx}'] = compatible_date(
+                    metas[name]['tzaware'], fromdate
+                )
+            ctes.append(
+                f'c{idx} as ('
+                f' select id as cid, parent, chunk from {table}'
+                f' where id = {head}'
+                ' union'
+                ' select chunks.id, chunks.parent, chunks.chunk'
+                f' from {table} as chunks'
+                f' join c{idx} on chunks.id = c{idx}.parent'
+                f' {where}'
+                ')'
+            )
+            selects.append(
+                f'select {idx} as idx, cid, parent, chunk from c{idx}'
+            )
+        chunks = defaultdict(dict)
+        if ctes:
+            sql = (
+                f'with recursive {", ".join(ctes)} '
+                f'{" union all ".join(selects)}'
+            )
+            for idx, cid, parent, chunk in cn.execute(sql, **params).fetchall():
+                chunks[idx][cid] = (parent, chunk)
+
+        result = {}
+        for idx, query in enumerate(queries):
+            name, _revdate, fromdate, todate = query
+            meta = metas[name]
+            if idx not in heads:
+                result[query] = empty_series(
+                    meta['tzaware'],
+                    dtype=meta['value_type'],
+                    name=name
+                )
+                continue
+
+            result[query] = self._chunks_to_series(
+                name, meta, heads[idx], chunks[idx], fromdate, todate
+            )
+
+        return result
+
+    def _chunks_to_series(self, name, meta, head, chunks, fromdate, todate):
+        # walk the chunks from the head down to the
+        # oldest one matching the date restriction
+        rawchunks = []
+        cid = head
+        while cid in chunks:
+            cid, chunk = chunks[cid]
+            rawchunks.append(chunk)
+        rawchunks.reverse()
+
+        indexchunks, valueschunks = list(zip(*(
+            binary_unpack(zlib.decompress(chunk))
+            for chunk in rawchunks
+        )))
+        bseparator = b'\0' if meta['value_type'] == 'object' else b''
+        index, values = numpy_deserialize(
+            b''.join(indexchunks),
+            bseparator.join(valueschunks),
+            meta
+        )
+        ts = pd.Series(values, index=index, name=name)
+        if meta['tzaware']:
+            ts = ts.tz_localize('UTC')
+
+        ts = ts.loc[
+            compatible_date(meta['tzaware'], fromdate):
+            compatible_date(meta['tzaware'], todate)
+        ].dropna()
+        ts.name = name
         return ts
 
+    @tx
+    def last_point(self, cn, name, tstamp, revision_date=None):
+        """Return the latest point of a primary series at or before
+        `tstamp` (as of `revision_date`), as a series of at most one
+        point.
+
+        Only the snapshot chunk holding this point is read (rather
+        than probing the series with `.get` calls over growing
+        periods). Returns None for the formulas and the unknown
+        series.
+        """
+        meta = self._primary_meta(cn, name)
+        if meta is None:
+            return None
+
+        self._guard_query_dates(revision_date, tstamp)
+        where = ''
+        if revision_date:
+            where = 'where insertion_date <= %(idate)s '
+        head = cn.execute(
+            'select snapshot '
+            f'from "{self.namespace}.revision"."{meta["tablename"]}" '
+            f'{where}'
+            'order by id desc limit 1',
+            idate=revision_date
+        ).scalar()
+        if head is None:
+            return empty_series(
+                meta['tzaware'], dtype=meta['value_type'], name=name
+            )
+
+        return self._last_points(cn, name, meta, tstamp, [head])[head]
+
+    @tx
+    def lookback_stamp(self, cn, name, tstamp, points, revision_date=None):
+        """Return the stamp of the `points`-th point of a primary
+        series before `tstamp` (as of `revision_date`): read from
+        there, the series has that many points before `tstamp`.
+
+        The snapshot chunks are walked backwards from `tstamp` with
+        one query: each chunk starting before the stamp holds a point
+        before it, hence at most `points` chunks are read. Returns
+        None for the formulas, the unknown series and when there are
+        not that many points.
+        """
+        meta = self._primary_meta(cn, name)
+        if meta is None:
+            return None
+
+        self._guard_query_dates(revision_date, tstamp)
+        table = f'"{self.namespace}.snapshot"."{meta["tablename"]}"'
+        where = ''
+        if revision_date:
+            where = 'where insertion_date <= %(idate)s '
+        stamp = compatible_date(meta['tzaware'], tstamp)
+        sql = (
+            'with recursive chain as ('
+            ' select id, parent, cstart,'
+            '        case when cstart < %(stamp)s then chunk end as chunk'
+            f' from {table}'
+            ' where id = ('
+            '  select snapshot'
+            f'  from "{self.namespace}.revision"."{meta["tablename"]}" '
+            f'  {where}'
+            '  order by id desc limit 1'
+            ' )'
+            ' union all'
+            ' select chunks.id, chunks.parent, chunks.cstart,'
+            '        case when chunks.cstart < %(stamp)s then chunks.chunk end'
+            f' from {table} as chunks'
+            ' join chain on chunks.id = chain.parent'
+            ') select id, parent, chunk from chain'
+            ' where cstart < %(stamp)s'
+            ' limit %(points)s'
+        )
+        rows = cn.execute(
+            sql, stamp=stamp, idate=revision_date, points=points
+        ).fetchall()
+        if not rows:
+            return None
+
+        ts = self._chunks_to_series(
+            name, meta, rows[0][0],
+            {cid: (parent, chunk) for cid, parent, chunk in rows},
+            None, tstamp
+        )
+        ts = ts[ts.index < stamp]
+        if len(ts) < points:
+            return None
+        return ts.index[-points]
+
+    @tx
+    def last_points(self, cn, name, tstamp, to_insertion_date=None):
+        """Return the `(insertion date, point)` of the revisions of a
+        primary series (up to `to_insertion_date`) with, for each of
+        them, the point `.last_point` would return.
+
+        The revisions sharing their snapshot chunks, each chunk is
+        read once. Returns None for the formulas and the unknown
+        series.
+        """
+        meta = self._primary_meta(cn, name)
+        if meta is None:
+            return None
+
+        self._guard_query_dates(to_insertion_date, tstamp)
+        where = ''
+        if to_insertion_date:
+            where = 'where insertion_date <= %(idate)s '
+        revs = cn.execute(
+            'select insertion_date, snapshot '
+            f'from "{self.namespace}.revision"."{meta["tablename"]}" '
+            f'{where}'
+            'order by id',
+            idate=to_insertion_date
+        ).fetchall()
+        if not revs:
+            return []
+
+        points = self._last_points(
+            cn, name, meta, tstamp, {head for _, head in revs}
+        )
+        return [
+            (pd.Timestamp(idate).astimezone('UTC'), points[head])
+            for idate, head in revs
+        ]
+
+    def _primary_meta(self, cn, name):
+        if not self.exists(cn, name) or self.type(cn, name) != 'primary':
+            return None
+        meta = self.internal_metadata(cn, name)
+        if not meta or not meta.get('tablename'):
+            return None
+        return meta
+
+    def _last_points(self, cn, name, meta, tstamp, heads):
+        # walk the chunks chains from the heads down to the first chunk
+        # starting before the stamp: its points hold the latest one
+        # (but when they are all erased: then we go on with the parent)
+        table = f'"{self.namespace}.snapshot"."{meta["tablename"]}"'
+        tstamp = compatible_date(meta['tzaware'], tstamp)
+        sql = (
+            'with recursive chain as ('
+            ' select id, parent, cstart <= %(stamp)s as before,'
+            '        case when cstart <= %(stamp)s then chunk end as chunk'
+            f' from {table} where id in %(ids)s'
+            ' union'
+            ' select chunks.id, chunks.parent, chunks.cstart <= %(stamp)s,'
+            '        case when chunks.cstart <= %(stamp)s then chunks.chunk end'
+            f' from {table} as chunks'
+            ' join chain on chunks.id = chain.parent'
+            ' where not chain.before'
+            ') select id, parent, before, chunk from chain'
+        )
+        result = {}
+        decoded = {}
+        pending = {head: head for head in heads}
+        while pending:
+            chunks = {
+                cid: (parent, before, chunk)
+                for cid, parent, before, chunk in cn.execute(
+                        sql, stamp=tstamp, ids=tuple(set(pending.values()))
+                ).fetchall()
+            }
+            walking = {}
+            for head, cid in pending.items():
+                while cid is not None and not chunks[cid][1]:
+                    cid = chunks[cid][0]
+                if cid is None:
+                    result[head] = empty_series(
+                        meta['tzaware'], dtype=meta['value_type'], name=name
+                    )
+                    continue
+
+                if cid not in decoded:
+                    decoded[cid] = self._chunks_to_series(
+                        name, meta, cid, {cid: (None, chunks[cid][2])},
+                        None, tstamp
+                    )
+                if len(decoded[cid]):
+                    result[head] = decoded[cid].iloc[-1:]
+                    continue
+
+                parent = chunks[cid][0]
+                if parent is None:
+                    result[head] = decoded[cid]
+                    continue
+                walking[head] = parent
+            pending = walking
+
+        return result
+
+    def eval_formula(self, cn, formula, **kw):
+        return self._eval_plan(
+            cn, self._formula_plan(cn, formula), **kw
+        )
+
+    def _eval_plan(self, cn, plan, **kw):
+        i = kw.get('__interpreter__')
+        if i is not None:
+            return i.evaluate_plan(plan, kw)
+
+        i = interpreter.Interpreter(cn, self, kw)
+        with self._readpool(cn) as readers:
+            i.readers = readers
+            return i.evaluate_plan(plan, kw)
+
+    @contextmanager
+    def _readpool(self, cn):
+        """Provide the pool of read connections of an evaluation
+        transaction, shared by the nested evaluations.
+        """
+        pool = self._readpools.get(id(cn))
+        if (pool is not None or
+            self.concurrency <= 1 or
+            self.readers <= 1 or
+            isinstance(cn, Engine)):
+            yield pool
+            return
+
+        pool = self._readpools[id(cn)] = helper.ReadPool(cn, self.readers)
+        try:
+            yield pool
+        finally:
+            del self._readpools[id(cn)]
+            pool.close()
+
+    def _formula_plan(self, cn, formula):
+        return evaluator.compile_plan(
+            helper.expanded(self, cn, parse(formula), scopes=True)
+        )
+
+    def formula_plan(self, cn, name, formula):
+        """Return the compiled evaluation plan of a named formula.
+
+        Plans are cached by content hash: a hit skips the expansion
+        and the tree interpretation altogether.
+        """
+        ch = self.content_hash(cn, name)
+        if ch is None:
+            # not migrated to content hashes
+            return self._formula_plan(cn, formula)
+
+        cached = self.plans.get(name)
+        if cached is not None and cached[0] == ch:
+            return cached[1]
+
+        plan = self._formula_plan(cn, formula)
+        self.plans[name] = (ch, plan)
+        return plan
+
     def _expanded_formula(self, cn, formula, stopnames=(), qargs=None):
         exp = helper.expanded(
             self,
@@ -400,6 +923,32 @@ class timeseries(basets):
             )
         return exp
 
+    def expanded_tree(self, cn, name, scopes=True):
+        """Return the fully expanded tree of a named formula.
+
+        The expansions are cached by content hash: a formula stack
+        is expanded once, each level reusing the expansions of the
+        levels below. A copy is returned since the callers embed it
+        in their own trees.
+        """
+        ch = self.content_hash(cn, name)
+        key = (name, scopes)
+        cached = self.expansions.get(key)
+        if ch is not None and cached is not None and cached[0] == ch:
+            return helper.copytree(cached[1])
+
+        tree = helper.expanded(
+            self, cn, parse(self.formula(cn, name)), scopes=scopes
+        )
+        if ch is not None:
+            self.expansions[key] = (ch, tree)
+        return helper.copytree(tree)
+
+    def _invalidate_expansions(self, *names):
+        for name in names:
+            for scopes in (True, False):
+                self.expansions.pop((name, scopes), None)
+
     def expanded_formula(self, cn, name, stopnames=(), **kw):
         formula = self.formula(cn, name)
         if formula is None:
@@ -509,6 +1058,7 @@ class timeseries(basets):
             self, cn, histmap, tree,
             from_value_date=None,
             to_value_date=None,
+            reach=None,
             **kw):
         """
         Complete the potentially missing entries of the collected histories.
@@ -549,7 +1099,7 @@ class timeseries(basets):
                     cn,
                     name,
                     revision_date=mindate,
-                    from_value_date=from_value_date,
+                    from_value_date=(reach or {}).get(name, from_value_date),
                     to_value_date=to_value_date,
                     **kw
                 )
@@ -663,13 +1213,16 @@ class timeseries(basets):
 
         # normal history: compute the union of the histories
         # of all underlying series
+        # (some of them being read before from_value_date)
         series = self.find_series(cn, tree)
+        lastpoints = {}
+        reach = self._history_reach(cn, tree, from_value_date, lastpoints)
         histmap = {
             name: self.history(
                 cn, name,
                 from_insertion_date=from_insertion_date,
                 to_insertion_date=to_insertion_date,
-                from_value_date=from_value_date,
+                from_value_date=reach.get(name, from_value_date),
                 to_value_date=to_value_date,
                 **kw
             ) or {}
@@ -683,6 +1236,7 @@ class timeseries(basets):
                 cn, histmap, tree,
                 from_value_date=from_value_date,
                 to_value_date=to_value_date,
+                reach=reach,
                 **kw
             )
 
@@ -695,6 +1249,10 @@ class timeseries(basets):
             },
             histories=histmap
         )
+        hi.lastpoints.update({
+            key: interpreter.HistoryIndex(dict(revs))
+            for key, revs in lastpoints.items()
+        })
 
         # delegate work for the autotrophic operator histories
         # this was not done in the previous step because
@@ -710,17 +1268,26 @@ class timeseries(basets):
         )
 
         # evaluate the formula using the prepared histories
+        # (and the revisions of the integration stocks points
+        # before from_value_date)
         idates = sorted({
             idate
             for hist in histmap.values()
             for idate in hist
+        } | {
+            idate
+            for revs in lastpoints.values()
+            for idate, _ts in revs
+            if (from_insertion_date is None or idate >= from_insertion_date) and
+            (to_insertion_date is None or idate <= to_insertion_date)
         })
 
         # build the final history dict
-        hist = {
-            idate: hi.evaluate(tree, idate, name)
-            for idate in idates
-        }
+        plan = evaluator.compile_plan(tree)
+        if self._incremental_history(plan):
+            hist = hi.evaluate_incremental(plan, idates, name)
+        else:
+            hist = hi.evaluate_many(plan, idates, name)
 
         if diffmode and idates:
             hist = self._history_diffs(
@@ -732,6 +1299,70 @@ class timeseries(basets):
 
         return hist
 
+    def _lookback_series(self, cn, tree):
+        """Return the names of the series read before the requested
+        from_value_date by the operators declared with a lookback
+        (see registry.lookback_transform).
+        """
+        if (tree[0] == 'let' and
+            len(tree) == 4 and
+            tree[1] == 'from_value_date' and
+            (tree[2] == 'nil' or
+             isinstance(tree[2], list) and tree[2][0] == 'lookback-stamp')):
+            return set(self.find_series(cn, tree[3]))
+
+        names = set()
+        for item in tree:
+            if isinstance(item, list):
+                names |= self._lookback_series(cn, item)
+        return names
+
+    def _history_reach(self, cn, tree, from_value_date, lastpoints):
+        """Return the value dates from which the histories of some
+        series must be read, before the requested from_value_date: the
+        series under a lookback are read from the start and the flows
+        of the integrations from the earliest last point of their stock
+        (the revisions of the stock last points are collected in
+        `lastpoints`, see HistoryInterpreter.last_point).
+        """
+        if from_value_date is None:
+            return {}
+
+        reach = dict.fromkeys(self._lookback_series(cn, tree))
+        for site in self.find_callsites(cn, 'integration', tree):
+            stock, flow = site[1], site[2]
+            revs = self.last_points(cn, stock, from_value_date)
+            if not revs:
+                continue
+            lastpoints[(stock, from_value_date)] = revs
+            stamps = [
+                compatible_date(from_value_date.tzinfo is not None, ts.index[0])
+                for _idate, ts in revs
+                if len(ts)
+            ]
+            if not stamps or flow in reach and reach[flow] is None:
+                continue
+            reach[flow] = min(stamps + [reach.get(flow, from_value_date)])
+        return reach
+
+    def _incremental_history(self, plan):
+        for node in plan.nodes:
+            ops = node.opnames()
+            if not ops or node.splice:
+                return False
+            if any(op not in self.incremental_history_operators
+                   for op in ops):
+                return False
+            op = ops[0]
+            if op == 'series':
+                # the fill policies propagate values across value dates
+                if 'limit' in node.kwargs:
+                    return False
+                kind, fill = node.kwargs.get('fill', (evaluator.CONST, None))
+                if kind != evaluator.CONST or fill in ('ffill', 'bfill'):
+                    return False
+        return True
+
     @tx
     def insertion_dates(self, cn, name,
                         from_insertion_date=None,
@@ -846,7 +1477,7 @@ class timeseries(basets):
             if interpreter.has_compatible_operators(
                     cn, self,
                     parse(formula),
-                    self.fast_staircase_operators):
+                    self.fast_staircase_operators | POINTWISE):
                 # go fast
                 return self.get(
                     cn, name,
@@ -907,6 +1538,7 @@ class timeseries(basets):
                 series = False
             return newtree
 
+        toedit = []
         for fname, text in formulas:
             tree = parse(text)
             series = self.find_series(
@@ -915,23 +1547,33 @@ class timeseries(basets):
             )
             if newname in series:
                 errors.append(fname)
-            if oldname not in series or errors:
-                continue
+            if oldname in series:
+                toedit.append((fname, tree))
+
+        # check everything before editing anything
+        if errors:
+            raise ValueError(
+                f'new name is already referenced by `{",".join(errors)}`'
+            )
 
+        for fname, tree in toedit:
             newtree = edit(tree, oldname, newname)
             newtext = serialize(newtree)
             # updating using jsonb_set is such a PITA ... we for now
             # prefer to be slightly more expensive
             self.update_internal_metadata(cn, fname, {'formula': newtext})
 
-        if errors:
-            raise ValueError(
-                f'new name is already referenced by `{",".join(errors)}`'
-            )
-
         if self.patch.exists(cn, oldname):
             self.patch.rename(cn, oldname, newname)
         super().rename(cn, oldname, newname)
+        self.plans.pop(oldname, None)
+        self._invalidate_expansions(oldname)
+
+        # the edited formulas and their dependents have a new content
+        edited = {fname for fname, _tree in toedit}
+        for fname, _tree in toedit:
+            edited.update(self.dependents(cn, fname))
+        self._refresh_content_hash(cn, sorted(edited))
 
     # groups
 
@@ -1137,7 +1779,12 @@ class timeseries(basets):
     def group_get(self, cn, groupname,
                   revision_date=None,
                   from_value_date=None,
-                  to_value_date=None):
+                  to_value_date=None,
+                  members=None):
+        # members: when provided, only these columns are returned
+        # (only the primary groups read just them: the values of the
+        # formula and bound groups depend on all their members)
+
         # case of formula
         formula = self.group_formula(cn, groupname)
         if formula:
@@ -1160,16 +1807,29 @@ class timeseries(basets):
                 df.columns = [str(col) for col in df.columns]
             if df.index.name:
                 df.index.name = None
-            return df
+            return _members(df, members)
 
         bindinfo = self.bindings_for(
             cn, groupname
         )
         if bindinfo:
-            return self._hijacked_formula(
+            return _members(
+                self._hijacked_formula(
+                    cn,
+                    bindinfo[0],
+                    bindinfo[1],
+                    revision_date=revision_date,
+                    from_value_date=from_value_date,
+                    to_value_date=to_value_date
+                ),
+                members
+            )
+
+        if members is not None:
+            return self._primary_group_members(
                 cn,
-                bindinfo[0],
-                bindinfo[1],
+                groupname,
+                members,
                 revision_date=revision_date,
                 from_value_date=from_value_date,
                 to_value_date=to_value_date
@@ -1183,6 +1843,22 @@ class timeseries(basets):
             to_value_date=to_value_date
         )
 
+    def _primary_group_members(self, cn, name, members, **getargs):
+        if not self.group_exists(cn, name):
+            return None
+
+        allseries = []
+        for colname, seriesname in self._group_info(cn, name):
+            if colname not in members:
+                continue
+            ts = self.tsh_group.get(cn, seriesname, **getargs)
+            ts.name = colname
+            allseries.append(ts)
+
+        if not allseries:
+            return pd.DataFrame()
+        return pd.concat(allseries, axis=1)
+
     def find_groups_and_series(self, cn, tree):
         op = tree[0]
         super_finder = dict(GFINDERS, **FINDERS)
@@ -1283,7 +1959,8 @@ class timeseries(basets):
                       from_value_date=None,
                       to_value_date=None,
                       from_insertion_date=None,
-                      to_insertion_date=None):
+                      to_insertion_date=None,
+                      members=None):
         idates = self.group_insertion_dates(
             cn,
             name,
@@ -1294,16 +1971,50 @@ class timeseries(basets):
             return None
         if not len(idates):
             return {}
-        history = {}
-        for idate in idates:
-            history[idate] = self.group_get(
+
+        bindinfo = self.bindings_for(cn, name)
+        if bindinfo:
+            return {
+                idate: _members(df, members)
+                for idate, df in self._hijacked_history(
+                    cn,
+                    bindinfo[0],
+                    bindinfo[1],
+                    idates,
+                    from_value_date=from_value_date,
+                    to_value_date=to_value_date
+                ).items()
+            }
+
+        return self._group_revisions(
+            lambda idate: self.group_get(
                 cn,
                 name,
                 from_value_date=from_value_date,
                 to_value_date=to_value_date,
-                revision_date=idate
-            )
-        return history
+                revision_date=idate,
+                members=members
+            ),
+            idates
+        )
+
+    def _group_revisions(self, func, idates):
+        # compute the revisions concurrently when possible
+        pool = self.scheduler
+        if pool is None or len(idates) < 2:
+            return {
+                idate: func(idate)
+                for idate in idates
+            }
+
+        futures = [
+            pool.submit(func, idate)
+            for idate in idates
+        ]
+        return {
+            idate: future.result()
+            for idate, future in zip(idates, futures)
+        }
 
     # group formula binding
 
@@ -1395,84 +2106,184 @@ class timeseries(basets):
                 groupname,
                 from_value_date=from_value_date,
                 to_value_date=to_value_date,
-                revision_date=revision_date,
+                revision_date=revision_date
             ),
             family
         )
 
-    @tx
-    def _hijacked_formula(self, cn, name, binding,
-                          from_value_date=None,
-                          to_value_date=None,
-                          revision_date=None):
+    def _hijacked_tree(self, cn, name, binding):
         # find all the series in the formula that are referenced in
         # the binding since the series can be anywhere in the
         # dependencies - we use exanded_formula using (shownames) to
         # limit the expansion to the minimum necessary to show such names.
         # This semi-expanded formula will be
         # used later in the interpretor
-        tree = helper.expanded(
+        return helper.expanded(
             self,
             cn,
             parse(self.formula(cn, name)),
             shownames=binding['series'].values,
             scopes=True,
         )
-        new_tree = helper.inject_toplevel_bindings(
-            tree,
-            {
-                'revision_date': revision_date,
-                'from_value_date': from_value_date,
-                'to_value_date': to_value_date,
-            }
-        )
-        series = self.find_series(cn, new_tree)
-        formula = serialize(new_tree)
 
-        groupmap = defaultdict(dict)
-        for sname in series:
-            df, family = self.get_bound_group(
-                cn,
-                sname,
-                binding,
-                from_value_date,
-                to_value_date,
-                revision_date
+    def _bound_families(self, cn, tree, binding):
+        """Return the families of the bound series of the tree (in
+        order of appearance) with their series and group names.
+        """
+        families = {}
+        for sname in self.find_series(cn, tree):
+            m = binding['series'] == sname
+            if sum(m) == 0:
+                continue
+            assert sum(m) == 1
+            family = binding.loc[m, 'family'].iloc[0]
+            families.setdefault(family, []).append(
+                (sname, binding.loc[m, 'group'].iloc[0])
             )
-            if family is not None:
+        return families
+
+    @staticmethod
+    def _combinations(families, possible_values):
+        # build scenarios combinations
+        # combination is a list of dict tha contain a unqiue scenario...
+        # [{ens0 = 'scenario0', ens1 = 'scenario4'}, ... ]
+        return [
+            dict(zip(families, comb))
+            for comb in itertools.product(*possible_values)
+        ]
+
+    @tx
+    def _hijacked_formula(self, cn, name, binding,
+                          from_value_date=None,
+                          to_value_date=None,
+                          revision_date=None):
+        tree = self._hijacked_tree(cn, name, binding)
+        qargs = {
+            'revision_date': revision_date,
+            'from_value_date': from_value_date,
+            'to_value_date': to_value_date,
+        }
+        families = self._bound_families(cn, tree, binding)
+        assert families
+
+        groupmap = defaultdict(dict)
+        for family, bound in families.items():
+            for sname, _gname in bound:
+                df, _family = self.get_bound_group(
+                    cn,
+                    sname,
+                    binding,
+                    from_value_date,
+                    to_value_date,
+                    revision_date
+                )
                 assert df is not None
                 groupmap[family][sname] = df
 
-        assert groupmap
+        return self._bound_evaluate(
+            cn, tree, binding, families, groupmap, qargs
+        )
 
+    def _bound_evaluate(self, cn, tree, binding, families, groupmap, qargs):
         bi = interpreter.BridgeInterpreter(
             cn, self, {},
             groups=groupmap,
             binding=binding,
         )
 
-        # build scenarios combinations
-        possible_values = []
-        families = []
-        for ens_name, sub in groupmap.items():
-            # we may have several groups there
-            # but they all have the same column names
-            # and this is what we want
-            df = sub[list(sub.keys())[0]]
-            possible_values.append(df.columns.to_list())
-            families.append(ens_name)
+        # the first group of each family gives the members
+        combinations = self._combinations(
+            families,
+            [
+                list(sub.values())[0].columns.to_list()
+                for sub in groupmap.values()
+            ]
+        )
 
-        # combination is a list of dict tha contain a unqiue scenario...
-        # [{ens0 = 'scenario0', ens1 = 'scenario4'}, ... ]
-        combinations = []
-        for comb in itertools.product(*possible_values):
-            combination = {}
-            for idx, values in enumerate(comb):
-                combination.update({families[idx]: values})
-            combinations.append(combination)
-
-        columns = []
-        for combination in combinations:
-            columns.append(bi.g_evaluate(formula, combination))
-
-        return pd.concat(columns, axis=1)
+        # evaluate all the combinations at once
+        return bi.b_evaluate(tree, combinations, qargs)
+
+    def _hijacked_history(self, cn, name, binding, idates,
+                          from_value_date=None,
+                          to_value_date=None):
+        # the tree and bindings are resolved once and each
+        # bound group history is read once, the revisions are then
+        # evaluated concurrently out of these histories
+        tree = self._hijacked_tree(cn, name, binding)
+        families = self._bound_families(cn, tree, binding)
+        assert families
+
+        lookups = {}
+        for bound in families.values():
+            for sname, gname in bound:
+                lookups[sname] = self._group_lookup(
+                    cn,
+                    gname,
+                    from_value_date=from_value_date,
+                    to_value_date=to_value_date,
+                    to_insertion_date=idates[-1]
+                )
+
+        def revision(idate):
+            groupmap = defaultdict(dict)
+            for family, bound in families.items():
+                for sname, gname in bound:
+                    df = lookups[sname](idate)
+                    if df is None:
+                        df = self.group_get(
+                            cn,
+                            gname,
+                            from_value_date=from_value_date,
+                            to_value_date=to_value_date,
+                            revision_date=idate
+                        )
+                    groupmap[family][sname] = df
+
+            return self._bound_evaluate(
+                cn, tree, binding, families, groupmap,
+                {
+                    'revision_date': idate,
+                    'from_value_date': from_value_date,
+                    'to_value_date': to_value_date,
+                }
+            )
+
+        return self._group_revisions(revision, idates)
+
+    def _group_lookup(self, cn, name, to_insertion_date,
+                      from_value_date=None,
+                      to_value_date=None):
+        """Read the history of a group once and return a function
+        providing its state at a given insertion date (or None when
+        the history cannot tell).
+        """
+        bounds = {
+            'from_value_date': from_value_date,
+            'to_value_date': to_value_date,
+            'to_insertion_date': to_insertion_date
+        }
+        if self.group_type(cn, name) != 'primary':
+            index = interpreter.HistoryIndex(
+                self.group_history(cn, name, **bounds)
+            )
+            return index.find
+
+        # primary: one history index per member
+        indexes = {}
+        for colname, seriesname in self._group_info(cn, name):
+            indexes[colname] = interpreter.HistoryIndex(
+                self.tsh_group.history(cn, seriesname, **bounds)
+            )
+
+        def find(idate):
+            allseries = []
+            for colname, index in indexes.items():
+                ts = index.find(idate)
+                if ts is None:
+                    return None
+                allseries.append(ts.rename(colname))
+            if not allseries:
+                return None
+            return pd.concat(allseries, axis=1)
+
+        return find